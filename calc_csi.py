@@ -2,15 +2,32 @@
 """
 calc_csi.py
 
-Calculate the chemical shift index of for CA atoms.
+Calculate the chemical shift index of for CA atoms.  With --consensus, the
+indexes of CA, CB, C, and HA are combined into a per-residue consensus,
+smoothed over a sliding window of residues, and called as alpha, beta, or
+coil for each of any number of extracted tables (e.g. one per pH of a
+titration), so secondary structure can be followed across the series.
 
 Original algorithm taken from program by MS Chimenti.  CSI_DICT taken from
-Wishart & Sykes (1994). Methods in Enzymology 239:363-392.
+Wishart & Sykes (1994). Methods in Enzymology 239:363-392.  The CSI ranges
+are laid out on the integer (aa,atom) codes of the compiled bmrb statistics
+(see sparky_bmrb), so residues are classified with array lookups.
 """
 __author__ = "Michael J. Harms"
 __date__ = "080516"
+__usage__ = "calc_csi.py [options] r_file [r_file ...]"
 
-import sys
+import sys, optparse
+import numpy
+import sparky_bmrb, sparky_stats
+from sparky_stats import STATS
+
+class CsiError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
 
 CSI_DICT = {'ALA' : [51.7,53.0],
             'CYS' : [56.3,57.6],
@@ -33,81 +50,407 @@ CSI_DICT = {'ALA' : [51.7,53.0],
             'TRP' : [57.1,58.4],
             'TYR' : [57.5,58.8]}
 
+# Nuclei used for the consensus index
+CSI_ATOMS = ["CA","CB","C","HA"]
 
-def readRFile(filename,column_list,data_type):
+# Half-width of the coil range around the bmrb average for nuclei that have
+# no entry in CSI_DICT (Wishart & Sykes 1994)
+CSI_WIDTH = {"CB":0.7,"C":0.5,"HA":0.1}
+
+# +1 if a shift above the coil range indicates helix, -1 if it indicates sheet
+CSI_SIGN = {"CA":1,"CB":-1,"C":1,"HA":-1}
+
+# Residues averaged by the smoothing pass, and the smoothed index needed to
+# call helix or sheet
+CSI_WINDOW = 5
+CSI_CUTOFF = 0.5
+
+
+def readColumns(filename,column_list):
     """
-    Read an R-style data file.
+    Read columns from an R-style data file into a dictionary of string arrays.
+    Each line is split once; fields after the last requested column (e.g.
+    notes containing spaces) are ignored.
     """
 
     f = open(filename,'r')
     lines = [l for l in f.readlines() if l[0] != "#" and l.strip() != ""]
     f.close()
-    
+
+    if len(lines) == 0:
+        err = "%s is empty!" % filename
+        raise CsiError(err)
+
     # Parse header 
-    header = lines.pop(0)
-    header = header.split()
-    num_columns = len(header)
+    header = lines.pop(0).split()
     header_dict = dict([(c,i) for i, c in enumerate(header)])
 
     # Make sure all columns are in data file
-    header_keys = header_dict.keys()
     for c in column_list:
-        if c not in header_keys:
+        if c not in header_dict:
             err = "Column \"%s\" missing from file!" % c
             raise CsiError(err) 
 
-    # Read data from columns
-    data = []
-    for line in lines:
-        columns = line.split()[1:]
-        data.append([data_type[i](columns[header_dict[c]])
-                    for i, c in enumerate(column_list)])
+    # Rows start with an unlabeled row number
+    last = max([header_dict[c] for c in column_list]) + 2
+    rows = [l.split()[1:last] for l in lines]
+    if len([r for r in rows if len(r) != last - 1]) > 0:
+        err = "%s is not formatted correctly!" % filename
+        raise CsiError(err)
 
-    # Take only CA atoms
-    data = [d for d in data if d[2] == "CA"]
+    rows = numpy.array(rows,dtype=str).reshape((len(rows),last - 1))
 
-    return data
+    return dict([(c,rows[:,header_dict[c]]) for c in column_list])
+
+def floatColumn(column):
+    """
+    Convert a column of strings to floats.  "NA" cells (e.g. peaks missing at
+    one pH of a long extracted table) are nan.
+    """
+
+    values = numpy.empty(len(column),dtype=numpy.float64)
+    values.fill(numpy.nan)
+    present = column != "NA"
+    values[present] = column[present].astype(numpy.float64)
 
+    return values
 
-def doCSI(data):
+def readRFile(filename,column_list,data_type):
     """
-    Use data in CSI_DATA to calculate chemical shift index.
+    Read an R-style data file.  Rows with an "NA" shift are skipped.
     """
 
-    out = []
-    for d in data:
-        csi = CSI_DICT[d[1]]
-        if d[3] < csi[0]:
-            out.append("beta")
-        elif d[3] > csi[1]:
-            out.append("alpha")
+    columns = readColumns(filename,column_list)
+    converted = []
+    for c, t in zip(column_list,data_type):
+        if t == float:
+            converted.append(floatColumn(columns[c]))
         else:
-            out.append("coil") 
+            converted.append(columns[c].astype(t))
+    data = [list(d) for d in zip(*converted)]
+
+    # Take only observed CA atoms
+    data = [d for d in data if d[2] == "CA" and d[3] == d[3]]
+
+    return data
+
+
+def csiTable(stats,atom="CA"):
+    """
+    Lay the coil range of atom out as (aa x atom) arrays of lower and upper
+    bounds on the codes of stats (a sparky_bmrb.BmrbStats).  CA ranges come
+    from CSI_DICT, others are the bmrb average +/- CSI_WIDTH.  Pairs with no
+    range are nan.
+    """
+
+    shape = (len(stats.aa_names),len(stats.atom_names))
+    lower = numpy.empty(shape,dtype=numpy.float64)
+    lower.fill(numpy.nan)
+    upper = lower.copy()
+
+    if atom == "CA":
+        aa = CSI_DICT.keys()
+        keys = stats.keys(aa,[atom for a in aa])
+        lower.flat[keys[keys >= 0]] = [CSI_DICT[a][0] for a, k in
+                                       zip(aa,keys) if k >= 0]
+        upper.flat[keys[keys >= 0]] = [CSI_DICT[a][1] for a, k in
+                                       zip(aa,keys) if k >= 0]
+    elif atom in stats.atom_codes:
+        j = stats.atom_codes[atom]
+        lower[:,j] = stats.average[:,j] - CSI_WIDTH[atom]
+        upper[:,j] = stats.average[:,j] + CSI_WIDTH[atom]
+
+    return lower, upper
+
+def csiTables(stats,atoms=CSI_ATOMS):
+    """
+    Combine the coil ranges of atoms into single (aa x atom) arrays of lower
+    bounds, upper bounds, and CSI_SIGN, so every shift in a table can be
+    classified with one lookup.
+    """
+
+    lower, upper = csiTable(stats,atoms[0])
+    sign = numpy.zeros(lower.shape,dtype=numpy.float64)
+    for atom in atoms:
+        atom_lower, atom_upper = csiTable(stats,atom)
+        has_range = numpy.logical_not(numpy.isnan(atom_lower))
+        lower[has_range] = atom_lower[has_range]
+        upper[has_range] = atom_upper[has_range]
+        if atom in stats.atom_codes:
+            sign[:,stats.atom_codes[atom]] = CSI_SIGN[atom]
+
+    return lower, upper, sign
+
+def calcIndex(aa,atoms,shifts,stats,tables=None):
+    """
+    Chemical shift index of every shift: +1 for helix, -1 for sheet, 0 for
+    coil, and nan for (aa,atom) pairs with no coil range or nan shifts.
+    tables are the arrays from csiTables (built from stats if None).
+    """
+
+    if tables is None:
+        tables = csiTables(stats)
+    lower, upper, sign = [t.ravel() for t in tables]
+
+    keys = stats.keys(aa,atoms)
+    index = numpy.empty(len(keys),dtype=numpy.float64)
+    index.fill(numpy.nan)
+
+    known = numpy.flatnonzero((keys >= 0) & \
+                             numpy.logical_not(numpy.isnan(shifts)))
+    k = keys[known]
+    known, k = known[numpy.logical_not(numpy.isnan(lower[k]))], \
+               k[numpy.logical_not(numpy.isnan(lower[k]))]
+    index[known] = (shifts[known] > upper[k]).astype(numpy.float64) - \
+                   (shifts[known] < lower[k])
+    index[known] *= sign[k]
+
+    return index
+
+def consensusCSI(residue,aa,atoms,index):
+    """
+    Combine the index of each nucleus into a per-residue consensus: the
+    index given by the most nuclei in CSI_ATOMS (0 on a tie).  Returns the
+    residue numbers, their amino acids, an (R x CSI_ATOMS) matrix of indexes
+    (nan if missing), and the consensus (nan if the residue has no indexed
+    nucleus).
+    """
+
+    atom_ids = dict([(a,i) for i, a in enumerate(CSI_ATOMS)])
+    column = numpy.array([atom_ids.get(a,-1) for a in atoms],dtype=numpy.int64)
+    use = (column >= 0) & numpy.logical_not(numpy.isnan(index))
+
+    residues, row = numpy.unique(residue,return_inverse=True)
+    res_aa = numpy.empty(len(residues),dtype=aa.dtype)
+    res_aa[row] = aa
+
+    nuclei = numpy.empty((len(residues),len(CSI_ATOMS)),dtype=numpy.float64)
+    nuclei.fill(numpy.nan)
+    nuclei[row[use],column[use]] = index[use]
+
+    # Votes for helix, coil, and sheet (nan never compares equal)
+    helix, coil, sheet = [(nuclei == i).sum(1) for i in [1,0,-1]]
+    consensus = numpy.zeros(len(residues),dtype=numpy.float64)
+    consensus[helix > numpy.maximum(coil,sheet)] = 1
+    consensus[sheet > numpy.maximum(coil,helix)] = -1
+    consensus[helix + coil + sheet == 0] = numpy.nan
 
-    return out
+    return residues, res_aa, nuclei, consensus
+
+def smoothCSI(residues,consensus,window=CSI_WINDOW):
+    """
+    Average the consensus over a sliding window of residue numbers (centered,
+    window residues wide), ignoring residues that are missing or have no
+    consensus.  Computed with cumulative sums over the full residue range.
+    """
+
+    if len(residues) == 0:
+        return numpy.zeros(0,dtype=numpy.float64)
+
+    first = residues.min()
+    span = residues.max() - first + 1
+    values = numpy.zeros(span,dtype=numpy.float64)
+    present = numpy.zeros(span,dtype=numpy.float64)
+    has_value = numpy.logical_not(numpy.isnan(consensus))
+    values[residues[has_value] - first] = consensus[has_value]
+    present[residues[has_value] - first] = 1
+
+    half = window/2
+    value_sum = numpy.concatenate(([0],numpy.cumsum(values)))
+    present_sum = numpy.concatenate(([0],numpy.cumsum(present)))
+    start = numpy.maximum(numpy.arange(span) - half,0)
+    end = numpy.minimum(numpy.arange(span) + window - half,span)
+    total = value_sum[end] - value_sum[start]
+    count = present_sum[end] - present_sum[start]
+
+    smoothed = numpy.empty(span,dtype=numpy.float64)
+    smoothed.fill(numpy.nan)
+    smoothed[count > 0] = total[count > 0]/count[count > 0]
+
+    return smoothed[residues - first]
+
+def callCSI(smoothed,cutoff=CSI_CUTOFF):
+    """
+    Secondary structure call of each smoothed index.
+    """
+
+    calls = numpy.array(["NA"]*len(smoothed),dtype="S5")
+    known = numpy.flatnonzero(numpy.logical_not(numpy.isnan(smoothed)))
+    calls[known] = "coil"
+    calls[known[smoothed[known] >= cutoff]] = "alpha"
+    calls[known[smoothed[known] <= -cutoff]] = "beta"
+
+    return calls
+
+def consensusFile(filename,stats,column="w2",window=CSI_WINDOW,
+                  cutoff=CSI_CUTOFF,tables=None):
+    """
+    Read one extracted table and return its residues, amino acids, and the
+    smoothed consensus index and call of each residue.  Rows with an "NA"
+    shift are skipped.
+    """
+
+    with STATS.stage("read"):
+        data = readColumns(filename,["residue","aa","atoms",column])
+    STATS.add("shifts_read",len(data["residue"]))
+
+    with STATS.stage("csi"):
+        try:
+            residue = data["residue"].astype(numpy.int64)
+            shifts = floatColumn(data[column])
+        except ValueError:
+            err = "%s is not formatted correctly!" % filename
+            raise CsiError(err)
+
+        observed = numpy.logical_not(numpy.isnan(shifts))
+        residue, shifts = residue[observed], shifts[observed]
+        aa, atoms = data["aa"][observed], data["atoms"][observed]
+
+        index = calcIndex(aa,atoms,shifts,stats,tables)
+        residues, aa, nuclei, consensus = consensusCSI(residue,aa,atoms,index)
+        smoothed = smoothCSI(residues,consensus,window)
+
+    return residues, aa, smoothed, callCSI(smoothed,cutoff)
+
+def iterConsensus(filenames,stats,column="w2",window=CSI_WINDOW,
+                  cutoff=CSI_CUTOFF):
+    """
+    Stream consensusFile over filenames (e.g. one extracted table per pH),
+    yielding one result per file.  Only the per-residue results of each file
+    are kept.
+    """
+
+    tables = csiTables(stats)
+    for filename in filenames:
+        yield consensusFile(filename,stats,column,window,cutoff,tables)
+
+def writeConsensus(filenames,results):
+    """
+    Return a wide R table with one row per residue and a smoothed index and
+    call column for each file (NA where the residue is missing).  results
+    (one per file, e.g. from iterConsensus) are consumed one at a time and
+    merged into the table, so only the table itself is held in memory.
+    """
+
+    num_files = len(filenames)
+    residues = numpy.zeros(0,dtype=numpy.int64)
+    aa = numpy.zeros(0,dtype="S10")
+    smoothed = numpy.zeros((0,num_files),dtype=numpy.float64)
+    calls = numpy.zeros((0,num_files),dtype="S5")
+    for j, (res, res_aa, res_smoothed, res_calls) in enumerate(results):
+
+        # Add rows for residues not seen in earlier files
+        merged = numpy.union1d(residues,res)
+        if len(merged) > len(residues):
+            old_rows = numpy.searchsorted(merged,residues)
+            new_aa = numpy.array(["NA"]*len(merged),dtype="S10")
+            new_smoothed = numpy.empty((len(merged),num_files),
+                                       dtype=numpy.float64)
+            new_smoothed.fill(numpy.nan)
+            new_calls = numpy.empty((len(merged),num_files),dtype="S5")
+            new_calls.fill("NA")
+            new_aa[old_rows] = aa
+            new_smoothed[old_rows] = smoothed
+            new_calls[old_rows] = calls
+            residues, aa, smoothed, calls = merged, new_aa, new_smoothed, \
+                                            new_calls
+
+        rows = numpy.searchsorted(residues,res)
+        aa[rows] = res_aa
+        smoothed[rows,j] = res_smoothed
+        calls[rows,j] = res_calls
+
+    out = ["# Consensus chemical shift index (%s) of:\n" % ",".join(CSI_ATOMS)]
+    out.extend(["#   %i: %s\n" % (j + 1,f) for j, f in enumerate(filenames)])
+    columns = ["%10s%10s" % ("index_%i" % (j + 1),"csi_%i" % (j + 1))
+               for j in range(num_files)]
+    out.append("%10s%10s%10s%s\n" % (" ","residue","aa","".join(columns)))
+    for i in range(len(residues)):
+        values = ["%s%10s" % (s == s and "%10.2F" % s or "%10s" % "NA",c)
+                  for s, c in zip(smoothed[i],calls[i])]
+        out.append("%10i%10i%10s%s\n" % (i,residues[i],aa[i],"".join(values)))
+
+    return "".join(out)
+
+
+def doCSI(data,stats=None):
+    """
+    Use data in CSI_DATA to calculate chemical shift index.  Residues with no
+    CSI range are "NA".
+    """
+
+    if stats is None:
+        stats = sparky_bmrb.loadStats()
+    if len(data) == 0:
+        return []
+
+    index = calcIndex([d[1] for d in data],[d[2] for d in data],
+                      numpy.array([d[3] for d in data],dtype=numpy.float64),
+                      stats,csiTables(stats,["CA"]))
+
+    out = numpy.array(["NA"]*len(data),dtype="S5")
+    for i, call in [(1,"alpha"),(0,"coil"),(-1,"beta")]:
+        out[index == i] = call
+
+    return list(out)
 
 def main():
+    """
+    Function to call if run from command line.
+    """
+
+    parser = optparse.OptionParser(usage=__usage__)
+    parser.add_option("-c","--consensus",action="store_true",default=False,
+                      help="consensus index of %s over all files" % \
+                           ",".join(CSI_ATOMS))
+    parser.add_option("-r","--resonance",default="w2",
+                      help="column holding the shifts [w2]")
+    parser.add_option("-w","--window",type="int",default=CSI_WINDOW,
+                      help="residues in the smoothing window [%i]" % \
+                           CSI_WINDOW)
+    parser.add_option("-t","--cutoff",type="float",default=CSI_CUTOFF,
+                      help="smoothed index calling helix/sheet [%.1F]" % \
+                           CSI_CUTOFF)
+    parser.add_option("-b","--bmrb",default=None,
+                      help="alternative bmrb statistics file")
+    options, args = parser.parse_args()
 
-    try:
-        filename = sys.argv[1]
-    except IndexError:
+    if len(args) == 0:
         print "You must specify a file for CSI analysis!"
         sys.exit()
 
-    data = readRFile(filename,["residue","aa","atoms","w2"],[int,str,str,float])
+    with STATS.stage("read stats"):
+        stats = sparky_bmrb.loadStats(options.bmrb)
+
+    if options.consensus:
+        results = iterConsensus(args,stats,options.resonance,options.window,
+                                options.cutoff)
+        table = writeConsensus(args,results)
+        with STATS.stage("output"):
+            print table
+        return
+
+    for filename in args:
+        with STATS.stage("read"):
+            data = readRFile(filename,["residue","aa","atoms",
+                                       options.resonance],
+                             [int,str,str,float])
 
-    csi_index = doCSI(data)
+        with STATS.stage("csi"):
+            csi_index = doCSI(data,stats)
     
-    out = []
-    for i in range(len(data)):
-        out.append("%10i%10s%10s%10.3F%10s\n" % 
-                   (data[i][0],data[i][1],data[i][2],data[i][3],csi_index[i]))
-    out = ["%10i%s" % (i,l) for i,l in enumerate(out)]
-    out.insert(0,"%10s%10s%10s%10s%10s%10s\n" % 
-               (" ","residue","aa","atom","w2","csi"))
+        out = []
+        for i in range(len(data)):
+            out.append("%10i%10s%10s%10.3F%10s\n" % 
+                       (data[i][0],data[i][1],data[i][2],data[i][3],
+                        csi_index[i]))
+        out = ["%10i%s" % (i,l) for i,l in enumerate(out)]
+        out.insert(0,"%10s%10s%10s%10s%10s%10s\n" % 
+                   (" ","residue","aa","atom",options.resonance,"csi"))
 
-    print "".join(out)
+        with STATS.stage("output"):
+            print "".join(out)
 
 
 if __name__ == "__main__":
-    main()
+    sparky_stats.run(main)
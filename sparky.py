@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+__description__ = \
+"""
+sparky.py
+
+Run a chain of sparky commands over a set of .save files in one process.
+Commands are separated by "+" (or a quoted "|") and applied in order.  Each
+file is read once, held in memory between commands, and written at most once,
+after the last command.  The modules implementing each command are only
+imported if the command is used.
+
+    sparky.py rename rules.txt + delete peaks.txt + extract -- save_dir
+    sparky.py prune "unlabeled and height < 5e4" + extract -- save_dir
+
+Commands:
+    rename RULES_FILE     rename peaks (see sparky_rename-peaks.py)
+    delete PEAK_FILE      delete peaks (see sparky_delete-peaks.py)
+    prune SELECTOR        delete peaks matching a selector (sparky_select.py)
+    extract               R table of a titration (see sparky_extract-peaks.py)
+    extract3d             R table of each file (sparky_extract-peaks_3d-assgn)
+
+Files are given after "--", either as .save files or as directories whose
+.save files are used.  Tables are printed only after all modified files have
+been written.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080505"
+__usage__ = "sparky.py COMMAND [ARGS] [+ COMMAND [ARGS] ...] -- FILES_OR_DIRS"
+
+import os, sys, cStringIO
+import sparky_stats
+from sparky_stats import STATS
+
+class SparkyCommandError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+class SparkyFileSet:
+    """
+    A set of sparky .save files held in memory between commands.
+    """
+
+    def __init__(self,files):
+        """
+        Initialize with a list of file names.  Files are read on first use.
+        """
+
+        self.files = files
+        self.modified = {}
+        self.output = cStringIO.StringIO()
+        self._lines = {}
+        self._state = {}
+
+    def lines(self,sparky_file):
+        """
+        Return the lines of sparky_file.  The state of the file when it was
+        read is recorded so that write can tell if it changed in the meantime.
+        """
+
+        try:
+            return self._lines[sparky_file]
+        except KeyError:
+            pass
+
+        with STATS.stage("read"):
+            f = open(sparky_file,'r')
+            self._state[sparky_file] = _fileState(os.fstat(f.fileno()))
+            self._lines[sparky_file] = f.readlines()
+            f.close()
+        STATS.add("bytes_read",sum([len(l) for l in self._lines[sparky_file]]))
+
+        return self._lines[sparky_file]
+
+    def setLines(self,sparky_file,lines):
+        """
+        Replace the lines of sparky_file and mark it as modified.
+        """
+
+        self._lines[sparky_file] = lines
+        self.modified[sparky_file] = True
+
+    def peakTable(self,sparky_file):
+        """
+        Return a PeakTable of the labeled peaks in sparky_file.  Unmodified
+        files come from the parse cache.
+        """
+
+        if sparky_file in self.modified:
+            import sparky_classes
+            with STATS.stage("parse"):
+                table = sparky_classes.parsePeakTable(self._lines[sparky_file])
+        else:
+            import sparky_cache
+            table = sparky_cache.loadPeakTable(sparky_file)
+
+        return table
+
+    def write(self):
+        """
+        Write all modified files, each atomically.  The locks on every modified
+        file are taken first (in a fixed order, so concurrent runs cannot
+        deadlock) and held until all are written.  If any file changed after
+        it was read, nothing is written, rather than losing the other edit.
+        """
+
+        import sparky_edit
+
+        files = self.modified.keys()
+        files.sort(key=os.path.abspath)
+
+        locks = []
+        try:
+            for sparky_file in files:
+                locks.append(sparky_edit.SparkyLock(sparky_file))
+                state = _fileState(os.stat(sparky_file))
+                if state != self._state[sparky_file]:
+                    err = "\"%s\" changed since it was read; not written!" % \
+                          sparky_file
+                    raise SparkyCommandError(err)
+
+            with STATS.stage("output"):
+                for sparky_file, lock in zip(files,locks):
+                    sparky_edit.writeLines(sparky_file,self._lines[sparky_file],
+                                           lock)
+        finally:
+            for lock in locks:
+                lock.release()
+        STATS.add("files_written",len(files))
+
+
+def _fileState(st):
+    """
+    Identity (device and inode), modification time, and size of a file from
+    its os.stat result.  Committed edits replace the file, so any edit changes
+    the inode.
+    """
+
+    return (st.st_dev,st.st_ino,st.st_mtime,st.st_size)
+
+
+def _rename(script,args,file_set):
+    """
+    Rename peaks using the rules in args[0].
+    """
+
+    rules = script.readPeakRules(args[0])
+    for f in file_set.files:
+        lines = file_set.lines(f)
+        if script.renameLines(lines,rules) > 0:
+            file_set.setLines(f,lines)
+
+def _delete(script,args,file_set):
+    """
+    Delete peaks listed in args[0].
+    """
+
+    import sparky_select
+
+    selector = sparky_select.nameSelector(script.readPeakList(args[0]))
+    for f in file_set.files:
+        lines = file_set.lines(f)
+        kept = script.deleteLines(lines,selector)
+        if len(kept) != len(lines):
+            file_set.setLines(f,kept)
+    script.warnUnmatched(selector)
+
+def _prune(script,args,file_set):
+    """
+    Delete peaks matching the selector expression args[0].
+    """
+
+    import sparky_select
+
+    selector = sparky_select.compileSelector(args[0])
+    for f in file_set.files:
+        lines = file_set.lines(f)
+        kept = script.deleteLines(lines,selector)
+        if len(kept) != len(lines):
+            file_set.setLines(f,kept)
+
+def _extract(script,args,file_set):
+    """
+    Write an R table of the titration to the output of file_set.
+    """
+
+    import sparky_titration
+
+    names = [os.path.basename(f) for f in file_set.files]
+    pH_values = [script.readPH(f) for f in names]
+    tables = [file_set.peakTable(f) for f in file_set.files]
+    data_dir = os.path.abspath(os.path.dirname(file_set.files[0]))
+
+    with STATS.stage("assemble"):
+        matrix = sparky_titration.buildMatrix(tables,pH_values)
+    with STATS.stage("output"):
+        script.writeMatrix(file_set.output,matrix,data_dir,names)
+        file_set.output.write("\n")
+
+def _extract3d(script,args,file_set):
+    """
+    Write an R table of each file to the output of file_set.
+    """
+
+    for f in file_set.files:
+        peaks = script.formatPeaks(file_set.peakTable(f))
+        with STATS.stage("output"):
+            for chunk in script.iterTable(f,peaks):
+                file_set.output.write(chunk)
+            file_set.output.write("\n")
+
+# Command name: (implementing script, number of arguments, handler)
+COMMANDS = {"rename":("sparky_rename-peaks",1,_rename),
+            "delete":("sparky_delete-peaks",1,_delete),
+            "prune":("sparky_delete-peaks",1,_prune),
+            "extract":("sparky_extract-peaks",0,_extract),
+            "extract3d":("sparky_extract-peaks_3d-assgn",0,_extract3d)}
+
+
+def parseCommandLine(argv):
+    """
+    Split argv into a list of (command,args) tuples and a list of .save files.
+    """
+
+    try:
+        split = argv.index("--")
+    except ValueError:
+        err = "No files specified (files follow \"--\")!"
+        raise SparkyCommandError(err)
+
+    # Commands
+    commands = [[]]
+    for a in argv[:split]:
+        if a in ["+","|"]:
+            commands.append([])
+        else:
+            commands[-1].append(a)
+
+    parsed = []
+    for c in commands:
+        if len(c) == 0 or c[0] not in COMMANDS:
+            err = "Unrecognized command \"%s\"!" % " ".join(c)
+            raise SparkyCommandError(err)
+        if len(c) - 1 != COMMANDS[c[0]][1]:
+            err = "Command \"%s\" takes %i argument(s)!" % \
+                  (c[0],COMMANDS[c[0]][1])
+            raise SparkyCommandError(err)
+        parsed.append((c[0],c[1:]))
+
+    # Files
+    files = []
+    for a in argv[split+1:]:
+        if os.path.isdir(a):
+            dir_files = [f for f in os.listdir(a) if f[-5:] == ".save"]
+            dir_files.sort()
+            files.extend([os.path.join(a,f) for f in dir_files])
+        elif os.path.isfile(a):
+            files.append(a)
+        else:
+            err = "\"%s\" does not exist!" % a
+            raise SparkyCommandError(err)
+    if len(files) == 0:
+        err = "No sparky .save files found!"
+        raise SparkyCommandError(err)
+
+    return parsed, files
+
+
+def runCommands(commands,files):
+    """
+    Apply commands to files in order, then write the modified files.  Output
+    of the commands is printed only once the files have been written, so
+    nothing is printed for a run whose writes fail.
+    """
+
+    import sparky_classes
+
+    file_set = SparkyFileSet(files)
+    for name, args in commands:
+        script = sparky_classes.loadScript(COMMANDS[name][0])
+        COMMANDS[name][2](script,args,file_set)
+
+    file_set.write()
+
+    with STATS.stage("output"):
+        sys.stdout.write(file_set.output.getvalue())
+
+
+def main():
+    """
+    Function called if run from command line.
+    """
+
+    if len(sys.argv) < 2:
+        print __usage__
+        sys.exit()
+
+    try:
+        commands, files = parseCommandLine(sys.argv[1:])
+    except SparkyCommandError, e:
+        print >> sys.stderr, e
+        print >> sys.stderr, __usage__
+        sys.exit(1)
+
+    import sparky_classes, sparky_edit
+
+    try:
+        runCommands(commands,files)
+    except (SparkyCommandError,sparky_classes.SparkyError,
+            sparky_edit.SparkyEditError), e:
+        print >> sys.stderr, e
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sparky_stats.run(main)
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+__description__ = \
+"""
+sparky_benchmark.py
+
+Benchmark the hot functions of the sparky scripts on synthetic data.  Realistic
+sparky .save and .list files are generated with a configurable number of peaks,
+dimension, and fraction of labeled peaks.  Each benchmark runs in a fresh
+Python process, whose peak resident memory (including the interpreter and
+imported modules) is reported.  Results can be saved as a baseline and later
+runs compared against it.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080501"
+__usage__ = "sparky_benchmark.py [options]"
+
+import os, sys, time, random, shutil, tempfile, optparse, resource
+import subprocess
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import sparky_classes, sparky_select, sparky_stats
+
+# Amino acids used to generate labels
+AA_LIST = ["ALA","ARG","ASN","ASP","CYS","GLN","GLU","GLY","HIS","ILE","LEU",
+           "LYS","MET","PHE","PRO","SER","THR","TRP","TYR","VAL"]
+
+# Atoms (name, nucleus, ppm range) assigned to each dimension
+DIM_ATOMS = {2:[("N","15N",(105.0,132.0)),("HN","1H",(6.5,10.0))],
+             3:[("CA","13C",(42.0,66.0)),("N","15N",(105.0,132.0)),
+                ("HN","1H",(6.5,10.0))]}
+
+class SparkyBenchmarkError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+def generateSaveFile(save_file,num_peaks=1000,dimension=2,labeled=0.8,seed=0,
+                     pH=7.0):
+    """
+    Write a synthetic sparky .save file with num_peaks peaks, a fraction
+    labeled of which carry assignments.  Positions drift slightly with pH, so
+    a set of files mimics a titration.
+    """
+
+    if dimension not in DIM_ATOMS.keys():
+        err = "Dimension \"%s\" is not valid!" % dimension
+        raise SparkyBenchmarkError(err)
+
+    rand = random.Random(seed)
+    atoms = DIM_ATOMS[dimension]
+    name = os.path.splitext(os.path.basename(save_file))[0]
+
+    out = ["<sparky save file>\n","<version 3.113>\n","<user>\n",
+           "set saveprompt 1\n","set saveinterval 0\n","<end user>\n",
+           "<spectrum>\n","name %s\n" % name,
+           "pathname ../spectra/%s.ucsf\n" % name,
+           "dimension %i\n" % dimension,
+           "shift %s\n" % " ".join(["0"]*dimension),
+           "points %s\n" % " ".join(["1024"]*dimension),
+           "<view>\n","precontour 1\n","<end view>\n","<ornament>\n"]
+
+    for i in range(num_peaks):
+
+        # Residue numbers cycle from 2 to 1000; 3D peaks start at the
+        # preceding residue
+        res_num = i % 999 + 2
+        res = [res_num - 1,res_num,res_num][3-dimension:]
+        aa = [AA_LIST[(r*7) % len(AA_LIST)] for r in res]
+        pos = [rand.uniform(a[2][0],a[2][1]) + 0.01*pH for a in atoms]
+
+        out.append("type peak\n")
+        out.append("id %i\n" % (i + 1))
+        out.append("pos %s\n" % " ".join(["%.3f" % p for p in pos]))
+        out.append("height %.3e %.3e\n" % (0.0,rand.lognormvariate(13,1)))
+        out.append("linewidth %s hz\n" % \
+                   " ".join(["%.1f" % rand.uniform(10,40) for p in pos]))
+        if rand.random() < 0.6:
+            out.append("integral %.3e\n" % rand.lognormvariate(16,1))
+        if rand.random() < 0.1:
+            out.append("note \"synthetic peak %i\"\n" % (i + 1))
+
+        if rand.random() < labeled:
+            rs = ["%s%i|%s|%s" % (aa[j],res[j],atoms[j][0],atoms[j][1])
+                  for j in range(dimension)]
+            out.append("rs |%s|\n" % "|".join(rs))
+            out.extend(["[\n","type label\n","color white\n",
+                        "xy %.2f %.2f\n" % (rand.random(),rand.random()),
+                        "label %s%i%s\n" % (aa[-1],res[-1],
+                                            "-".join([a[0] for a in atoms])),
+                        "]\n"])
+
+    out.extend(["<end ornament>\n","<end spectrum>\n"])
+
+    g = open(save_file,'w')
+    g.writelines(out)
+    g.close()
+
+
+def generateListFile(list_file,num_peaks=1000,dimension=2,seed=0,pH=7.0):
+    """
+    Write a synthetic sparky .list file (assignment and one column per
+    dimension) with num_peaks peaks.
+    """
+
+    rand = random.Random(seed)
+    atoms = DIM_ATOMS[dimension]
+
+    out = ["%17s%s\n" % ("Assignment","".join(["%11s" % ("w%i" % (j+1))
+                                               for j in range(dimension)])),
+           "\n"]
+    for i in range(num_peaks):
+        res_num = i % 999 + 2
+        label = "%s%i%s" % (AA_LIST[(res_num*7) % len(AA_LIST)],res_num,
+                            "-".join([a[0] for a in atoms]))
+        pos = [rand.uniform(a[2][0],a[2][1]) + 0.01*pH for a in atoms]
+        out.append("%17s%s\n" % (label,"".join(["%11.3f" % p for p in pos])))
+
+    g = open(list_file,'w')
+    g.writelines(out)
+    g.close()
+
+
+def generateTitration(out_dir,num_files=10,num_peaks=1000,dimension=2,
+                      labeled=0.8,seed=0):
+    """
+    Write a synthetic titration: num_files pairs of pH_XpYY_synth.save and
+    .list files spanning pH 4 to 9.
+    """
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    files = []
+    for i in range(num_files):
+        pH = 4.0 + 5.0*i/max(num_files - 1,1)
+        root = "pH_%s_synth" % ("%.2f" % pH).replace(".","p")
+        root = os.path.join(out_dir,root)
+        generateSaveFile("%s.save" % root,num_peaks,dimension,labeled,seed+i,
+                         pH)
+        generateListFile("%s.list" % root,num_peaks,dimension,seed+i,pH)
+        files.append(root)
+
+    return files
+
+
+def _dataFiles(data_dir):
+    """
+    Names of the benchmark data files in data_dir.
+    """
+
+    names = {"save":"pH_7p00_bench.save","edit":"edit.save",
+             "work":"work.save","list":"pH_7p00_bench.list",
+             "rules":"rules.txt","delete":"delete.txt","cache":"cache"}
+
+    return dict([(k,os.path.join(data_dir,n)) for k, n in names.items()])
+
+def _generateData(data_dir,num_peaks,dimension,labeled,seed):
+    """
+    Generate the benchmark data in data_dir.
+    """
+
+    files = _dataFiles(data_dir)
+    save_file, edit_file = files["save"], files["edit"]
+    list_file, rules_file = files["list"], files["rules"]
+    delete_file = files["delete"]
+
+    generateSaveFile(save_file,num_peaks,dimension,labeled,seed)
+    generateSaveFile(edit_file,num_peaks,dimension,1.0,seed)
+    generateListFile(list_file,num_peaks,dimension,seed)
+
+    # Rename every residue by +3; delete every tenth residue
+    residues = range(2,min(num_peaks,999) + 2)
+    names = ["%s%i" % (AA_LIST[(r*7) % len(AA_LIST)],r) for r in residues]
+    g = open(rules_file,'w')
+    g.writelines(["%s-->%s%i\n" % (n,n[:3],int(n[3:]) + 3) for n in names])
+    g.close()
+    g = open(delete_file,'w')
+    g.writelines(["%s\n" % n for n in names[::10]])
+    g.close()
+
+def _benchmarks(data_dir,dimension):
+    """
+    Return a list of (name,setup,function) tuples for the data generated in
+    data_dir.  setup is run (untimed) before function.
+    """
+
+    files = _dataFiles(data_dir)
+    save_file, edit_file, work_file = files["save"], files["edit"], \
+                                      files["work"]
+    list_file, cache_dir = files["list"], files["cache"]
+
+    if dimension == 2:
+        extract = sparky_classes.loadScript("sparky_extract-peaks")
+    else:
+        extract = sparky_classes.loadScript("sparky_extract-peaks_3d-assgn")
+    rename = sparky_classes.loadScript("sparky_rename-peaks")
+    delete = sparky_classes.loadScript("sparky_delete-peaks")
+    read_lists = sparky_classes.loadScript("sparky_read-peak-lists")
+
+    def noCache():
+        os.environ["SPARKY_NO_CACHE"] = "1"
+
+    def warmCache():
+        os.environ.pop("SPARKY_NO_CACHE",None)
+        os.environ["SPARKY_CACHE_DIR"] = cache_dir
+        extract.extractPeaks(save_file)
+
+    def copyEditFile():
+        shutil.copy(edit_file,work_file)
+
+    rules = rename.readPeakRules(files["rules"])
+    to_delete = sparky_select.nameSelector(
+                    delete.readPeakList(files["delete"]))
+
+    return [("parse: SparkyExperiment",None,
+             lambda: sparky_classes.SparkyExperiment(save_file,False)),
+            ("parse: readPeakTable",None,
+             lambda: sparky_classes.readPeakTable(save_file,False)),
+            ("parse: SparkySaveIndex",None,
+             lambda: sparky_classes.SparkySaveIndex(save_file)),
+            ("extract: extractPeaks",noCache,
+             lambda: extract.extractPeaks(save_file)),
+            ("extract: extractPeaks (cached)",warmCache,
+             lambda: extract.extractPeaks(save_file)),
+            ("edit: rename convertSparkyFile",copyEditFile,
+             lambda: rename.convertSparkyFile(work_file,rules)),
+            ("edit: delete convertSparkyFile",copyEditFile,
+             lambda: delete.convertSparkyFile(work_file,to_delete)),
+            ("list: parsePeakFile",None,
+             lambda: read_lists.parsePeakFile(list_file))]
+
+
+def _runOne(name,data_dir,dimension,repeat):
+    """
+    Run the benchmark called name on the data in data_dir.  Called in a fresh
+    process (see runBenchmarks); returns the best wall time, the peak
+    resident memory of the process (kB), and the error raised (or None).
+    """
+
+    try:
+        setup, function = dict([(b[0],b[1:]) for b in
+                                _benchmarks(data_dir,dimension)])[name]
+        best = None
+        for i in range(repeat):
+            if setup is not None:
+                setup()
+            t = time.time()
+            function()
+            t = time.time() - t
+            if best is None or t < best:
+                best = t
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return best, peak_rss, None
+    except Exception, e:
+        return None, None, "%s: %s" % (e.__class__.__name__,e)
+
+
+def runBenchmarks(num_peaks=20000,dimension=2,labeled=0.8,repeat=3,seed=0,
+                  data_dir=None):
+    """
+    Run all benchmarks and return a dictionary of results keyed by benchmark
+    name.  Each result holds the best time (s), throughput (peaks/s), and
+    peak resident memory of its process (kB), or the error raised.
+    """
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "sparky_benchmark.py")
+
+    remove_dir = data_dir is None
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix="sparky_benchmark")
+    elif not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    results = {}
+    try:
+        _generateData(data_dir,num_peaks,dimension,labeled,seed)
+        for name, setup, function in _benchmarks(data_dir,dimension):
+            p = subprocess.Popen([sys.executable,script,"--run-one",name,
+                                  "--data-dir",data_dir,
+                                  "-d",str(dimension),"-r",str(repeat)],
+                                 stdout=subprocess.PIPE)
+            out = p.communicate()[0].splitlines()
+            try:
+                best, memory, error = json.loads(out[-1])
+            except (IndexError,ValueError):
+                error = "benchmark process exited with status %i" % \
+                        p.returncode
+
+            if error is not None:
+                results[name] = {"error":error}
+            else:
+                results[name] = {"time":best,"peaks_per_s":num_peaks/best,
+                                 "peak_rss_kb":memory}
+    finally:
+        if remove_dir:
+            shutil.rmtree(data_dir)
+
+    results["_config"] = {"num_peaks":num_peaks,"dimension":dimension,
+                          "labeled":labeled,"repeat":repeat,"seed":seed}
+
+    return results
+
+
+def formatResults(results,baseline=None,tolerance=0.1):
+    """
+    Generate a human-readable table of results.  If baseline is given, each
+    time is compared against it and slowdowns larger than tolerance flagged.
+    """
+
+    names = [k for k in results.keys() if k[0] != "_"]
+    names.sort()
+
+    out = ["# %s\n" % ", ".join(["%s=%s" % x for x in
+                                 sorted(results["_config"].items())])]
+    out.append("%-34s%12s%14s%12s  %s\n" % \
+               ("benchmark","time (s)","peaks/s","peak RSS kB","vs base"))
+    for n in names:
+        r = results[n]
+        if "error" in r:
+            out.append("%-34s  FAILED: %s\n" % (n,r["error"]))
+            continue
+
+        compare = ""
+        if baseline is not None and "time" in baseline.get(n,{}):
+            ratio = r["time"]/baseline[n]["time"]
+            compare = "%.2fx" % ratio
+            if ratio > 1 + tolerance:
+                compare = "%s SLOWER" % compare
+        out.append("%-34s%12.4f%14.0f%12i  %s\n" % \
+                   (n,r["time"],r["peaks_per_s"],r["peak_rss_kb"],compare))
+
+    return "".join(out)
+
+
+def main():
+    """
+    Function called if run from command line.
+    """
+
+    parser = optparse.OptionParser(usage=__usage__)
+    parser.add_option("-n","--peaks",type="int",default=20000,
+                      help="number of peaks per file [20000]")
+    parser.add_option("-d","--dimension",type="int",default=2,
+                      help="experiment dimension (2 or 3) [2]")
+    parser.add_option("-l","--labeled",type="float",default=0.8,
+                      help="fraction of peaks that are labeled [0.8]")
+    parser.add_option("-r","--repeat",type="int",default=3,
+                      help="repetitions of each benchmark (best is kept) [3]")
+    parser.add_option("--seed",type="int",default=0,
+                      help="random seed for synthetic data [0]")
+    parser.add_option("--save",default=None,
+                      help="save results as a baseline (JSON) file")
+    parser.add_option("--compare",default=None,
+                      help="compare results against a baseline file")
+    parser.add_option("--tolerance",type="float",default=0.1,
+                      help="fractional slowdown flagged as a regression [0.1]")
+    parser.add_option("--generate",default=None,metavar="DIR",
+                      help="only write a synthetic titration to DIR")
+    parser.add_option("--files",type="int",default=10,
+                      help="number of pH points written by --generate [10]")
+    parser.add_option("--run-one",default=None,help=optparse.SUPPRESS_HELP)
+    parser.add_option("--data-dir",default=None,help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    # Run a single benchmark for runBenchmarks
+    if options.run_one is not None:
+        print json.dumps(_runOne(options.run_one,options.data_dir,
+                                 options.dimension,options.repeat))
+        return
+
+    if options.generate is not None:
+        generateTitration(options.generate,options.files,options.peaks,
+                          options.dimension,options.labeled,options.seed)
+        return
+
+    baseline = None
+    if options.compare is not None:
+        f = open(options.compare,'r')
+        baseline = json.load(f)
+        f.close()
+
+    results = runBenchmarks(options.peaks,options.dimension,options.labeled,
+                            options.repeat,options.seed)
+    print formatResults(results,baseline,options.tolerance),
+
+    if options.save is not None:
+        g = open(options.save,'w')
+        json.dump(results,g,indent=1,sort_keys=True)
+        g.close()
+
+
+if __name__ == "__main__":
+    sparky_stats.run(main)
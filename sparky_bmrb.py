@@ -0,0 +1,274 @@
+__description__ = \
+"""
+BMRB chemical shift statistics (bmrb_chemical-shift-stats.txt) held as dense
+(amino acid x atom) arrays.  Amino acid and atom names are mapped to integer
+codes, so the statistics for any number of assignments are looked up with one
+fancy-indexing operation instead of one dictionary lookup per assignment.
+
+loadStats compiles a statistics file once into a binary .npz entry in the
+sparky cache directory (see sparky_cache), keyed by a hash of the file's
+contents, so editing or swapping the statistics file invalidates the entry.
+An alternative statistics file can be given explicitly or with the
+SPARKY_BMRB_STATS environment variable.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080514"
+
+import os, tempfile
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+import numpy
+import sparky_cache
+from sparky_stats import STATS
+
+# Statistics stored for each (amino acid, atom) pair, in file column order
+COLUMNS = ["count","minimum","maximum","average","sd"]
+
+DEFAULT_STATS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "bmrb_chemical-shift-stats.txt")
+
+# Bump when the layout of compiled statistics changes
+COMPILED_VERSION = 1
+
+# Sparky atom names that bmrb spells differently (see BmrbStats.keys)
+ATOM_ALIASES = {"HN":"H"}
+
+class SparkyBmrbError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+class BmrbStats:
+    """
+    Chemical shift statistics indexed by integer amino acid and atom codes.
+    Each column in COLUMNS is an (amino acid x atom) array, nan for pairs that
+    are not in the statistics file.
+    """
+
+    def __init__(self,aa_names,atom_names,columns):
+        """
+        Initialize from lists of names and a dictionary of column arrays.
+        """
+
+        self.aa_names = aa_names
+        self.atom_names = atom_names
+        self.aa_codes = dict([(a,i) for i, a in enumerate(aa_names)])
+        self.atom_codes = dict([(a,i) for i, a in enumerate(atom_names)])
+        for c in COLUMNS:
+            setattr(self,c,columns[c])
+
+    def keys(self,aa,atoms,aliases=None):
+        """
+        Convert arrays of amino acid and atom names into flat indexes into the
+        column arrays.  Pairs that have no statistics are -1.  aliases (e.g.
+        ATOM_ALIASES) maps atom names to the bmrb names they are looked up as.
+        """
+
+        if aliases is None:
+            aliases = {}
+
+        aa = numpy.asarray(aa,dtype=str)
+        atoms = numpy.asarray(atoms,dtype=str)
+
+        # Only the distinct names are looked up in the code dictionaries
+        aa_unique, aa_inverse = numpy.unique(aa,return_inverse=True)
+        atom_unique, atom_inverse = numpy.unique(atoms,return_inverse=True)
+        aa_code = numpy.array([self.aa_codes.get(a,-1) for a in aa_unique] +
+                              [-1],dtype=numpy.int64)[aa_inverse]
+        atom_code = numpy.array([self.atom_codes.get(aliases.get(a,a),-1)
+                                 for a in atom_unique] + [-1],
+                                dtype=numpy.int64)
+        atom_code = atom_code[atom_inverse]
+
+        valid = (aa_code >= 0) & (atom_code >= 0)
+        keys = numpy.where(valid,aa_code*len(self.atom_names) + atom_code,-1)
+
+        # Both names may be known without the pair having statistics
+        known = keys[valid]
+        keys[valid] = numpy.where(numpy.isnan(self.count.ravel()[known]),-1,
+                                  known)
+
+        return keys
+
+    def lookup(self,column,keys):
+        """
+        Return the values of column for flat indexes from keys (nan for -1).
+        """
+
+        values = getattr(self,column).ravel()[numpy.maximum(keys,0)]
+        values[keys < 0] = numpy.nan
+
+        return values
+
+    def pairs(self):
+        """
+        Return a list of the (amino acid,atom) pairs that have statistics.
+        """
+
+        aa, atoms = numpy.nonzero(numpy.logical_not(numpy.isnan(self.count)))
+
+        return [(self.aa_names[i],self.atom_names[j]) for i, j in
+                zip(aa,atoms)]
+
+
+def readStats(stats_file=DEFAULT_STATS_FILE):
+    """
+    Parse a chemical shift statistics file from bmrb into a BmrbStats.
+    """
+
+    # Read in file and remove comments and blank lines
+    f = open(stats_file,'r')
+    lines = f.readlines()
+    f.close()
+    lines = [l.split() for l in lines if l[0] != "#" and l.strip() != ""]
+
+    aa_names = dict([(l[0],0) for l in lines]).keys()
+    aa_names.sort()
+    atom_names = dict([(l[1],0) for l in lines]).keys()
+    atom_names.sort()
+    aa_codes = dict([(a,i) for i, a in enumerate(aa_names)])
+    atom_codes = dict([(a,i) for i, a in enumerate(atom_names)])
+
+    columns = {}
+    for c in COLUMNS:
+        columns[c] = numpy.empty((len(aa_names),len(atom_names)),
+                                 dtype=numpy.float64)
+        columns[c].fill(numpy.nan)
+
+    for l in lines:
+        try:
+            values = [float(v) for v in l[3:8]]
+            if len(values) != len(COLUMNS):
+                raise ValueError
+        except ValueError:
+            err = "Mangled line in %s:\n%s" % (stats_file," ".join(l))
+            raise SparkyBmrbError(err)
+        i, j = aa_codes[l[0]], atom_codes[l[1]]
+        for c, v in zip(COLUMNS,values):
+            columns[c][i,j] = v
+
+    return BmrbStats(aa_names,atom_names,columns)
+
+def _statsToArrays(stats,digest):
+    """
+    Convert a BmrbStats into a dictionary of plain arrays for numpy.savez.
+    """
+
+    arrays = {"aa_names":numpy.array(stats.aa_names,dtype=str),
+              "atom_names":numpy.array(stats.atom_names,dtype=str),
+              "columns":numpy.array([getattr(stats,c) for c in COLUMNS]),
+              "digest":numpy.array(digest),
+              "version":numpy.array(COMPILED_VERSION)}
+
+    return arrays
+
+def _arraysToStats(data):
+    """
+    Convert a dictionary of arrays written by _statsToArrays to a BmrbStats.
+    """
+
+    aa_names = [str(a) for a in data["aa_names"]]
+    atom_names = [str(a) for a in data["atom_names"]]
+    columns = dict(zip(COLUMNS,data["columns"]))
+
+    return BmrbStats(aa_names,atom_names,columns)
+
+def _readCompiled(entry,digest):
+    """
+    Return the BmrbStats compiled in entry, or None if there is no valid
+    entry for digest.
+    """
+
+    if not os.path.isfile(entry):
+        return None
+
+    try:
+        data = numpy.load(entry)
+        try:
+            if str(data["digest"]) != digest or \
+               int(data["version"]) != COMPILED_VERSION:
+                return None
+            return _arraysToStats(data)
+        finally:
+            data.close()
+    except (IOError,KeyError,ValueError):
+        return None
+
+def _writeCompiled(entry,stats,digest):
+    """
+    Write stats to entry (through a temporary file, renamed into place).
+    """
+
+    cache_dir = os.path.dirname(entry)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    fd, tmp_file = tempfile.mkstemp(suffix=".tmp",dir=cache_dir)
+    f = os.fdopen(fd,'wb')
+    try:
+        try:
+            numpy.savez(f,**_statsToArrays(stats,digest))
+        finally:
+            f.close()
+        os.rename(tmp_file,entry)
+    except:
+        os.remove(tmp_file)
+        raise
+
+
+# Statistics already loaded by this process, keyed by content hash
+_loaded = {}
+
+def loadStats(stats_file=None,cache_dir=None):
+    """
+    Return a BmrbStats for stats_file (SPARKY_BMRB_STATS, or the file shipped
+    with these scripts, if None).  The file is only parsed if no compiled
+    entry matches the hash of its contents.  Compiled entries are kept in
+    cache_dir (the sparky cache directory if None) unless SPARKY_NO_CACHE is
+    set.
+    """
+
+    if stats_file is None:
+        stats_file = os.environ.get("SPARKY_BMRB_STATS",DEFAULT_STATS_FILE)
+
+    try:
+        f = open(stats_file,'rb')
+        digest = sha1(f.read()).hexdigest()
+        f.close()
+    except IOError:
+        err = "Could not read bmrb statistics file \"%s\"!" % stats_file
+        raise SparkyBmrbError(err)
+
+    try:
+        return _loaded[digest]
+    except KeyError:
+        pass
+
+    if os.environ.get("SPARKY_NO_CACHE"):
+        _loaded[digest] = readStats(stats_file)
+        return _loaded[digest]
+
+    if cache_dir is None:
+        cache_dir = os.environ.get("SPARKY_CACHE_DIR",
+                                   sparky_cache.DEFAULT_CACHE_DIR)
+    entry = os.path.join(cache_dir,"bmrb_%s.npz" % digest)
+
+    stats = _readCompiled(entry,digest)
+    if stats is None:
+        STATS.add("cache_misses")
+        stats = readStats(stats_file)
+        try:
+            _writeCompiled(entry,stats,digest)
+        except EnvironmentError:
+            pass
+    else:
+        STATS.add("cache_hits")
+
+    _loaded[digest] = stats
+
+    return stats
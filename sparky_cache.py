@@ -0,0 +1,279 @@
+__description__ = \
+"""
+A persistent cache of parsed sparky .save files.  Each file is parsed once into
+a PeakTable and stored as a binary .npz entry in a cache directory, keyed by
+absolute path, modification time, size, and parser version.  The cache is
+bounded in size; the least recently used entries are evicted first.
+
+The cache directory defaults to ~/.sparky_cache and can be changed with the
+SPARKY_CACHE_DIR environment variable.  SPARKY_CACHE_SIZE sets the size limit
+in megabytes.  Setting SPARKY_NO_CACHE disables the cache entirely.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080428"
+
+import os, sys, tempfile, zipfile
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+import numpy
+import sparky_classes, sparky_stats
+from sparky_stats import STATS
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"),".sparky_cache")
+DEFAULT_CACHE_SIZE = 256
+
+class SparkyCacheError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+class SparkyCache:
+    """
+    Size-bounded, least-recently-used cache of PeakTables on disk.
+    """
+
+    def __init__(self,cache_dir=None,max_size=None):
+        """
+        Initialize the cache in cache_dir, holding at most max_size megabytes.
+        """
+
+        if cache_dir is None:
+            cache_dir = os.environ.get("SPARKY_CACHE_DIR",DEFAULT_CACHE_DIR)
+        if max_size is None:
+            max_size = float(os.environ.get("SPARKY_CACHE_SIZE",
+                                            DEFAULT_CACHE_SIZE))
+
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_size*1024*1024)
+
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    err = "Could not create cache directory \"%s\"!" % cache_dir
+                    raise SparkyCacheError(err)
+
+    def _entryFile(self,save_file):
+        """
+        Name of the cache entry for save_file.
+        """
+
+        key = sha1(os.path.abspath(save_file)).hexdigest()
+
+        return os.path.join(self.cache_dir,"%s.npz" % key)
+
+    def _fileKey(self,save_file):
+        """
+        Key describing the current state of save_file.
+        """
+
+        st = os.stat(save_file)
+
+        return (os.path.abspath(save_file),float(st.st_mtime),int(st.st_size),
+                sparky_classes.PARSER_VERSION)
+
+    def get(self,save_file):
+        """
+        Return the cached PeakTable for save_file, or None if there is no valid
+        entry.  A hit marks the entry as most recently used; an entry that
+        cannot be read (e.g. truncated) is removed.
+        """
+
+        entry = self._entryFile(save_file)
+        if not os.path.isfile(entry):
+            return None
+
+        try:
+            if not zipfile.is_zipfile(entry):
+                raise zipfile.BadZipfile(entry)
+            data = numpy.load(entry)
+            try:
+                key = (str(data["path"]),float(data["mtime"]),int(data["size"]),
+                       int(data["version"]))
+                if key != self._fileKey(save_file):
+                    return None
+                table = _arraysToTable(data)
+            finally:
+                data.close()
+        except (IOError,KeyError,ValueError,EOFError,zipfile.BadZipfile):
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            return None
+
+        try:
+            os.utime(entry,None)
+        except OSError:
+            pass
+
+        return table
+
+    def put(self,save_file,table,key=None):
+        """
+        Store table as the entry for save_file, then evict old entries.  key
+        is the _fileKey of save_file taken before it was parsed (the current
+        key if None), so a file replaced during the parse is not cached under
+        its new state.  The entry is written to a temporary file and renamed
+        into place, so concurrent readers never see a partial entry.
+        """
+
+        if key is None:
+            key = self._fileKey(save_file)
+        path, mtime, size, version = key
+        arrays = _tableToArrays(table)
+        arrays.update({"path":numpy.array(path),"mtime":numpy.array(mtime),
+                       "size":numpy.array(size),"version":numpy.array(version)})
+
+        fd, tmp_file = tempfile.mkstemp(suffix=".tmp",dir=self.cache_dir)
+        f = os.fdopen(fd,'wb')
+        try:
+            try:
+                numpy.savez(f,**arrays)
+            finally:
+                f.close()
+            os.rename(tmp_file,self._entryFile(save_file))
+        except:
+            os.remove(tmp_file)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache fits in max_bytes.
+        """
+
+        entries = []
+        for e in os.listdir(self.cache_dir):
+            if e[-4:] != ".npz":
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir,e))
+            except OSError:
+                continue
+            entries.append((st.st_mtime,st.st_size,e))
+
+        entries.sort()
+        total = sum([e[1] for e in entries])
+        for mtime, size, e in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir,e))
+            except OSError:
+                pass
+            total -= size
+
+    def load(self,save_file,skip_unlabeled=True):
+        """
+        Return a PeakTable for save_file, parsing the file only if the cache
+        holds no valid entry for it.  Unlabeled peaks are always cached so that
+        one entry serves both values of skip_unlabeled.
+        """
+
+        with STATS.stage("cache read"):
+            table = self.get(save_file)
+
+        if table is None:
+            STATS.add("cache_misses")
+            key = self._fileKey(save_file)
+            table = sparky_classes.readPeakTable(save_file,skip_unlabeled=False)
+            with STATS.stage("cache write"):
+                try:
+                    self.put(save_file,table,key)
+                except EnvironmentError:
+                    pass
+        else:
+            STATS.add("cache_hits")
+            STATS.add("peaks_from_cache",len(table))
+
+        if skip_unlabeled:
+            num_peaks = len(table)
+            table = table.select(table.labeled)
+            STATS.add("peaks_skipped_unlabeled",num_peaks - len(table))
+
+        return table
+
+
+def _tableToArrays(table):
+    """
+    Convert a PeakTable into a dictionary of plain arrays for numpy.savez.
+    """
+
+    arrays = dict([(c,getattr(table,c)) for c in table._columns if c != "note"])
+    arrays["has_note"] = numpy.array([n is not None for n in table.note],
+                                     dtype=numpy.bool_)
+    arrays["note"] = numpy.array([n or "" for n in table.note],dtype=str)
+    arrays["dimension"] = numpy.array(table.dimension)
+    arrays["aa_names"] = numpy.array(table.aa_names,dtype=str)
+    arrays["atom_names"] = numpy.array(table.atom_names,dtype=str)
+
+    return arrays
+
+def _arraysToTable(data):
+    """
+    Convert a dictionary of arrays written by _tableToArrays to a PeakTable.
+    """
+
+    dimension = int(data["dimension"])
+    columns = dict([(c,data[c]) for c in sparky_classes.PeakTable._columns
+                    if c != "note"])
+    for c in ["position","res_num","aa","atoms"]:
+        columns[c] = columns[c].reshape((len(columns["index"]),dimension))
+
+    note = numpy.empty(len(columns["index"]),dtype=object)
+    note[:] = [str(n) for n in data["note"]]
+    note[numpy.logical_not(data["has_note"])] = None
+    columns["note"] = note
+
+    aa_names = [str(a) for a in data["aa_names"]]
+    atom_names = [str(a) for a in data["atom_names"]]
+
+    return sparky_classes.PeakTable(dimension,columns,aa_names,atom_names)
+
+
+_default_cache = None
+
+def loadPeakTable(save_file,skip_unlabeled=True):
+    """
+    Return a PeakTable for save_file using the default cache (or parsing the
+    file directly if SPARKY_NO_CACHE is set or the cache is unusable).
+    """
+
+    global _default_cache
+
+    if not os.environ.get("SPARKY_NO_CACHE"):
+        try:
+            if _default_cache is None:
+                _default_cache = SparkyCache()
+            return _default_cache.load(save_file,skip_unlabeled)
+        except (SparkyCacheError,EnvironmentError):
+            pass
+
+    return sparky_classes.readPeakTable(save_file,skip_unlabeled)
+
+
+def main():
+    """
+    Parse each file on the command line into the cache.
+    """
+
+    if len(sys.argv) < 2:
+        print "sparky_cache.py $1.save $2.save ... $n.save"
+        sys.exit()
+
+    cache = SparkyCache()
+    for save_file in sys.argv[1:]:
+        table = cache.load(save_file,skip_unlabeled=False)
+        print "%s: %i peaks" % (save_file,len(table))
+
+
+if __name__ == "__main__":
+    sparky_stats.run(main)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+__description__ = \
+"""
+sparky_calc-csp.py
+
+Combined chemical shift perturbations of the N-HN peaks in a titration:
+
+    csp = sqrt(dH**2 + (alpha*dN)**2)
+
+relative to a reference pH (the lowest by default) and between consecutive pH
+values.  Both are computed in one array operation over the (peak x pH)
+matrices, so the table and the report of significant residues can be rerun
+as each new spectrum arrives (a directory of .save files only parses new
+files; see sparky_cache).  The titration is a directory of sparky .save files
+named pH_7p01_*.save or a .npz bundle written by sparky_extract-peaks.py -f
+npz -l wide.
+
+Modes:
+    matrix       perturbation of each peak at each pH from the reference
+    steps        perturbation of each peak between consecutive pH values
+    significant  peaks whose largest perturbation from the reference exceeds
+                 the cutoff (by default the mean + 1 sd of the largest
+                 perturbation of every peak)
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080522"
+__usage__ = "sparky_calc-csp.py [options] dir_with_save_files|titration.npz"
+
+import os, sys, optparse
+import numpy
+import sparky_stats, sparky_titration
+from sparky_stats import STATS
+
+# Weight of the nitrogen shift relative to the proton shift
+CSP_ALPHA = 0.14
+
+# Atom pairs (w1-w2) used, and the sd above the mean of the largest
+# perturbations that makes a peak significant
+CSP_ATOMS = ["N-HN"]
+CSP_SD = 1.0
+
+MODES = ["matrix","steps","significant"]
+
+# Rows formatted (and written) at a time
+CHUNK_ROWS = 4096
+
+class SparkyCspError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+
+def selectPeaks(matrix,atom_pairs=CSP_ATOMS):
+    """
+    Return the rows of matrix whose atoms are in atom_pairs, and the proton
+    and nitrogen shift matrices of those rows.  The dimension holding the
+    proton is taken from the atom names (e.g. w2 for N-HN, w1 for HN-N).
+    """
+
+    rows = numpy.flatnonzero(numpy.in1d(matrix.atoms,atom_pairs))
+    proton_w1 = numpy.array([a.split("-")[0][0:1] == "H"
+                             for a in matrix.atoms[rows]],dtype=numpy.bool_)
+    proton_w1 = proton_w1[:,numpy.newaxis]
+
+    w1, w2 = matrix.w1[rows], matrix.w2[rows]
+    proton = numpy.where(proton_w1,w1,w2)
+    nitrogen = numpy.where(proton_w1,w2,w1)
+
+    return rows, proton, nitrogen
+
+def calcPerturbations(proton,nitrogen,reference=0,alpha=CSP_ALPHA):
+    """
+    Combined perturbations of (peak x pH) proton and nitrogen shifts relative
+    to column reference, and between consecutive columns (peak x pH - 1).
+    Missing shifts give nan.
+    """
+
+    d_proton = proton - proton[:,reference,numpy.newaxis]
+    d_nitrogen = nitrogen - nitrogen[:,reference,numpy.newaxis]
+    csp = numpy.sqrt(d_proton**2 + (alpha*d_nitrogen)**2)
+
+    steps = numpy.sqrt(numpy.diff(proton,axis=1)**2 +
+                       (alpha*numpy.diff(nitrogen,axis=1))**2)
+
+    return csp, steps
+
+def significantPeaks(csp,cutoff=None,num_sd=CSP_SD):
+    """
+    Find peaks whose largest perturbation exceeds cutoff (the mean + num_sd
+    sd of the largest perturbation of every peak if None).  Returns the
+    cutoff, the row indexes sorted from largest to smallest perturbation,
+    each peak's largest perturbation and its column, and the number of
+    columns above the cutoff.
+    """
+
+    observed = numpy.logical_not(numpy.isnan(csp))
+    filled = numpy.where(observed,csp,-numpy.inf)
+    largest_column = filled.argmax(1)
+    largest = filled[numpy.arange(len(csp)),largest_column]
+    largest[numpy.logical_not(observed.any(1))] = numpy.nan
+
+    measured = largest[numpy.logical_not(numpy.isnan(largest))]
+    if cutoff is None:
+        if len(measured) == 0:
+            err = "No perturbations to set a cutoff from!"
+            raise SparkyCspError(err)
+        cutoff = measured.mean() + num_sd*measured.std()
+
+    num_above = (filled > cutoff).sum(1)
+    rows = numpy.flatnonzero(num_above > 0)
+    rows = rows[numpy.argsort(-largest[rows],kind="mergesort")]
+
+    return cutoff, rows, largest, largest_column, num_above
+
+def iterMatrix(matrix,rows,values,labels,titration,chunk_rows=CHUNK_ROWS):
+    """
+    Generate a wide R table of values (rows x columns, one column per label)
+    in chunks of up to chunk_rows rows.
+    """
+
+    header = ["# Taken from data in: %s\n" % os.path.abspath(titration)]
+    header.append("%10s%10s%10s%10s%s\n" % \
+                  (" ","residue","aa","atoms",
+                   "".join(["%12s" % l for l in labels])))
+    yield "".join(header)
+
+    out = []
+    for i, r in enumerate(rows):
+        columns = [v == v and "%12.4F" % v or "%12s" % "NA"
+                   for v in values[i]]
+        out.append("%10i%10i%10s%10s%s\n" % \
+                   (i,matrix.residue[r],matrix.aa[r],matrix.atoms[r],
+                    "".join(columns)))
+
+        if len(out) >= chunk_rows:
+            yield "".join(out)
+            out = []
+
+    if out:
+        yield "".join(out)
+
+def significantReport(matrix,rows,csp,reference_pH,titration,cutoff=None,
+                      num_sd=CSP_SD):
+    """
+    Return an R table of the significant peaks, largest perturbation first.
+    """
+
+    cutoff, order, largest, largest_column, num_above = \
+        significantPeaks(csp,cutoff,num_sd)
+
+    out = ["# Taken from data in: %s\n" % os.path.abspath(titration)]
+    out.append("# Reference pH %.3F, cutoff %.4F ppm: %i of %i peaks\n" % \
+               (reference_pH,cutoff,len(order),len(rows)))
+    out.append("%10s%10s%10s%10s%12s%10s%10s\n" % \
+               (" ","residue","aa","atoms","max_csp","pH_max","num_pH"))
+    for i, j in enumerate(order):
+        r = rows[j]
+        out.append("%10i%10i%10s%10s%12.4F%10.3F%10i\n" % \
+                   (i,matrix.residue[r],matrix.aa[r],matrix.atoms[r],
+                    largest[j],matrix.pH[largest_column[j]],num_above[j]))
+
+    return "".join(out)
+
+
+def main():
+    """
+    If called from command line...
+    """
+
+    parser = optparse.OptionParser(usage=__usage__)
+    parser.add_option("-m","--mode",default="matrix",
+                      help="matrix, steps, or significant [matrix]")
+    parser.add_option("-r","--reference",type="float",default=None,
+                      help="reference pH (nearest measured) [lowest]")
+    parser.add_option("-a","--alpha",type="float",default=CSP_ALPHA,
+                      help="weight of the nitrogen shift [%.2F]" % CSP_ALPHA)
+    parser.add_option("-p","--atoms",default=",".join(CSP_ATOMS),
+                      help="atom pairs used [%s]" % ",".join(CSP_ATOMS))
+    parser.add_option("-t","--cutoff",type="float",default=None,
+                      help="significance cutoff in ppm [mean + sd]")
+    parser.add_option("-k","--num-sd",type="float",default=CSP_SD,
+                      help="sd above the mean for the default cutoff " + \
+                           "[%.1F]" % CSP_SD)
+    parser.add_option("-j","--jobs",type="int",default=1,
+                      help="number of processes used to parse files")
+    parser.add_option("-o","--output",default=None,
+                      help="output file [stdout]")
+    options, args = parser.parse_args()
+
+    try:
+        titration = args[0]
+    except IndexError:
+        print __usage__
+        sys.exit()
+
+    if options.mode not in MODES:
+        print "--mode must be one of %s" % ", ".join(MODES)
+        sys.exit()
+    if not os.path.exists(titration):
+        print "\"%s\" does not exist!" % titration
+        sys.exit()
+
+    with STATS.stage("read"):
+        matrix = sparky_titration.loadTitration(titration,options.jobs)
+    if len(matrix.pH) == 0:
+        print "No spectra in \"%s\"!" % titration
+        sys.exit()
+
+    reference = 0
+    if options.reference is not None:
+        reference = numpy.abs(matrix.pH - options.reference).argmin()
+
+    with STATS.stage("csp"):
+        rows, proton, nitrogen = selectPeaks(matrix,options.atoms.split(","))
+        csp, steps = calcPerturbations(proton,nitrogen,reference,
+                                       options.alpha)
+    STATS.add("peaks_compared",len(rows))
+
+    with STATS.stage("output"):
+        if options.output is None:
+            g = sys.stdout
+        else:
+            g = open(options.output,'w')
+
+        if options.mode == "matrix":
+            labels = ["csp_%.2F" % p for p in matrix.pH]
+            for chunk in iterMatrix(matrix,rows,csp,labels,titration):
+                g.write(chunk)
+        elif options.mode == "steps":
+            labels = ["step_%.2F" % p for p in matrix.pH[1:]]
+            for chunk in iterMatrix(matrix,rows,steps,labels,titration):
+                g.write(chunk)
+        else:
+            try:
+                g.write(significantReport(matrix,rows,csp,
+                                          matrix.pH[reference],titration,
+                                          options.cutoff,options.num_sd))
+            except SparkyCspError, e:
+                print >> sys.stderr, e
+                sys.exit(1)
+
+        if options.output is None:
+            g.write("\n")
+        else:
+            g.close()
+
+
+if __name__ == "__main__":
+    sparky_stats.run(main)
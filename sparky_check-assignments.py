@@ -5,30 +5,52 @@ sparky_check-assignments.py
 
 Do a couple of simple checks on the assignments of a spectrum given the
 statistics for assignments of identical atom types in many NMR spectra.
+
+With --score, every shift (w1, w2, and w3) is instead given a z-score and
+log-likelihood against the bmrb average and sd, checked against the bmrb
+minimum and maximum, and the assignments are ranked by their combined score.
 """
 __author__ = "Michael J. Harms"
 __date__ = "080423"
-__usage__ = "sparky_check-assignments.py assignment_file [stat_file]"
+__usage__ = \
+"sparky_check-assignments.py [options] assignment_file [stat_file]"
 
-import os, sys
+import os, sys, optparse
+import numpy
+import sparky_bmrb, sparky_stats
+from sparky_stats import STATS
 
-def parseStats(stats_file):
+class SparkyCheckAssignmentsError(Exception):
     """
-    Parse a chemical shift statistics file from brmb.
+    General error class for this module.
     """
 
-    # Read in file and remove comments and blank lines 
-    f = open(stats_file,'r')
-    lines = f.readlines()
-    f.close()
-    lines = [l.split() for l in lines if l[0] != "#" and l.strip() != ""]
-  
-    stats = [("%s %s" % (l[0],l[1]),(float(l[6]),float(l[7]))) for l in lines]
-   
-    return dict(stats)
+    pass
 
-def sparkyCheckAssignments(assignment_file,stats,resonance="w2"):
+# Shift columns and, for each, the atom it belongs to: the first assigned
+# atom, the labeled atom (aa/atoms), or the second assigned atom.
+DIMENSIONS = ["w1","w2","w3"]
+
+# Number of suspicious assignments reported by default when scoring
+TOP_SCORES = 50
+
+def parseStats(stats_file=None):
     """
+    Load a chemical shift statistics file from brmb as a sparky_bmrb.BmrbStats
+    table indexed by integer (aa,atom) codes.  The file is only parsed if it
+    has changed since it was last compiled (see sparky_bmrb.loadStats).
+    """
+
+    return sparky_bmrb.loadStats(stats_file)
+
+def readAssignments(assignment_file,resonance="w2"):
+    """
+    Read an assignment table (as written by sparky_extract-peaks_3d-assgn.py)
+    into a dictionary of arrays: residue, aa, atoms, assgn (assigned atoms),
+    assgn_num (N x 2 residue numbers of the assigned atoms), values (the
+    chemical shifts in column resonance), and, if the table has all of the
+    DIMENSIONS, shifts, dim_aa, and dim_atoms (N x 3 shifts and the amino acid
+    and atom each belongs to).  Each line is split once.
     """
 
     f = open(assignment_file,'r')
@@ -43,20 +65,7 @@ def sparkyCheckAssignments(assignment_file,stats,resonance="w2"):
   
     # Read assignments input data 
     try: 
-        residue_index = col_dict["residue"]
-        residues = [int(c[residue_index]) for c in columns]
-
-        assgn_index = col_dict["assgn_atoms"]
-        assgn = [c[assgn_index] for c in columns]
-        
-        aa_index = col_dict["aa"]
-        aa = [c[aa_index] for c in columns]
-        
-        atoms_index = col_dict["atoms"]
-        atoms = [c[atoms_index] for c in columns]
-
-        N = range(len(residues))
-
+        indexes = [col_dict[c] for c in ["residue","assgn_atoms","aa","atoms"]]
     except KeyError:
         err = "%s is not formatted correctly!" % assignment_file
         raise SparkyCheckAssignmentsError(err)
@@ -65,53 +74,208 @@ def sparkyCheckAssignments(assignment_file,stats,resonance="w2"):
     # resonance on command line)
     try:
         resonance_index = col_dict[resonance]
-        res_values = [float(c[resonance_index]) for c in columns]
     except KeyError:
         err = "%s does not contain data for resonance %s" % \
             (assignment_file,resonance)
         raise SparkyCheckAssignmentsError(err)
 
+    try:
+        residue, assgn, aa, atoms = [[c[i] for c in columns] for i in indexes]
+        values = [c[resonance_index] for c in columns]
+
+        # Assigned atoms (e.g. ASN2-CA,ARG1-HN) split into residue and atom
+        assgn_parts = [x.split("-",1) for a in assgn
+                       for x in a.split(",")[0:2]]
+        assgn_num = [int(p[0][3:]) for p in assgn_parts]
+        data = {"residue":numpy.array(residue,dtype=numpy.int64),
+                "aa":numpy.array(aa,dtype=str),
+                "atoms":numpy.array(atoms,dtype=str),
+                "assgn":numpy.array(assgn,dtype=str),
+                "assgn_num":numpy.array(assgn_num,dtype=numpy.int64),
+                "values":numpy.array(values,dtype=numpy.float64)}
+        data["assgn_num"] = data["assgn_num"].reshape((len(columns),2))
+
+        if len([d for d in DIMENSIONS if d in col_dict]) == len(DIMENSIONS):
+            shifts = [c[col_dict[d]] for c in columns for d in DIMENSIONS]
+            assgn_aa = numpy.array([p[0][0:3] for p in assgn_parts],dtype=str)
+            assgn_atoms = numpy.array([p[1] for p in assgn_parts],dtype=str)
+            assgn_aa = assgn_aa.reshape((len(columns),2))
+            assgn_atoms = assgn_atoms.reshape((len(columns),2))
+
+            data["shifts"] = numpy.array(shifts,dtype=numpy.float64)
+            data["shifts"] = data["shifts"].reshape((len(columns),3))
+            data["dim_aa"] = numpy.column_stack((assgn_aa[:,0],data["aa"],
+                                                 assgn_aa[:,1]))
+            data["dim_atoms"] = numpy.column_stack((assgn_atoms[:,0],
+                                                    data["atoms"],
+                                                    assgn_atoms[:,1]))
+    except (IndexError,ValueError):
+        err = "%s is not formatted correctly!" % assignment_file
+        raise SparkyCheckAssignmentsError(err)
+
+    return data
+
+def checkAssignments(data,stats):
+    """
+    Run every check over the arrays returned by readAssignments in one
+    vectorized pass each.  Returns a dictionary of row indexes:
+
+        out_of_order   assigned atoms not from residue + 1
+        double_name    residue also given another amino acid name (the last
+                       name used for the residue is taken as correct)
+        bad_atoms      (aa,atom) pair not in the statistics
+        strange_ppm    shift more than 1 std from the average
+
+    along with last_aa (the last name used for each row's residue), average,
+    and sd.
+    """
+
+    residue = data["residue"]
 
     # Check for non-sequential assignment residues
-    assgn_num = [[int(x.split("-")[0][3:]) for x in a.split(",")]
-                 for a in assgn]
-    out_of_order = [(residues[i],aa[i],assgn[i])
-                    for i in N if (assgn_num[i][0] != residues[i]+1) or 
-                                  (assgn_num[i][1] != residues[i]+1)] 
+    out_of_order = (data["assgn_num"][:,0] != residue + 1) | \
+                   (data["assgn_num"][:,1] != residue + 1)
 
     # Find residues that have more than one aa name
-    res_dict = dict([(residues[i],aa[i]) for i in N])
-    double_name = [(residues[i],aa[i],res_dict[residues[i]]) for i in N 
-                   if aa[i] != res_dict[residues[i]]]
+    unique_res, res_inverse = numpy.unique(residue,return_inverse=True)
+    last = len(residue) - 1 - \
+           numpy.unique(residue[::-1],return_index=True)[1]
+    last_aa = data["aa"][last][res_inverse]
+    double_name = data["aa"] != last_aa
 
     # Make sure that all of the atoms have standard amino acid and atom names
-    possible_atoms = stats.keys() 
-    atom_keys = [(i,"%s %s" % (aa[i],atoms[i])) for i in N]
-    bad_atoms = [a for a in atom_keys if a[1] not in possible_atoms]
+    keys = stats.keys(data["aa"],data["atoms"])
+    bad_atoms = keys < 0
 
     # Check for ppm values different by more than a standard deviation from 
     # average.
-    atom_keys = [a for a in atom_keys if a not in bad_atoms]
-    deviations = [abs(res_values[a[0]] - stats[a[1]][0]) for a in atom_keys]
-    strange_ppm = [a for i, a in enumerate(atom_keys)
-                   if deviations[i] > stats[a[1]][1]]
+    average = stats.lookup("average",keys)
+    sd = stats.lookup("sd",keys)
+    strange_ppm = numpy.zeros(len(residue),dtype=numpy.bool_)
+    good = numpy.logical_not(bad_atoms)
+    strange_ppm[good] = numpy.abs(data["values"][good] - average[good]) > \
+                        sd[good]
+
+    return {"out_of_order":numpy.flatnonzero(out_of_order),
+            "double_name":numpy.flatnonzero(double_name),
+            "bad_atoms":numpy.flatnonzero(bad_atoms),
+            "strange_ppm":numpy.flatnonzero(strange_ppm),
+            "last_aa":last_aa,"average":average,"sd":sd}
+
+def scoreAssignments(data,stats):
+    """
+    Score every shift of every assignment against stats at once.  Returns a
+    dictionary of arrays:
+
+        z              (N x 3) (shift - average)/sd (nan without statistics)
+        log_like       (N x 3) log-likelihood of the shift under a normal
+                       distribution with the bmrb average and sd
+        out_of_bounds  (N x 3) shift outside the bmrb minimum/maximum
+        score          sum of z**2 over the dimensions with statistics
+        num_out        number of dimensions out of bounds
+        order          rows ranked from most to least suspicious: any shift
+                       out of bounds first, then by score
+    """
+
+    if "shifts" not in data:
+        err = "Scoring requires columns %s!" % ", ".join(DIMENSIONS)
+        raise SparkyCheckAssignmentsError(err)
+
+    shifts = data["shifts"]
+    keys = stats.keys(data["dim_aa"].ravel(),data["dim_atoms"].ravel(),
+                      sparky_bmrb.ATOM_ALIASES)
+    average, sd, minimum, maximum = [stats.lookup(c,keys).reshape(shifts.shape)
+                                     for c in ["average","sd","minimum",
+                                               "maximum"]]
+
+    # nan (missing statistics) and zero sd propagate without warnings
+    old_settings = numpy.seterr(invalid="ignore",divide="ignore")
+    try:
+        z = (shifts - average)/sd
+        log_like = -0.5*z**2 - numpy.log(sd) - 0.5*numpy.log(2*numpy.pi)
+        out_of_bounds = (shifts < minimum) | (shifts > maximum)
+    finally:
+        numpy.seterr(**old_settings)
+
+    scored = numpy.logical_not(numpy.isnan(z))
+    score = numpy.where(scored,z**2,0.0).sum(1)
+    num_out = out_of_bounds.sum(1)
+
+    # lexsort sorts on its last key first
+    order = numpy.lexsort((-score,-num_out))
+
+    return {"z":z,"log_like":log_like,"out_of_bounds":out_of_bounds,
+            "score":score,"num_out":num_out,"order":order}
+
+def formatScores(data,scores,top=TOP_SCORES):
+    """
+    Return an R-readable table of the top (all if top is 0) most suspicious
+    assignments, ranked by scoreAssignments.
+    """
+
+    order = scores["order"]
+    if top > 0:
+        order = order[:top]
+
+    z, log_like = scores["z"], scores["log_like"]
+    out_of_bounds = scores["out_of_bounds"]
+
+    out = ["%10s%10s%10s%10s%28s%s%10s%10s%10s\n" % \
+           (" ","residue","aa","atoms","assgn_atoms",
+            "".join(["%10s" % ("z_%s" % d) for d in DIMENSIONS]),
+            "log_like","score","bounds")]
+    for rank, i in enumerate(order):
+        z_values = "".join([v == v and "%10.2F" % v or "%10s" % "NA"
+                            for v in z[i]])
+        scored = numpy.logical_not(numpy.isnan(log_like[i]))
+        if scored.any():
+            total = "%10.2F" % log_like[i][scored].sum()
+        else:
+            total = "%10s" % "NA"
+        bounds = ",".join([d for d, o in zip(DIMENSIONS,out_of_bounds[i])
+                           if o]) or "ok"
+        out.append("%10i%10i%10s%10s%28s%s%s%10.2F%10s\n" % \
+                   (rank,data["residue"][i],data["aa"][i],data["atoms"][i],
+                    data["assgn"][i],z_values,total,scores["score"][i],
+                    bounds))
+
+    return "".join(out)
+
+def sparkyCheckAssignments(assignment_file,stats,resonance="w2"):
+    """
+    Check the assignments in assignment_file against stats (a BmrbStats) and
+    return a human-readable report.
+    """
+
+    with STATS.stage("read"):
+        data = readAssignments(assignment_file,resonance)
+    STATS.add("assignments_checked",len(data["residue"]))
+
+    with STATS.stage("check"):
+        checks = checkAssignments(data,stats)
+
+    residue, aa, atoms = data["residue"], data["aa"], data["atoms"]
+    values, average, sd = data["values"], checks["average"], checks["sd"]
  
     # Generate human-readable output
     out = ["Automated assignment checking for:\n    %s\n\n" % \
            os.path.abspath(assignment_file)] 
     out.append("Possible non-sequential assignments:\n")
-    out.extend(["    %i %s, %s\n" % o for o in out_of_order])
+    out.extend(["    %i %s, %s\n" % (residue[i],aa[i],data["assgn"][i])
+                for i in checks["out_of_order"]])
     out.append("\n")
     out.append("Residue numbers with multiple amino acid names:\n")
-    out.extend(["    %i %s, %s\n" % d for d in double_name])
+    out.extend(["    %i %s, %s\n" % (residue[i],aa[i],checks["last_aa"][i])
+                for i in checks["double_name"]])
     out.append("\n")
     out.append("Unrecognized amino acid/atom pairs:\n")
-    out.extend(["    %i %s\n" % (residues[a[0]],a[1]) for a in bad_atoms])
+    out.extend(["    %i %s %s\n" % (residue[i],aa[i],atoms[i])
+                for i in checks["bad_atoms"]])
     out.append("\n")
     out.append("Chemical shifts greater than 1 std from average:\n")
-    out.extend(["    %i %s, %.3F (Avg: %.3F +/- %.2F)\n" % \
-               (residues[a[0]],a[1],res_values[a[0]],
-                stats[a[1]][0],stats[a[1]][1]) for a in strange_ppm])
+    out.extend(["    %i %s %s, %.3F (Avg: %.3F +/- %.2F)\n" % \
+               (residue[i],aa[i],atoms[i],values[i],average[i],sd[i])
+                for i in checks["strange_ppm"]])
     out.append("\n")
 
     return "".join(out)
@@ -121,25 +285,44 @@ def main():
     Function to call if run from command line.
     """
 
-    print __file__
+    parser = optparse.OptionParser(usage=__usage__)
+    parser.add_option("-r","--resonance",default="w2",
+                      help="column checked against the averages [w2]")
+    parser.add_option("-s","--score",action="store_true",default=False,
+                      help="rank assignments by a score over all dimensions")
+    parser.add_option("-n","--top",type="int",default=TOP_SCORES,
+                      help="assignments reported with --score, 0 for all " + \
+                           "[%i]" % TOP_SCORES)
+    options, args = parser.parse_args()
+
     try:
-        assignment_file = sys.argv[1]
+        assignment_file = args[0]
     except IndexError:
         print __usage__
         sys.exit()
 
     try:
-        stat_file = sys.argv[2]
+        stat_file = args[1]
     except IndexError:
-        script_dir = os.path.split(__file__)[0]
-        stat_file = os.path.join(script_dir,"bmrb_chemical-shift-stats.txt")
+        stat_file = None
 
-    stats = parseStats(stat_file)
-    log = sparkyCheckAssignments(assignment_file,stats)
+    with STATS.stage("read stats"):
+        stats = parseStats(stat_file)
 
+    if options.score:
+        with STATS.stage("read"):
+            data = readAssignments(assignment_file,options.resonance)
+        STATS.add("assignments_checked",len(data["residue"]))
+        with STATS.stage("score"):
+            scores = scoreAssignments(data,stats)
+        with STATS.stage("format"):
+            log = formatScores(data,scores,options.top)
+    else:
+        log = sparkyCheckAssignments(assignment_file,stats,options.resonance)
 
-    #print log
+    with STATS.stage("output"):
+        print log
 
 
 if __name__ == "__main__":
-    main()
+    sparky_stats.run(main)
@@ -5,7 +5,13 @@ A set of classes useful for reading sparky .save files.
 __author__ = "Michael J. Harms"
 __date__ = "080425"
 
-import os, sys
+import os, sys, re, mmap, imp
+import numpy
+import sparky_stats
+from sparky_stats import STATS
+
+# Bump whenever parsing changes, so cached parses (sparky_cache) are discarded.
+PARSER_VERSION = 2
 
 class SparkyError(Exception):
     """
@@ -14,151 +20,715 @@ class SparkyError(Exception):
 
     pass
 
-class SparkyPeak:
+def loadScript(script_name):
+    """
+    Import one of the sparky_*.py scripts (which cannot be imported by name
+    because of the hyphens) as a module.
+    """
+
+    module_name = script_name.replace("-","_")
+    try:
+        return sys.modules[module_name]
+    except KeyError:
+        pass
+
+    script_dir = os.path.split(os.path.abspath(__file__))[0]
+    script_file = os.path.join(script_dir,"%s.py" % script_name)
+    if not os.path.isfile(script_file):
+        err = "Script \"%s\" not found!" % script_file
+        raise SparkyError(err)
+
+    return imp.load_source(module_name,script_file)
+
+# Line prefixes of the peak fields, keyed to the field they hold
+_PEAK_FIELDS = {"hei":"height","int":"integral","not":"note","rs ":"rs",
+                "pos":"position"}
+
+# A peak label is the residue group of its "rs" line (e.g. ASN2) followed by
+# its atoms (e.g. N-HN)
+_label_pattern = re.compile(r"^([A-Za-z]+-?\d+)(.*)$")
+
+def splitLabel(label):
+    """
+    Split a peak label (e.g. ASN2N-HN) into its residue group (ASN2) and atoms
+    (N-HN).  Returns None if the label does not start with a residue group.
+    """
+
+    m = _label_pattern.match(label)
+    if m is None:
+        return None
+
+    return m.group(1), m.group(2)
+
+def rsGroups(rs_line,dimension):
     """
-    A class to hold an individual peak.
+    Return the residue group of each dimension of an "rs" line exactly as
+    written (e.g. ["ASN2","ASN2"]), "" for groups the line does not have.
     """
 
+    groups = rs_line[4:].split("|")[0:3*dimension:3]
+
+    return groups + [""]*(dimension - len(groups))
+
+class SparkyPeak(object):
+    """
+    A class to hold an individual peak.  The raw lines of the peak are kept and
+    each attribute (height, integral, note, position, labeled, aa, res_num,
+    atoms) is decoded the first time it is accessed.
+    """
+
+    __slots__ = ["dimension","_lines","_fields","_height","_integral","_note",
+                 "_position","_label"]
+
     def __init__(self,peak_lines,dimension):
         """
-        Use dimension to decide which parser to use on the data in peak_lines.
+        Classify the lines in peak_lines in a single pass, recording which line
+        holds each field.
         """
-    
-        # Available parsers
-        self._parse_dict = {2:self.parse2D,
-                            3:self.parse3D}
-        
-        # Parse data using correct parser
+
+        if dimension not in (2,3):
+            err = "Dimension \"%s\" is not valid!" % dimension
+            raise SparkyError(err)
         self.dimension = dimension
+        self._lines = peak_lines
+
+        # Only the first line with each prefix is used
+        fields = {}
+        for i, l in enumerate(peak_lines):
+            key = _PEAK_FIELDS.get(l[0:3])
+            if key is not None and key not in fields:
+                fields[key] = i
+        self._fields = fields
+
+    def _line(self,field,start):
+        """
+        Return the contents of the line holding field (after the first start
+        characters), or None if the peak has no such line.
+        """
+
         try:
-            self.parser = self._parse_dict[self.dimension]
+            return self._lines[self._fields[field]][start:]
         except KeyError:
-            err = "Dimension \"%s\" is not valid!" % dimension
-            raise SparkyError(err)
+            return None
+
+    def _syntaxError(self):
+        """
+        Raise an error describing a peak that could not be decoded.
+        """
+
+        err = "Syntax error!  Peak could not be processed!\n\n %s"
+        err = err % "".join(self._lines)
+        raise SparkyError(err)
+
+    def _getHeight(self):
+        """
+        Peak height.
+        """
 
         try:
-            self.parser(peak_lines)
-        except (ValueError,IndexError):
-            err = "Syntax error!  Peak could not be processed!\n\n %s"
-            err = err % "".join(peak_lines)
-            raise SparkyError(err) 
+            return self._height
+        except AttributeError:
+            try:
+                self._height = float(self._line("height",7).split()[1])
+            except (AttributeError,ValueError,IndexError):
+                self._syntaxError()
+            return self._height
 
+    def _getIntegral(self):
+        """
+        Peak integral (None if the peak was not integrated).
+        """
 
-    def parseCommon(self,peak_lines):
+        try:
+            return self._integral
+        except AttributeError:
+            integral = self._line("integral",9)
+            try:
+                self._integral = float(integral.split()[0])
+            except (AttributeError,ValueError):
+                self._integral = None
+            except IndexError:
+                self._syntaxError()
+            return self._integral
+
+    def _getNote(self):
         """
-        Parse peak data common to experiments of all dimensionality.
+        Peak note, in quotes (None if the peak has no note).
         """
 
-        self.hash = [l[0:3] for l in peak_lines]
-        
-        # Peak height 
-        hei = peak_lines[self.hash.index("hei")][7:].split()
-        self.height = float(hei[1])
+        try:
+            return self._note
+        except AttributeError:
+            note = self._line("note",5)
+            if note is None:
+                self._note = None
+            else:
+                note = note.strip()[1:-1]   # remove trailing quotes
+                self._note = "\"%s\"" % note
+            return self._note
+
+    def _getPosition(self):
+        """
+        Peak position in each dimension.
+        """
 
-        # Peak integral
         try:
-            integral = peak_lines[self.hash.index("int")][9:].split()
-            self.integral = float(integral[0])
-        except ValueError:
-            self.integral = None
-        
-        # Peak note
+            return self._position
+        except AttributeError:
+            try:
+                # Every dimension is read from its own field.  The old
+                # parse3D repeated w2 as w3, so 3D positions (w3) differ
+                # from those written by earlier versions.
+                pos = self._line("position",4).split()
+                self._position = [float(pos[i]) for i in range(self.dimension)]
+            except (AttributeError,ValueError,IndexError):
+                self._syntaxError()
+            return self._position
+
+    def _getLabel(self):
+        """
+        Decode the "rs" line into (aa,res_num,atoms), or None if the peak is
+        unlabeled.
+        """
+
         try:
-            note = peak_lines[self.hash.index("not")][5:].strip()
-            note = note[1:-1]   # remove trailing quotes
-            self.note ="\"%s\"" % note
-        except ValueError:
-            self.note = None
+            return self._label
+        except AttributeError:
+            rs = self._line("rs",4)
+            self._label = None
+            if rs is not None:
+                rs = rs.split("|")
+                try:
+                    groups = [rs[3*i] for i in range(self.dimension)]
+                    self._label = ([g[0:3] for g in groups],
+                                   [int(g[3:]) for g in groups],
+                                   [rs[3*i+1] for i in range(self.dimension)])
+                except ValueError:
+                    pass
+                except IndexError:
+                    self._syntaxError()
+            return self._label
 
+    def _getAa(self):
+        """
+        Amino acid of each dimension (None if unlabeled).
+        """
 
+        label = self._getLabel()
+        if label is not None:
+            return label[0]
 
-    def parse2D(self,peak_lines):
+    def _getResNum(self):
         """
-        Parse a 2-dimensional peak.
+        Residue number of each dimension (None if unlabeled).
         """
 
-        self.parseCommon(peak_lines)
+        label = self._getLabel()
+        if label is not None:
+            return label[1]
 
-        # Peak label
-        try:
-            self.labeled = True
-            rs = peak_lines[self.hash.index("rs ")][4:].split("|")
-            self.aa = [rs[0][0:3],rs[3][0:3]]
-            self.res_num = [int(rs[0][3:]),int(rs[3][3:])]
-            self.atoms = [rs[1],rs[4]]
-        except ValueError:
-            self.labeled = False      
- 
-        # Peak position 
-        pos = peak_lines[self.hash.index("pos")][4:].split()
-        self.position = [float(pos[0]),float(pos[1])]
-       
+    def _getAtoms(self):
+        """
+        Atom name of each dimension (None if unlabeled).
+        """
+
+        label = self._getLabel()
+        if label is not None:
+            return label[2]
 
-    def parse3D(self,peak_lines):
+    def _getLabeled(self):
         """
-        Parse a 3-dimensional peak.
+        Whether the peak has a valid assignment.
         """
-        
-        self.parseCommon(peak_lines)
 
-        # Peak label
-        try:
-            self.labeled = True
-            rs = peak_lines[self.hash.index("rs ")][4:].split("|")
-            self.aa = [rs[0][0:3],rs[3][0:3],rs[6][0:3]]
-            self.res_num = [int(rs[0][3:]),int(rs[3][3:]),int(rs[6][3:])]
-            self.atoms = [rs[1],rs[4],rs[7]]
-        except ValueError:
-            self.labeled = False
- 
-        # Peak position 
-        pos = peak_lines[self.hash.index("pos")][4:].split()
-        self.position = [float(pos[0]),float(pos[1]),float(pos[1])]
+        return self._getLabel() is not None
+
+    height = property(_getHeight)
+    integral = property(_getIntegral)
+    note = property(_getNote)
+    position = property(_getPosition)
+    labeled = property(_getLabeled)
+    aa = property(_getAa)
+    res_num = property(_getResNum)
+    atoms = property(_getAtoms)
        
         
-class SparkyExperiment:
+def iterPeakBlocks(lines):
     """
-    Class to hold a set of sparky peaks extracted from a sparky .save file.
+    Tokenize the lines of a sparky .save file in a single forward pass.  Yields
+    a (dimension,peak_lines) tuple as each peak ornament closes.  Only the lines
+    of the current peak are held in memory.
     """
 
-    def __init__(self,save_file,skip_unlabeled=True):
+    dimension = None
+    peak_lines = None
+    for line in lines:
+
+        # Grab dimensionality of experiment (first instance only)
+        if dimension is None and line[0:9] == "dimension":
+            dimension = int(line[9:])
+
+        # A new peak closes the previous one
+        elif line[0:9] == "type peak":
+            if peak_lines is not None:
+                yield dimension, peak_lines
+            elif dimension is None:
+                err = "Peak found before experiment dimension was specified!"
+                raise SparkyError(err)
+            peak_lines = [line]
+
+        # The end of the ornaments closes the last peak
+        elif line[0:14] == "<end ornament>":
+            if peak_lines is not None:
+                yield dimension, peak_lines
+            return
+
+        elif peak_lines is not None:
+            peak_lines.append(line)
+
+    if peak_lines is not None:
+        err = "File ended before \"<end ornament>\" was found!"
+        raise SparkyError(err)
+
+
+def _countBytes(lines,count):
+    """
+    Yield each of lines, adding its length to count[0].
+    """
+
+    for line in lines:
+        count[0] += len(line)
+        yield line
+
+
+def iterPeaks(save_file,skip_unlabeled=False):
+    """
+    Generator that yields an instance of SparkyPeak for each peak in save_file,
+    reading the file one line at a time.
+    """
+
+    if not os.path.isfile(save_file):
+        err = "File \"%s\" does not exist!" % save_file
+        raise SparkyError(err)
+
+    num_peaks = 0
+    num_unlabeled = 0
+    num_bytes = [0]
+    f = open(save_file,'r')
+    lines = f
+    if STATS.enabled:
+        lines = _countBytes(f,num_bytes)
+    try:
+        for dimension, peak_lines in iterPeakBlocks(lines):
+            peak = SparkyPeak(peak_lines,dimension)
+            num_peaks += 1
+            if skip_unlabeled and not peak.labeled:
+                num_unlabeled += 1
+                continue
+            yield peak
+    finally:
+        f.close()
+        STATS.add("bytes_read",num_bytes[0])
+        STATS.add("peaks_parsed",num_peaks)
+        STATS.add("peaks_skipped_unlabeled",num_unlabeled)
+
+
+class PeakTable(object):
+    """
+    Columnar container for a set of sparky peaks.  Each attribute is a
+    contiguous array with one row per peak:
+
+        index     (N)       ordinal of the peak within its .save file
+        position  (N x dim) peak position (ppm)
+        height    (N)       peak height
+        integral  (N)       peak integral (nan if not integrated)
+        labeled   (N)       whether the peak has an assignment
+        res_num   (N x dim) residue numbers (0 if unlabeled)
+        aa        (N x dim) codes into self.aa_names (-1 if unlabeled)
+        atoms     (N x dim) codes into self.atom_names (-1 if unlabeled)
+        note      (N)       peak note, quoted as in SparkyPeak (None if absent)
+
+    Amino acid and atom names are interned, so each is stored once per table.
+    """
+
+    _columns = ["index","position","height","integral","labeled","res_num",
+                "aa","atoms","note"]
+
+    def __init__(self,dimension,columns,aa_names,atom_names):
+        """
+        Initialize from a dictionary of arrays keyed by column name.
+        """
+
+        self.dimension = dimension
+        self.aa_names = aa_names
+        self.atom_names = atom_names
+        for c in self._columns:
+            setattr(self,c,columns[c])
+
+    def __len__(self):
+        """
+        Number of peaks in the table.
+        """
+
+        return len(self.index)
+
+    def select(self,which):
+        """
+        Return a new PeakTable containing the rows in which (a boolean mask,
+        an array of row indexes, or a slice).
+        """
+
+        columns = dict([(c,getattr(self,c)[which]) for c in self._columns])
+
+        return PeakTable(self.dimension,columns,self.aa_names,self.atom_names)
+
+    def sort(self,column="res_num",dim=0,reverse=False):
+        """
+        Return a new PeakTable sorted by column.  For per-dimension columns
+        (position, res_num) dim selects the dimension to sort on.  The sort is
+        stable, so peaks with identical keys keep their file order.
+        """
+
+        key = getattr(self,column)
+        if key.ndim == 2:
+            key = key[:,dim]
+        if column in ["aa","atoms"]:
+            names = {"aa":self.aa_names,"atoms":self.atom_names}[column]
+            key = numpy.array(names + [""])[key]
+
+        order = numpy.argsort(key,kind="mergesort")
+        if reverse:
+            order = order[::-1]
+
+        return self.select(order)
+
+    def residueMask(self,first,last,dim=0):
+        """
+        Mask of labeled peaks with first <= residue number <= last.
+        """
+
+        res_num = self.res_num[:,dim]
+
+        return self.labeled & (res_num >= first) & (res_num <= last)
+
+    def aaMask(self,aa_list,dim=0):
         """
-        Read in a file, decide on the experiment dimensions, and generate a
-        list of instances of SparkyPeak (self.peak_list).
+        Mask of peaks whose amino acid is in aa_list.
+        """
+
+        return self._nameMask(self.aa[:,dim],self.aa_names,aa_list)
+
+    def atomMask(self,atom_list,dim=0):
+        """
+        Mask of peaks whose atom is in atom_list.
+        """
+
+        return self._nameMask(self.atoms[:,dim],self.atom_names,atom_list)
+
+    def ppmMask(self,low,high,dim=0):
+        """
+        Mask of peaks with low <= position <= high.
+        """
+
+        position = self.position[:,dim]
+
+        return (position >= low) & (position <= high)
+
+    def _nameMask(self,codes,names,wanted):
+        """
+        Convert a list of names to their interned codes and compare against
+        codes in a single vectorized pass.
+        """
+
+        lookup = dict([(n,i) for i, n in enumerate(names)])
+        wanted = [lookup[w] for w in wanted if w in lookup]
+
+        return numpy.in1d(codes,wanted)
+
+    def label(self,row,dim=0):
+        """
+        Return the assignment (e.g. "VAL10", "N") of a row in dimension dim,
+        or None if the peak is unlabeled.
+        """
+
+        if not self.labeled[row]:
+            return None
+
+        group = "%s%i" % (self.aa_names[self.aa[row,dim]],self.res_num[row,dim])
+
+        return group, self.atom_names[self.atoms[row,dim]]
+
+
+def buildPeakTable(peaks,dimension=2):
+    """
+    Build a PeakTable from an iterable of SparkyPeak instances.  peaks may be a
+    generator (e.g. iterPeaks), in which case no SparkyPeak is held in memory
+    after its row has been added.  dimension is only used if peaks is empty.
+    """
+
+    aa_codes = {}
+    atom_codes = {}
+    columns = dict([(c,[]) for c in PeakTable._columns])
+
+    for i, p in enumerate(peaks):
+        dimension = p.dimension
+        columns["index"].append(i)
+        columns["position"].append(p.position)
+        columns["height"].append(p.height)
+        columns["integral"].append(p.integral)
+        columns["labeled"].append(p.labeled)
+        columns["note"].append(p.note)
+        if p.labeled:
+            columns["res_num"].append(p.res_num)
+            columns["aa"].append([aa_codes.setdefault(a,len(aa_codes))
+                                  for a in p.aa])
+            columns["atoms"].append([atom_codes.setdefault(a,len(atom_codes))
+                                     for a in p.atoms])
+        else:
+            columns["res_num"].append([0]*dimension)
+            columns["aa"].append([-1]*dimension)
+            columns["atoms"].append([-1]*dimension)
+
+    # Convert lists to contiguous arrays
+    num_peaks = len(columns["index"])
+    dtypes = {"index":numpy.int32,"position":numpy.float64,
+              "height":numpy.float64,"integral":numpy.float64,
+              "labeled":numpy.bool_,"res_num":numpy.int32,"aa":numpy.int32,
+              "atoms":numpy.int32}
+    for c in dtypes.keys():
+        if c == "integral":
+            columns[c] = [numpy.nan if x is None else x for x in columns[c]]
+        columns[c] = numpy.array(columns[c],dtype=dtypes[c])
+        if c in ["position","res_num","aa","atoms"]:
+            columns[c] = columns[c].reshape((num_peaks,dimension))
+    note = numpy.empty(num_peaks,dtype=object)
+    note[:] = columns["note"]
+    columns["note"] = note
+
+    aa_names = sorted(aa_codes.keys(),key=aa_codes.get)
+    atom_names = sorted(atom_codes.keys(),key=atom_codes.get)
+
+    return PeakTable(dimension,columns,aa_names,atom_names)
+
+
+def parsePeakTable(lines,skip_unlabeled=True):
+    """
+    Parse the lines of a sparky .save file (e.g. one held in memory) into a
+    PeakTable.
+    """
+
+    peaks = (SparkyPeak(peak_lines,dimension)
+             for dimension, peak_lines in iterPeakBlocks(lines))
+    table = buildPeakTable(peaks)
+    if skip_unlabeled:
+        table = table.select(table.labeled)
+
+    return table
+
+
+def readPeakTable(save_file,skip_unlabeled=True):
+    """
+    Stream the peaks in save_file straight into a PeakTable.  Reading,
+    segmenting, and parsing happen in one pass, timed as the "parse" stage.
+    """
+
+    with STATS.stage("parse"):
+        return buildPeakTable(iterPeaks(save_file,skip_unlabeled))
+
+
+class SparkySaveIndex:
+    """
+    Byte-offset index of the peak ornaments in a memory-mapped sparky .save
+    file.  Building the index only searches the mapped buffer for block
+    boundaries; peaks are decoded on request, touching only their own bytes.
+    """
+
+    def __init__(self,save_file):
+        """
+        Map save_file into memory and record the byte offset of each peak.
         """
 
-        # Load file
         if not os.path.isfile(save_file):
             err = "File \"%s\" does not exist!" % save_file
             raise SparkyError(err)
-        self.save_file = save_file 
-        f = open(self.save_file,'r')
-        lines = f.readlines()
-        f.close() 
+        self.save_file = save_file
+
+        with STATS.stage("index"):
+            self._buildIndex()
+        STATS.add("bytes_mapped",len(self._map))
+
+    def _buildIndex(self):
+        """
+        Map the file and find the offsets of the peaks.
+        """
+
+        save_file = self.save_file
+        f = open(save_file,'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        except (ValueError,EnvironmentError):
+            err = "File \"%s\" could not be memory-mapped!" % save_file
+            raise SparkyError(err)
+        finally:
+            f.close()
 
         # Grab dimensionality of experiment
-        dim_line = [i for i, l in enumerate(lines) if l[0:9] == "dimension"][0]
-        dimension = int(lines[dim_line][9:])
-       
-        # Make a list of the starting and ending line of each peak
-        peak_lines = [i for i, l in enumerate(lines) if l[0:9] == "type peak"]
-        end_ornament = [i for i, l in enumerate(lines)
-                        if l[0:14] == "<end ornament>"]
-        peak_lines.append(end_ornament[0])
-        peak_lines = [(peak_lines[i-1],peak_lines[i])
-                      for i in range(1,len(peak_lines))]
+        dim_start = self._findLine("dimension",0,len(self._map))
+        if dim_start < 0:
+            err = "Experiment dimension not found in \"%s\"!" % save_file
+            raise SparkyError(err)
+        dim_end = self._map.find("\n",dim_start)
+        if dim_end < 0:
+            err = "Experiment dimension line of \"%s\" is truncated!" % \
+                  save_file
+            raise SparkyError(err)
+        self.dimension = int(self._map[dim_start+9:dim_end])
+
+        # Offsets of each "type peak" line, up to the first "<end ornament>"
+        end = self._findLine("<end ornament>",0,len(self._map))
+        if end < 0:
+            end = len(self._map)
+        offsets = []
+        start = self._findLine("type peak",0,end)
+        while start >= 0:
+            offsets.append(start)
+            start = self._findLine("type peak",start + 1,end)
+        offsets.append(end)
+
+        self.offsets = numpy.array(offsets,dtype=numpy.int64)
+        self._res_num = None
+
+    def _findLine(self,prefix,start,end):
+        """
+        Return the offset of the first line in [start,end) that begins with
+        prefix, or -1.
+        """
+
+        if start == 0 and self._map[0:len(prefix)] == prefix:
+            return 0
+        i = self._map.find("\n%s" % prefix,max(start - 1,0),end)
+        if i < 0:
+            return -1
+
+        return i + 1
+
+    def __len__(self):
+        """
+        Number of peaks in the file.
+        """
+
+        return len(self.offsets) - 1
+
+    def blockRange(self,i):
+        """
+        Return the (start,end) byte offsets of peak i.
+        """
+
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("peak index out of range")
+
+        return int(self.offsets[i]), int(self.offsets[i+1])
+
+    def __getitem__(self,i):
+        """
+        Decode peak i into an instance of SparkyPeak.
+        """
+
+        start, end = self.blockRange(i)
+
+        return SparkyPeak(self._map[start:end].splitlines(True),self.dimension)
+
+    def residueNumbers(self,dim=0):
+        """
+        Return an array of the residue number of every peak in dimension dim
+        (-1 for unlabeled peaks).  Only the "rs" line of each peak is decoded;
+        the result is cached.
+        """
+
+        if self._res_num is None:
+            res_num = numpy.zeros((len(self),self.dimension),dtype=numpy.int32)
+            res_num[:] = -1
+            for i in range(len(self)):
+                start = self._findLine("rs ",int(self.offsets[i]) + 1,
+                                       int(self.offsets[i+1]))
+                if start < 0:
+                    continue
+                rs = self._map[start+4:self._map.find("\n",start)].split("|")
+                try:
+                    res_num[i] = [int(rs[3*j][3:])
+                                  for j in range(self.dimension)]
+                except (ValueError,IndexError):
+                    pass
+            self._res_num = res_num
+
+        return self._res_num[:,dim]
+
+    def residueGroups(self):
+        """
+        Return an (N x dimension) array of the residue groups of every peak
+        exactly as written on its "rs" line (see rsGroups), "" for peaks
+        without one.  Only the "rs" line of each peak is decoded.
+        """
+
+        groups = []
+        for i in range(len(self)):
+            start, end = int(self.offsets[i]), int(self.offsets[i+1])
+            rs_start = self._findLine("rs ",start + 1,end)
+            if rs_start < 0:
+                groups.append([""]*self.dimension)
+                continue
+            rs_end = self._map.find("\n",rs_start,end)
+            if rs_end < 0:
+                rs_end = end
+            groups.append(rsGroups(self._map[rs_start:rs_end],self.dimension))
+
+        groups = numpy.array(groups,dtype=str)
 
-        # Create list of instances of SparkyPeak for each peak in file.
-        self.peak_list = []             
-        for peak in peak_lines:
-            indiv_peak = lines[peak[0]:peak[1]]
-            self.peak_list.append(SparkyPeak(indiv_peak,dimension))
+        return groups.reshape((len(self),self.dimension))
 
-        # Remove unlabeled peaks if requested
-        if skip_unlabeled:
-            self.peak_list = [p for p in self.peak_list if p.labeled]
+    def peaksForResidues(self,first,last,dim=0):
+        """
+        Return a list of SparkyPeak instances for all peaks with first <=
+        residue number <= last in dimension dim.
+        """
 
-                
+        res_num = self.residueNumbers(dim)
+        rows = numpy.flatnonzero((res_num >= first) & (res_num <= last))
+
+        return [self[i] for i in rows]
+
+    def close(self):
+        """
+        Release the memory map.
+        """
+
+        self._map.close()
+
+
+class SparkyExperiment:
+    """
+    Class to hold a set of sparky peaks extracted from a sparky .save file.
+    """
+
+    iterPeaks = staticmethod(iterPeaks)
+
+    def __init__(self,save_file,skip_unlabeled=True):
+        """
+        Read in a file and generate a list of instances of SparkyPeak
+        (self.peak_list).
+        """
+
+        self.save_file = save_file 
+        self.peak_list = list(iterPeaks(self.save_file,skip_unlabeled))
+
+    def peakTable(self):
+        """
+        Return the peaks in self.peak_list as a PeakTable.
+        """
+
+        return buildPeakTable(self.peak_list)
 
 
 def main():
@@ -172,11 +742,9 @@ def main():
         print "specify sparky .save file"
         sys.exit()
 
-    experiment = SparkyExperiment(input_file)
-    for p in experiment.peak_list:
-        if p.labeled:
-            print p.position, p.atoms, p.aa
+    for p in iterPeaks(input_file,skip_unlabeled=True):
+        print p.position, p.atoms, p.aa
 
 
 if __name__ == "__main__":
-    main()
+    sparky_stats.run(main)
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+__description__ = \
+"""
+sparky_db.py
+
+A local SQLite store of parsed sparky peaks, so that questions spanning many
+experiments ("how does residue 42 N-HN move across every titration?") can be
+answered without touching the original .save files.
+
+    sparky_db.py ingest peaks.db save_dir1 save_dir2 pH_7p01_x.save ...
+    sparky_db.py query peaks.db -r 42 -a N-HN
+
+Ingestion records the path, pH (parsed from names like pH_7p01_*.save),
+modification time and size of each file; files that have not changed since
+they were last ingested are skipped, and changed files are replaced.  Peaks
+are indexed by residue, atoms, experiment and pH.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080512"
+__usage__ = "sparky_db.py ingest|query DB_FILE [options] [FILES_OR_DIRS]"
+
+import os, re, sys, time, optparse
+import sparky_cache, sparky_stats
+from sparky_stats import STATS
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+# Bump whenever the schema changes
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiments (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    pH REAL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    dimension INTEGER NOT NULL,
+    ingested REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS peaks (
+    experiment INTEGER NOT NULL REFERENCES experiments(id),
+    idx INTEGER NOT NULL,
+    labeled INTEGER NOT NULL,
+    residue INTEGER,
+    aa TEXT,
+    atoms TEXT,
+    w1 REAL,
+    w2 REAL,
+    w3 REAL,
+    height REAL,
+    volume REAL,
+    note TEXT
+);
+CREATE INDEX IF NOT EXISTS experiments_pH ON experiments (pH);
+CREATE INDEX IF NOT EXISTS peaks_experiment ON peaks (experiment);
+CREATE INDEX IF NOT EXISTS peaks_residue ON peaks (residue,atoms);
+CREATE INDEX IF NOT EXISTS peaks_atoms ON peaks (atoms);
+"""
+
+# Dimension whose residue labels a peak, by experiment dimension.  3D peaks
+# are stored under their w2 residue, as sparky_extract-peaks_3d-assgn.py
+# reports them.
+RESIDUE_DIM = {2:0,3:1}
+
+# Columns returned by SparkyPeakDB.query
+QUERY_COLUMNS = ["name","pH","residue","aa","atoms","w1","w2","w3","height",
+                 "volume","note"]
+
+class SparkyDBError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+# A single value or a low-high range; either value may be negative
+_range_pattern = re.compile(r"^(-?[^-]+)(?:-(-?[^-]+))?$")
+
+def parseRange(value,convert=int):
+    """
+    Parse a value (e.g. 42) or range (e.g. 40-50) into a (low,high) tuple of
+    convert(value).  Raises ValueError if value is not a value or range.
+    """
+
+    m = _range_pattern.match(value.strip())
+    if m is None:
+        raise ValueError(value)
+
+    low = convert(m.group(1))
+    high = low
+    if m.group(2) is not None:
+        high = convert(m.group(2))
+
+    return min(low,high), max(low,high)
+
+def readPH(save_file):
+    """
+    Parse the pH from a file name of style pH_7p01_*.save, or return None if
+    the name does not hold a pH.
+    """
+
+    try:
+        pH = os.path.basename(save_file).split("_")[1]
+        return float("%s.%s" % tuple(pH.split("p")))
+    except (IndexError,TypeError,ValueError):
+        return None
+
+
+class SparkyPeakDB:
+    """
+    SQLite database of peaks from many sparky experiments.
+    """
+
+    def __init__(self,db_file):
+        """
+        Open (creating if necessary) the database in db_file.
+        """
+
+        self.db_file = db_file
+        self.connection = sqlite3.connect(db_file)
+        self.connection.executescript(_SCHEMA)
+
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            self.connection.execute("PRAGMA user_version = %i" % \
+                                    SCHEMA_VERSION)
+        elif version != SCHEMA_VERSION:
+            err = "%s has schema version %i (expected %i)!" % \
+                  (db_file,version,SCHEMA_VERSION)
+            raise SparkyDBError(err)
+        self.connection.commit()
+
+    def close(self):
+        """
+        Close the database.
+        """
+
+        self.connection.close()
+
+    def ingest(self,save_file,force=False):
+        """
+        Load the peaks in save_file, replacing any peaks previously loaded from
+        it.  Unless force is True, a file whose modification time and size are
+        unchanged is skipped.  Returns the number of peaks loaded (0 if
+        skipped).
+        """
+
+        path = os.path.abspath(save_file)
+        st = os.stat(path)
+        row = self.connection.execute("SELECT id, mtime, size FROM "
+                                      "experiments WHERE path = ?",
+                                      (path,)).fetchone()
+        if row is not None and not force and \
+           (row[1],row[2]) == (float(st.st_mtime),int(st.st_size)):
+            STATS.add("files_unchanged")
+            return 0
+
+        table = sparky_cache.loadPeakTable(path,skip_unlabeled=False)
+
+        with STATS.stage("db write"):
+            cursor = self.connection.cursor()
+            try:
+                if row is not None:
+                    cursor.execute("DELETE FROM peaks WHERE experiment = ?",
+                                   (row[0],))
+                    cursor.execute("DELETE FROM experiments WHERE id = ?",
+                                   (row[0],))
+                cursor.execute("INSERT INTO experiments (path,name,pH,mtime,"
+                               "size,dimension,ingested) VALUES "
+                               "(?,?,?,?,?,?,?)",
+                               (path,os.path.basename(path),readPH(path),
+                                float(st.st_mtime),int(st.st_size),
+                                table.dimension,time.time()))
+                cursor.executemany("INSERT INTO peaks VALUES "
+                                   "(?,?,?,?,?,?,?,?,?,?,?,?)",
+                                   _peakRows(cursor.lastrowid,table))
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                raise
+        STATS.add("peaks_ingested",len(table))
+
+        return len(table)
+
+    def remove(self,save_file):
+        """
+        Remove save_file and its peaks from the database.
+        """
+
+        path = os.path.abspath(save_file)
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM peaks WHERE experiment IN (SELECT id FROM "
+                       "experiments WHERE path = ?)",(path,))
+        cursor.execute("DELETE FROM experiments WHERE path = ?",(path,))
+        self.connection.commit()
+
+    def experiments(self):
+        """
+        Return a list of (path,pH,number of peaks) for every experiment.
+        """
+
+        return self.connection.execute("SELECT e.path, e.pH, COUNT(p.idx) "
+                                       "FROM experiments e LEFT JOIN peaks p "
+                                       "ON p.experiment = e.id GROUP BY e.id "
+                                       "ORDER BY e.pH, e.path").fetchall()
+
+    def query(self,residue=None,atoms=None,aa=None,pH_range=None,
+              experiment=None,labeled=True):
+        """
+        Return peaks as a list of tuples (see QUERY_COLUMNS), sorted by
+        residue, atoms, and pH.
+
+            residue     residue number, or (first,last) range
+            atoms       atoms, e.g. "N-HN"
+            aa          amino acid, e.g. "HIS"
+            pH_range    (low,high)
+            experiment  SQL LIKE pattern matched against experiment paths
+            labeled     only labeled peaks (False returns every peak)
+        """
+
+        where = []
+        args = []
+        if labeled:
+            where.append("p.labeled = 1")
+        if residue is not None:
+            if isinstance(residue,(tuple,list)):
+                if len(residue) != 2:
+                    err = "Residue range must be (first,last)!"
+                    raise SparkyDBError(err)
+                where.append("p.residue BETWEEN ? AND ?")
+                args.extend([int(r) for r in residue])
+            else:
+                where.append("p.residue = ?")
+                args.append(int(residue))
+        if atoms is not None:
+            where.append("p.atoms = ?")
+            args.append(atoms)
+        if aa is not None:
+            where.append("p.aa = ?")
+            args.append(aa)
+        if pH_range is not None:
+            if len(pH_range) != 2:
+                err = "pH range must be (low,high)!"
+                raise SparkyDBError(err)
+            where.append("e.pH BETWEEN ? AND ?")
+            args.extend([float(p) for p in pH_range])
+        if experiment is not None:
+            where.append("e.path LIKE ?")
+            args.append(experiment)
+
+        sql = ["SELECT e.name, e.pH, p.residue, p.aa, p.atoms, p.w1, p.w2, "
+               "p.w3, p.height, p.volume, p.note FROM peaks p JOIN "
+               "experiments e ON p.experiment = e.id"]
+        if where:
+            sql.append("WHERE %s" % " AND ".join(where))
+        sql.append("ORDER BY p.residue, p.atoms, e.pH, e.path, p.idx")
+
+        with STATS.stage("db query"):
+            rows = self.connection.execute(" ".join(sql),args).fetchall()
+
+        return rows
+
+
+def _peakRows(experiment,table):
+    """
+    Generate one database row per peak in a PeakTable.
+    """
+
+    aa_names = table.aa_names
+    atom_names = table.atom_names
+    dims = range(table.dimension)
+    res_dim = RESIDUE_DIM.get(table.dimension,0)
+
+    position = table.position.tolist()
+    position = [p + [None]*(3 - len(p)) for p in position]
+    height = table.height.tolist()
+    volume = table.integral.tolist()
+    volume = [(v, None)[v != v] for v in volume]
+
+    for i in range(len(table)):
+        if table.labeled[i]:
+            residue = int(table.res_num[i,res_dim])
+            aa = aa_names[table.aa[i,res_dim]]
+            atoms = "-".join([atom_names[table.atoms[i,d]] for d in dims])
+        else:
+            residue = aa = atoms = None
+
+        note = table.note[i]
+        if note is not None:
+            note = note[1:-1]
+
+        yield (experiment,int(table.index[i]),int(table.labeled[i]),residue,aa,
+               atoms,position[i][0],position[i][1],position[i][2],height[i],
+               volume[i],note)
+
+
+def formatRows(rows):
+    """
+    Format query results as an R-readable table.
+    """
+
+    out = ["%10s%30s%10s%10s%10s%10s%10s%10s%10s%10s%10s%30s\n" % \
+           (" ","experiment","pH","residue","aa","atoms","w1","w2","w3",
+            "height","volume","note")]
+    for i, r in enumerate(rows):
+        name, pH, residue, aa, atoms, w1, w2, w3, height, volume, note = r
+        values = [_na("%10.3F",pH),_na("%10i",residue),_na("%10s",aa),
+                  _na("%10s",atoms),_na("%10.3F",w1),_na("%10.3F",w2),
+                  _na("%10.3F",w3),_na("%10.2E",height),_na("%10.2E",volume)]
+        if note is not None:
+            note = "%30s" % ("\"%s\"" % note[:26])
+        else:
+            note = "%30s" % "NA"
+        out.append("%10i%30s%s%s\n" % (i,name,"".join(values),note))
+
+    return "".join(out)
+
+def _na(format,value):
+    """
+    Format value, or NA if it is missing.
+    """
+
+    if value is None:
+        return "%10s" % "NA"
+
+    return format % value
+
+
+def _saveFiles(args):
+    """
+    Expand a list of .save files and directories into a sorted list of .save
+    files.
+    """
+
+    save_files = []
+    for a in args:
+        if os.path.isdir(a):
+            save_files.extend([os.path.join(a,f) for f in os.listdir(a)
+                               if f[-5:] == ".save"])
+        elif os.path.isfile(a):
+            save_files.append(a)
+        else:
+            err = "\"%s\" does not exist!" % a
+            raise SparkyDBError(err)
+    save_files.sort()
+
+    return save_files
+
+
+def main():
+    """
+    Function called if run from command line.
+    """
+
+    if len(sys.argv) < 3 or sys.argv[1] not in ["ingest","query"]:
+        print __usage__
+        sys.exit()
+    command = sys.argv[1]
+    db_file = sys.argv[2]
+
+    parser = optparse.OptionParser(usage=__usage__)
+    if command == "ingest":
+        parser.add_option("-f","--force",action="store_true",default=False,
+                          help="reload files even if they have not changed")
+    else:
+        parser.add_option("-r","--residue",default=None,
+                          help="residue number or range (e.g. 42 or 40-50)")
+        parser.add_option("-a","--atoms",default=None,
+                          help="atoms (e.g. N-HN)")
+        parser.add_option("--aa",default=None,
+                          help="amino acid (e.g. HIS)")
+        parser.add_option("-p","--pH",default=None,
+                          help="pH range (e.g. 5-8)")
+        parser.add_option("-e","--experiment",default=None,
+                          help="SQL LIKE pattern for experiment paths")
+        parser.add_option("-u","--unlabeled",action="store_true",
+                          default=False,help="include unlabeled peaks")
+        parser.add_option("-l","--list",action="store_true",default=False,
+                          help="list the experiments in the database")
+    options, args = parser.parse_args(sys.argv[3:])
+
+    db = SparkyPeakDB(db_file)
+    try:
+        if command == "ingest":
+            try:
+                save_files = _saveFiles(args)
+            except SparkyDBError, e:
+                print e
+                sys.exit(1)
+            for f in save_files:
+                num_peaks = db.ingest(f,options.force)
+                if num_peaks > 0:
+                    print >> sys.stderr, "%s: %i peaks" % (f,num_peaks)
+            return
+
+        if options.list:
+            for path, pH, num_peaks in db.experiments():
+                print "%10s%10i  %s" % (pH is None and "NA" or "%.3F" % pH,
+                                        num_peaks,path)
+            return
+
+        residue = pH_range = None
+        try:
+            if options.residue is not None:
+                residue = parseRange(options.residue,int)
+        except ValueError:
+            print "-r must be a residue number or range (e.g. 42 or 40-50)"
+            print __usage__
+            sys.exit(1)
+        try:
+            if options.pH is not None:
+                pH_range = parseRange(options.pH,float)
+        except ValueError:
+            print "-p must be a pH or pH range (e.g. 7 or 5-8)"
+            print __usage__
+            sys.exit(1)
+
+        rows = db.query(residue,options.atoms,options.aa,pH_range,
+                        options.experiment,not options.unlabeled)
+        with STATS.stage("output"):
+            sys.stdout.write(formatRows(rows))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sparky_stats.run(main)
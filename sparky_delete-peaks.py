@@ -4,13 +4,21 @@ __description__ = \
 sparky_delete-peaks.py 
 
 Delete peaks in Sparky .save files using peaks in input file input file.  
+Alternatively, peaks can be chosen with a selector expression (-s), e.g.
+
+    sparky_delete-peaks.py -s "unlabeled and height < 5e4" *.save
+
+See sparky_select.py for the selector language.
 """
 
 __author__ = "Michael J. Harms"
 __date__ = "080409"
-__usage__ = "sparky_delete-peaks.py input-file $1.save $2.save ... $n.save"
+__usage__ = "sparky_delete-peaks.py [-s SELECTOR] [input-file] *.save"
 
-import os, sys
+import os, sys, optparse
+import numpy
+import sparky_classes, sparky_edit, sparky_select, sparky_stats
+from sparky_stats import STATS
 
 class SparkyDeletePeaksError(Exception):
     """
@@ -34,43 +42,100 @@ def readPeakList(peak_file):
  
     return peak_list
 
-def convertSparkyFile(sparky_file,peak_list):
+def deleteLines(sparky,selector):
     """
-    Delete peaks in sparky_file using peak_list. 
+    Delete peaks matched by selector (a sparky_select.Selector) from sparky
+    (the lines of a sparky .save file), returning the lines that are kept.
+    A NameSelector only needs the "rs" line of each peak, so no other peak
+    data is decoded.
     """
 
-    f = open(sparky_file,'r')
-    sparky = f.readlines()
-    f.close()
+    by_name = isinstance(selector,sparky_select.NameSelector)
+
+    # iterPeakBlocks yields each peak as the line after it is read, so the
+    # number of lines read so far gives the end of the peak
+    line_number = [0]
+    def countLines():
+        for i, l in enumerate(sparky):
+            line_number[0] = i
+            yield l
+
+    with STATS.stage("parse"):
+        peaks = []
+        peak_lines = []
+        for dimension, lines in sparky_classes.iterPeakBlocks(countLines()):
+            if by_name:
+                rs = [l for l in lines if l[0:3] == "rs "]
+                if len(rs) == 0:
+                    rs = [""]
+                peaks.append(sparky_classes.rsGroups(rs[0],dimension))
+            else:
+                peaks.append(sparky_classes.SparkyPeak(lines,dimension))
+            peak_lines.append((line_number[0] - len(lines),line_number[0]))
+
+    with STATS.stage("select"):
+        if by_name:
+            mask = selector.groupMask(peaks)
+        else:
+            mask = selector.mask(sparky_classes.buildPeakTable(peaks))
+
+    with STATS.stage("edit"):
+        delete = numpy.flatnonzero(mask)
+        STATS.add("peaks_deleted",len(delete))
+        keep_lines = numpy.ones(len(sparky),dtype=numpy.bool_)
+        for d in delete:
+            keep_lines[peak_lines[d][0]:peak_lines[d][1]] = False
+ 
+        # Create output file, taking only lines with keep_lines == True
+        out = [l for i, l in enumerate(sparky) if keep_lines[i]]
 
-    keep_lines = [True for l in sparky]
-    peak_lines = [i for i, l in enumerate(sparky) if l[0:9] == "type peak"]
-    end_ornament = [i for i, l in enumerate(sparky)
-                    if l[0:14] == "<end ornament>"]
-    peak_lines.append(end_ornament[0])
+    return out
 
-    peak_lines = [(peak_lines[i-1],peak_lines[i])
-                  for i in range(1,len(peak_lines))]
 
-    # Use rs lines to find peaks to delete
-    for p in peak_lines:
+def convertSparkyFile(sparky_file,selector,keep=False):
+    """
+    Delete peaks matched by selector (a sparky_select.Selector) from
+    sparky_file, or, if keep is True, delete every peak it does not match.
+    The selector is evaluated over all peaks at once (a NameSelector only
+    decodes the "rs" lines); the changes are written with an atomic, locked
+    edit (see sparky_edit).  Returns the number of peaks deleted.
+    """
 
-        peak = sparky[p[0]:p[1]]        
-        
-        hash = [l[0:3] for l in peak]
-        rs = peak[hash.index("rs ")]
-        column = rs[4:].split("|")
-        if column[0] in peak_list or column[3] in peak_list:
-            for i in range(p[0],p[1]):
-                keep_lines[i] = False    
- 
-    # Create output file, taking only lines with keep_lines == True
-    out = [l for i, l in enumerate(sparky) if keep_lines[i]]
+    editor = sparky_edit.SparkyEditor(sparky_file)
+    try:
+        if isinstance(selector,sparky_select.NameSelector):
+            with STATS.stage("parse"):
+                groups = editor.index.residueGroups()
+            with STATS.stage("select"):
+                mask = selector.groupMask(groups)
+        else:
+            table = editor.peakTable()
+            with STATS.stage("select"):
+                mask = selector.mask(table)
+        if keep:
+            mask = numpy.logical_not(mask)
+        delete = numpy.flatnonzero(mask)
+
+        with STATS.stage("edit"):
+            for i in delete:
+                editor.deletePeak(int(i))
+        STATS.add("peaks_deleted",len(delete))
+
+        editor.commit()
+    finally:
+        editor.close()
+
+    return len(delete)
+
+
+def warnUnmatched(selector):
+    """
+    Warn about each name in a sparky_select.NameSelector that did not match a
+    peak in any file.
+    """
 
-    # Write output
-    g = open(sparky_file,'w')
-    g.writelines(out)
-    g.close()
+    for name in selector.unmatched():
+        print >> sys.stderr, "Warning: no peaks matched \"%s\"" % name
 
 
 def main():
@@ -78,16 +143,36 @@ def main():
     If called from command line...
     """
 
+    parser = optparse.OptionParser(usage=__usage__)
+    parser.add_option("-s","--select",default=None,
+                      help="delete peaks matching this selector (see "
+                           "sparky_select.py) instead of using a peak file")
+    parser.add_option("-k","--keep",action="store_true",default=False,
+                      help="delete every peak that is NOT selected")
+    options, args = parser.parse_args()
+
     # Parse command line
+    if options.select is None:
+        if len(args) < 2:
+            print __usage__
+            sys.exit()
+        peak_list = readPeakList(args[0])
+        sparky_files = args[1:]
+    else:
+        if len(args) < 1:
+            print __usage__
+            sys.exit()
+        sparky_files = args
+
+    # Compile the selector
     try:
-        peak_file = sys.argv[1]
-        sparky_files = sys.argv[2:]
-    except IndexError:
-        print __usage__
-        sys.exit()
-
-    # Read in peak conversion rules
-    peak_list = readPeakList(peak_file)
+        if options.select is None:
+            selector = sparky_select.nameSelector(peak_list)
+        else:
+            selector = sparky_select.compileSelector(options.select)
+    except sparky_select.SparkySelectError, e:
+        print e
+        sys.exit(1)
    
     # Make sure that sparky files exist 
     file_check = [os.path.isfile(f) for f in sparky_files]
@@ -98,9 +183,12 @@ def main():
     sparky_files.sort() 
     for sparky_file in sparky_files:
         print sparky_file
-        convertSparkyFile(sparky_file,peak_list)    
+        convertSparkyFile(sparky_file,selector,options.keep)    
+
+    if options.select is None:
+        warnUnmatched(selector)
         
 
 
 if __name__ == "__main__":
-    main()
+    sparky_stats.run(main)
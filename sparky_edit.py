@@ -0,0 +1,306 @@
+__description__ = \
+"""
+Transactional editing of sparky .save files.  Edits are recorded as byte-range
+patches against a SparkySaveIndex of the file and applied in one streamed copy
+to a temporary file, which then atomically replaces the original.  An advisory
+lock on the file is held from the time it is indexed until the edit is
+committed or abandoned, so many batch editors can safely work on the same
+set of files in parallel.  A crash part way through leaves the original file
+untouched.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080507"
+
+import os, sys, bisect, shutil, tempfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import sparky_classes
+from sparky_stats import STATS
+
+# Size of the chunks copied from the original file when committing
+COPY_CHUNK = 1024*1024
+
+class SparkyEditError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+class SparkyLock:
+    """
+    Advisory lock on a sparky file, held on the file itself.  A committed edit
+    replaces the file, so after waiting for the lock we check that the name
+    still refers to the file we locked and, if not, lock the new file instead.
+    Locking is skipped on platforms without fcntl.
+    """
+
+    def __init__(self,save_file):
+        """
+        Block until the lock on save_file is acquired.
+        """
+
+        self.save_file = save_file
+        self._f = None
+        while True:
+            f = open(save_file,'rb')
+            if fcntl is None:
+                break
+            fcntl.flock(f.fileno(),fcntl.LOCK_EX)
+            locked = os.fstat(f.fileno())
+            try:
+                current = os.stat(save_file)
+            except OSError:
+                current = None
+            if current is not None and \
+               (current.st_dev,current.st_ino) == \
+               (locked.st_dev,locked.st_ino):
+                break
+            f.close()
+        self._f = f
+
+    def release(self):
+        """
+        Release the lock.
+        """
+
+        if self._f is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._f.fileno(),fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
+
+
+class SparkyEditor:
+    """
+    Record byte-range patches against a sparky .save file and commit them
+    atomically.
+    """
+
+    def __init__(self,save_file,lock=True):
+        """
+        Lock (if requested) and index save_file.
+        """
+
+        self.save_file = save_file
+        self._lock = None
+        if lock:
+            self._lock = SparkyLock(save_file)
+
+        try:
+            self.index = sparky_classes.SparkySaveIndex(save_file)
+        except:
+            self.close()
+            raise
+        self._map = self.index._map
+        self._patches = {}
+        self._starts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+        return False
+
+    def __len__(self):
+        """
+        Number of peaks in the original file.
+        """
+
+        return len(self.index)
+
+    def peakTable(self):
+        """
+        Return a PeakTable of every peak in the original file; row i is peak
+        i of the index.  Each peak is decoded from its own bytes of the map.
+        """
+
+        with STATS.stage("parse"):
+            peaks = (self.index[i] for i in range(len(self)))
+            table = sparky_classes.buildPeakTable(peaks,self.index.dimension)
+
+        return table
+
+    def findLines(self,prefix,start=0,end=None):
+        """
+        Yield (start,end,line) for each line in the original file between
+        start and end that begins with prefix (a string or a tuple of strings),
+        in file order.  Only matching lines are decoded.
+        """
+
+        if end is None:
+            end = len(self._map)
+        if isinstance(prefix,str):
+            prefix = (prefix,)
+
+        found = dict([(p,self.index._findLine(p,start,end)) for p in prefix])
+        while True:
+            hits = [(i,p) for p, i in found.items() if i >= 0]
+            if len(hits) == 0:
+                break
+            i, p = min(hits)
+            line_end = self._map.find("\n",i,end)
+            if line_end < 0:
+                line_end = end
+            else:
+                line_end += 1
+            yield i, line_end, self._map[i:line_end]
+            found[p] = self.index._findLine(p,line_end,end)
+
+    def replace(self,start,end,text):
+        """
+        Record a patch replacing bytes start to end of the original file with
+        text.  A deletion ("" text) supersedes any patches inside it, and
+        patches inside an existing deletion are dropped.  Other overlaps are
+        an error.
+        """
+
+        # Patches never overlap, so those overlapping this one are a run just
+        # before the first patch starting at or after end
+        i = bisect.bisect_left(self._starts,end)
+        overlaps = []
+        while i > 0 and self._patches[self._starts[i-1]][0] > start:
+            overlaps.append(self._starts[i-1])
+            i -= 1
+
+        for s in overlaps:
+            e, t = self._patches[s]
+            if t == "" and s <= start and end <= e:
+                return
+            if text == "" and start <= s and e <= end:
+                del self._patches[s]
+                self._starts.remove(s)
+                continue
+            err = "Edit of bytes %i-%i overlaps edit of bytes %i-%i!" % \
+                  (start,end,s,e)
+            raise SparkyEditError(err)
+
+        self._patches[start] = (end,text)
+        bisect.insort(self._starts,start)
+
+    def deletePeak(self,i):
+        """
+        Record deletion of peak i.
+        """
+
+        start, end = self.index.blockRange(i)
+        self.replace(start,end,"")
+
+    def text(self,start,end):
+        """
+        Return bytes start to end of the file with pending patches applied.
+        """
+
+        out = []
+        pos = start
+        for s in sorted([s for s in self._patches.keys()
+                         if start <= s < end]):
+            e, t = self._patches[s]
+            out.append(self._map[pos:s])
+            out.append(t)
+            pos = e
+        if pos < end:
+            out.append(self._map[pos:end])
+
+        return "".join(out)
+
+    def commit(self):
+        """
+        Apply all patches in one streamed copy to a temporary file in the same
+        directory, then atomically rename it over the original.  Returns True
+        if the file was changed.
+        """
+
+        if not self._patches:
+            self.close()
+            return False
+
+        out_dir = os.path.dirname(os.path.abspath(self.save_file))
+        fd, tmp_file = tempfile.mkstemp(prefix=".sparky_edit",dir=out_dir)
+        g = os.fdopen(fd,'wb')
+        try:
+            with STATS.stage("output"):
+                pos = 0
+                for s in sorted(self._patches.keys()):
+                    e, t = self._patches[s]
+                    self._copy(g,pos,s)
+                    g.write(t)
+                    pos = e
+                self._copy(g,pos,len(self._map))
+                g.flush()
+                os.fsync(g.fileno())
+                g.close()
+                shutil.copymode(self.save_file,tmp_file)
+                os.rename(tmp_file,self.save_file)
+        except:
+            g.close()
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            self.close()
+            raise
+
+        STATS.add("patches_applied",len(self._patches))
+        self.close()
+
+        return True
+
+    def _copy(self,g,start,end):
+        """
+        Copy bytes start to end of the original file to g in chunks.
+        """
+
+        while start < end:
+            stop = min(start + COPY_CHUNK,end)
+            g.write(self._map[start:stop])
+            start = stop
+
+    def close(self):
+        """
+        Abandon any uncommitted patches and release the file and lock.
+        """
+
+        self._patches = {}
+        self._starts = []
+        if getattr(self,"index",None) is not None:
+            self.index.close()
+            self.index = None
+        if self._lock is not None:
+            self._lock.release()
+            self._lock = None
+
+
+def writeLines(save_file,lines,lock=None):
+    """
+    Atomically replace save_file with lines under the advisory lock.  If lock
+    (a SparkyLock already held on save_file) is given it is used and left
+    held; otherwise the lock is taken here, if the file already exists.
+    """
+
+    held = lock
+    if held is None and os.path.exists(save_file):
+        lock = SparkyLock(save_file)
+    try:
+        out_dir = os.path.dirname(os.path.abspath(save_file))
+        fd, tmp_file = tempfile.mkstemp(prefix=".sparky_edit",dir=out_dir)
+        g = os.fdopen(fd,'wb')
+        try:
+            g.writelines(lines)
+            g.flush()
+            os.fsync(g.fileno())
+            g.close()
+            if os.path.exists(save_file):
+                shutil.copymode(save_file,tmp_file)
+            os.rename(tmp_file,save_file)
+        except:
+            g.close()
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+    finally:
+        if held is None and lock is not None:
+            lock.release()
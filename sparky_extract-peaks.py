@@ -5,87 +5,347 @@ sparky_extract-peaks.py
 
 Extract all peaks in all sparky .save files in a directory, writing to an 
 R-readable list.  This program assumes that the pH of each experiment is in the
-filename with style: pH_7p01_*.save.  
+filename with style: pH_7p01_*.save.  By default the table has one row per
+peak and pH (NA where a peak is missing); -l wide writes one row per peak with
+columns for each pH.
 """
 
 __author__ = "Michael J. Harms"
 __date__ = "080410"
-__usage__ = "sparky_extract-peaks.py dir_with_save_files"
+__usage__ = "sparky_extract-peaks.py [options] dir_with_save_files"
 
-import os, sys
+import os, sys, time, optparse, cPickle
+import numpy
+import sparky_cache, sparky_classes, sparky_stats, sparky_titration
+from sparky_stats import STATS
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+def loadTable(sparky_file):
+    """
+    Return a PeakTable of the labeled peaks in sparky_file.  The file is only
+    parsed if it has changed since it was last cached (see sparky_cache).
+    """
+
+    return sparky_cache.loadPeakTable(sparky_file,skip_unlabeled=True)
 
 
 def extractPeaks(sparky_file):
     """
-    Extract peaks from sparky_file.
+    Extract labeled peaks from sparky_file.
     """
 
-    f = open(sparky_file,'r')
-    sparky = f.readlines()
-    f.close()
+    return formatPeaks(loadTable(sparky_file))
 
-    # Create peak_lines, a list of tuples that describe the line-numbers of 
-    # each peak.
-    peak_lines = [i for i, l in enumerate(sparky) if l[0:9] == "type peak"]
-    end_ornament = [i for i, l in enumerate(sparky)
-                    if l[0:14] == "<end ornament>"]
-    peak_lines.append(end_ornament[0])
-    peak_lines = [(peak_lines[i-1],peak_lines[i])
-                  for i in range(1,len(peak_lines))]
 
-    peak_list = []
-    for p in peak_lines:
+def formatPeaks(table):
+    """
+    Format the labeled peaks in a PeakTable as a dictionary of R-table rows,
+    keyed by peak label.
+    """
 
-        peak = sparky[p[0]:p[1]]        
-        hash = [l[0:3] for l in peak]
+    table = table.select(table.labeled)
+    aa_names = table.aa_names
+    atom_names = table.atom_names
 
-        # Peak label. This try/except statement will skip all unlabeled peaks.
-        try:
-            rs = peak[hash.index("rs ")][4:].split("|")
-            aa_type = "%10s" % rs[0][0:3]
-            res_num = "%10i" % int(rs[0][3:])
-            atoms = "%10s" % ("%s-%s" % (rs[1],rs[4]))
-        except ValueError:
-            continue
-       
-        # Peak position 
-        pos = peak[hash.index("pos")][4:].split()
-        w1 = "%10.3F" % float(pos[0])
-        w2 = "%10.3F" % float(pos[1])
+    with STATS.stage("format"):
+        peak_list = []
+        for i in range(len(table)):
+
+            # Peak label
+            aa_type = "%10s" % aa_names[table.aa[i,0]]
+            res_num = "%10i" % table.res_num[i,0]
+            atoms = "%10s" % ("%s-%s" % (atom_names[table.atoms[i,0]],
+                                         atom_names[table.atoms[i,1]]))
+
+            # Peak position 
+            w1 = "%10.3F" % table.position[i,0]
+            w2 = "%10.3F" % table.position[i,1]
        
-        # Peak height 
-        height = peak[hash.index("hei")][7:].split()
-        height = "%10.2E" % float(height[1])
+            # Peak height 
+            height = "%10.2E" % table.height[i]
 
-        # Peak integral
-        try:
-            integral = peak[hash.index("int")][9:].split()
-            integral = "%10.2E" % float(integral[0])
-        except ValueError:
-            integral = "%10s" % "NA"
+            # Peak integral
+            if table.integral[i] == table.integral[i]:
+                integral = "%10.2E" % table.integral[i]
+            else:
+                integral = "%10s" % "NA"
         
-        # Peak note
-        try:
-            note = peak[hash.index("not")][5:].strip()
-            note = note[1:-1]   # remove trailing quotes
-            note = "%30s" % ("\"%s\"" % (note[:26]))
-        except ValueError:
-            note = "%30s" % "NA"
+            # Peak note (stored with quotes)
+            if table.note[i] is not None:
+                note = "%30s" % ("\"%s\"" % (table.note[i][1:-1][:26]))
+            else:
+                note = "%30s" % "NA"
 
-        peak_list.append((3*"%s" % (res_num,aa_type,atoms),
-                          5*"%s" % (w1,w2,height,integral,note)))
+            peak_list.append((3*"%s" % (res_num,aa_type,atoms),
+                              5*"%s" % (w1,w2,height,integral,note)))
 
     return dict(peak_list)
 
 
+def loadIfComplete(sparky_file):
+    """
+    Return a PeakTable of the labeled peaks in sparky_file, or None (with a
+    warning) if the file cannot be parsed, e.g. because it is still being
+    written.
+    """
+
+    try:
+        return loadTable(sparky_file)
+    except (sparky_classes.SparkyError,ValueError,EnvironmentError), e:
+        print >> sys.stderr, "Skipping \"%s\": %s" % (sparky_file,e)
+        return None
+
+
+def loadAllTables(sparky_files,jobs=1):
+    """
+    Return a list of PeakTables of the labeled peaks in each file in
+    sparky_files, parsed across jobs processes.
+    """
+
+    return sparky_stats.mapWithStats(loadTable,sparky_files,jobs)
+
+
+def readPH(sparky_file):
+    """
+    Parse the pH from a file name of style pH_7p01_*.save.
+    """
+
+    pH = os.path.basename(sparky_file).split("_")[1]
+
+    return float("%s.%s" % tuple(pH.split("p")))
+
+
+def writeMatrix(g,matrix,data_dir,sparky_files,layout="long"):
+    """
+    Write a TitrationMatrix to the file object g as a long or wide R table,
+    in chunks.
+    """
+
+    if layout == "wide":
+        chunks = matrix.iterWide(data_dir,sparky_files)
+    else:
+        chunks = matrix.iterLong(data_dir,sparky_files)
+    for chunk in chunks:
+        g.write(chunk)
+
+
+def tableArrays(data_dir,sparky_files,matrix):
+    """
+    Convert a TitrationMatrix into a dictionary of columns, one row per
+    observed peak, in the order of the long R table (residue number, amino
+    acid, and atoms, then pH).  Missing integrals are nan and missing notes "".
+    """
+
+    rows, columns = numpy.nonzero(matrix.observed)
+
+    arrays = {"residue":matrix.residue[rows],
+              "aa":matrix.aa[rows],
+              "atoms":matrix.atoms[rows],
+              "pH":matrix.pH[columns],
+              "w1":matrix.w1[rows,columns],
+              "w2":matrix.w2[rows,columns],
+              "height":matrix.height[rows,columns],
+              "volume":matrix.volume[rows,columns],
+              "note":numpy.array([n or "" for n in matrix.note[rows,columns]],
+                                 dtype=str)}
+    arrays["data_dir"] = numpy.array(data_dir)
+    arrays["files"] = numpy.array(sparky_files,dtype=str)
+
+    return arrays
+
+
+def writeArrays(output_file,arrays):
+    """
+    Write a dictionary of columns to output_file as a numpy .npz bundle
+    (loadable with numpy.load, or RcppCNpy in R).
+    """
+
+    g = open(output_file,'wb')
+    try:
+        numpy.savez(g,**arrays)
+    finally:
+        g.close()
+
+
+def updateManifest(input_dir,manifest,jobs=1):
+    """
+    Bring manifest (a dictionary keyed by file name holding the modification
+    time, size, and PeakTable of each .save file in input_dir) up to date.
+    Only new or changed files are parsed; deleted files are dropped.  Files
+    that cannot be parsed yet (e.g. partly written) are left out, so they are
+    tried again on the next update.  Returns True if anything changed.
+    """
+
+    current = {}
+    for f in os.listdir(input_dir):
+        if f[-5:] != ".save":
+            continue
+        try:
+            st = os.stat(os.path.join(input_dir,f))
+        except OSError:
+            continue
+        current[f] = (st.st_mtime,st.st_size)
+
+    removed = [f for f in manifest.keys() if f not in current]
+    changed = [f for f in current.keys()
+               if f not in manifest or manifest[f][0:2] != current[f]]
+    changed.sort()
+
+    for f in removed:
+        del manifest[f]
+
+    new_tables = sparky_stats.mapWithStats(loadIfComplete,
+                                           [os.path.join(input_dir,f)
+                                            for f in changed],jobs)
+    num_updated = 0
+    for f, table in zip(changed,new_tables):
+        if table is None:
+            if f in manifest:
+                del manifest[f]
+                num_updated += 1
+            continue
+        manifest[f] = current[f] + (table,)
+        num_updated += 1
+
+    return len(removed) > 0 or num_updated > 0
+
+
+def writeTitration(output_file,data_dir,sparky_files,pH_values,tables,
+                   file_format="text",layout="long"):
+    """
+    Write the titration in tables (one PeakTable per file in sparky_files) to
+    output_file as a long or wide R table (to stdout if output_file is None)
+    or .npz bundle.
+    """
+
+    # Assemble the (peak x pH) matrices
+    with STATS.stage("assemble"):
+        matrix = sparky_titration.buildMatrix(tables,pH_values)
+
+    if file_format == "npz":
+        with STATS.stage("output"):
+            if layout == "long":
+                arrays = tableArrays(data_dir,sparky_files,matrix)
+            else:
+                arrays = matrix.arrays()
+                arrays["data_dir"] = numpy.array(data_dir)
+                arrays["files"] = numpy.array(sparky_files,dtype=str)
+            writeArrays(output_file,arrays)
+        return
+
+    # Stream the table out in chunks
+    with STATS.stage("output"):
+        if output_file is None:
+            g = sys.stdout
+        else:
+            g = open(output_file,'w')
+        writeMatrix(g,matrix,data_dir,sparky_files,layout)
+        if output_file is None:
+            g.write("\n")
+        else:
+            g.close()
+
+
+def writeManifestTable(input_dir,manifest,output_file,file_format="text",
+                       layout="long"):
+    """
+    Write the titration for all files in manifest to output_file, replacing
+    the old output atomically.
+    """
+
+    sparky_files = manifest.keys()
+    sparky_files.sort()
+    pH_values = [readPH(f) for f in sparky_files]
+
+    tmp_file = "%s.tmp" % output_file
+    writeTitration(tmp_file,os.path.abspath(input_dir),sparky_files,pH_values,
+                   [manifest[f][2] for f in sparky_files],file_format,layout)
+    os.rename(tmp_file,output_file)
+
+
+def watchDirectory(input_dir,output_file,manifest_file=None,interval=60,
+                   jobs=1,file_format="text",layout="long"):
+    """
+    Keep output_file (in file_format and layout) up to date as .save files
+    appear in (or change in) input_dir.  Already ingested files are recorded
+    in manifest_file so that they are not parsed again, even across runs.
+    Changes are detected with inotify if pyinotify is installed; otherwise the
+    directory is polled every interval seconds.
+    """
+
+    if manifest_file is None:
+        manifest_file = "%s.manifest" % output_file
+
+    try:
+        f = open(manifest_file,'rb')
+        manifest = cPickle.load(f)
+        f.close()
+    except (IOError,EOFError,cPickle.UnpicklingError):
+        manifest = {}
+
+    def update(force=False):
+        if updateManifest(input_dir,manifest,jobs) or force:
+            writeManifestTable(input_dir,manifest,output_file,file_format,
+                               layout)
+            g = open(manifest_file,'wb')
+            cPickle.dump(manifest,g,cPickle.HIGHEST_PROTOCOL)
+            g.close()
+            print >> sys.stderr, "%s: %i files" % (output_file,len(manifest))
+
+    update(force=True)
+
+    # Fall back to polling
+    if pyinotify is None:
+        while True:
+            time.sleep(interval)
+            update()
+
+    class _Ignore(pyinotify.ProcessEvent):
+        def process_default(self,event):
+            pass
+
+    wm = pyinotify.WatchManager()
+    mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | \
+           pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM
+    wm.add_watch(input_dir,mask)
+    notifier = pyinotify.Notifier(wm,_Ignore(),timeout=interval*1000)
+    while True:
+        if notifier.check_events():
+            notifier.read_events()
+            notifier.process_events()
+        update()
+
 
 def main():
     """
     If called from command line...
     """
 
+    parser = optparse.OptionParser(usage=__usage__)
+    parser.add_option("-j","--jobs",type="int",default=1,
+                      help="number of processes used to parse files")
+    parser.add_option("-w","--watch",action="store_true",default=False,
+                      help="keep the output file up to date as files arrive")
+    parser.add_option("-o","--output",default=None,
+                      help="output file (required with --watch or -f npz)")
+    parser.add_option("-f","--format",default="text",
+                      help="output format: text (R table) or npz [text]")
+    parser.add_option("-l","--layout",default="long",
+                      help="long (one row per peak and pH) or wide (one row "
+                           "per peak, columns for each pH) [long]")
+    parser.add_option("-m","--manifest",default=None,
+                      help="manifest of ingested files [OUTPUT.manifest]")
+    parser.add_option("-i","--interval",type="float",default=60,
+                      help="seconds between directory polls [60]")
+    options, args = parser.parse_args()
+
     try:
-        input_dir = sys.argv[1]
+        input_dir = args[0]
     except IndexError:
         print __usage__
         sys.exit()
@@ -94,51 +354,41 @@ def main():
     if not os.path.isdir(input_dir):
         print "\"%s\" does not exist!" % input_dir
         sys.exit()
+
+    if options.format not in ["text","npz"]:
+        print "--format must be \"text\" or \"npz\""
+        sys.exit()
+    if options.layout not in ["long","wide"]:
+        print "--layout must be \"long\" or \"wide\""
+        sys.exit()
+    if options.format == "npz" and options.output is None:
+        print "-f npz requires an output file (--output)"
+        sys.exit()
+
+    if options.watch:
+        if options.output is None:
+            print "--watch requires an output file (--output)"
+            sys.exit()
+        watchDirectory(input_dir,options.output,options.manifest,
+                       options.interval,options.jobs,options.format,
+                       options.layout)
+        return
+
     sparky_files = os.listdir(input_dir)
     sparky_files = [f for f in sparky_files if f[-5:] == ".save"]
     sparky_files.sort()
-    os.chdir(input_dir)
+    data_dir = os.path.abspath(input_dir)
 
     # Create list of pH values
-    pH_values = [l.split("_")[1] for l in sparky_files]
-    pH_values = [float("%s.%s" % tuple(p.split("p"))) for p in pH_values]
-
-    # Extract peaks from each file at each pH
-    all_peaks = dict([(pH_values[i],extractPeaks(f))
-                      for i, f in enumerate(sparky_files)])
-
-    # Create list of unique peaks, sorted by residue number
-    all_peak_labels = [pH.keys() for pH in all_peaks.values()]
-    flattened_labels = []
-    for peak_list in all_peak_labels:
-        flattened_labels.extend(peak_list)
-    unique_labels = dict([(l,0) for l in flattened_labels]).keys()
-    to_sort = [(int(l.split()[0]),l) for l in unique_labels]
-    to_sort.sort()
-    peak_labels = [l[1] for l in to_sort]
-
-
-    # Write output in R-readable format
-    i = 0
-    output = ["# Taken from data in: %s\n" % os.path.abspath(input_dir)]
-    output.extend(["#   %s\n" % f for f in sparky_files])
-    output.append("%10s%10s%10s%10s%10s%10s%10s%10s%10s%30s\n" % \
-           (" ","residue","aa","atoms","pH","w1","w2","height","volume","note"))
-    pH_values.sort()
-    for peak in peak_labels:
-        for pH in pH_values:
-            try:
-                peak_data = all_peaks[pH][peak]
-                output.append("%10i%s%10.3F%s\n" % (i,peak,pH,peak_data))
-            except KeyError:
-                output.append("%10i%s%10.3F%10s%10s%10s%10s%30s\n" % \
-                              (i,peak,pH,"NA","NA","NA","NA","NA"))
-            i += 1
-
-    print "".join(output)
-   
- 
+    pH_values = [readPH(f) for f in sparky_files]
+
+    # Parse each file at each pH
+    tables = loadAllTables([os.path.join(input_dir,f) for f in sparky_files],
+                           options.jobs)
+
+    writeTitration(options.output,data_dir,sparky_files,pH_values,tables,
+                   options.format,options.layout)
 
 
 if __name__ == "__main__":
-    main()
+    sparky_stats.run(main)
@@ -3,112 +3,222 @@ __description__ = \
 """
 sparky_extract-peaks_3d-assgn.py 
 
+Extract the labeled peaks in a 3D sparky .save file, writing an R-readable
+table (or, with -f npz, a numpy .npz bundle of columns).
 """
 
 __author__ = "Michael J. Harms"
 __date__ = "080410"
-__usage__ = "sparky_extract-peaks.py dir_with_save_files"
+__usage__ = "sparky_extract-peaks_3d-assgn.py [options] save_file"
 
-import os, sys
+import os, sys, optparse
+import numpy
+import sparky_cache, sparky_stats
+from sparky_stats import STATS
+
+# Rows formatted (and written) at a time
+CHUNK_ROWS = 4096
+ROW_FORMAT = "%10i%s%s\n"
+
+
+def loadTable(sparky_file):
+    """
+    Return a PeakTable of the labeled peaks in sparky_file.  The file is only
+    parsed if it has changed since it was last cached (see sparky_cache).
+    """
+
+    return sparky_cache.loadPeakTable(sparky_file,skip_unlabeled=True)
 
 
 def extractPeaks(sparky_file):
     """
-    Extract peaks from sparky_file.
-    """
-
-    f = open(sparky_file,'r')
-    sparky = f.readlines()
-    f.close()
-
-    # Create peak_lines, a list of tuples that describe the line-numbers of 
-    # each peak.
-    peak_lines = [i for i, l in enumerate(sparky) if l[0:9] == "type peak"]
-    end_ornament = [i for i, l in enumerate(sparky)
-                    if l[0:14] == "<end ornament>"]
-    peak_lines.append(end_ornament[0])
-    peak_lines = [(peak_lines[i-1],peak_lines[i])
-                  for i in range(1,len(peak_lines))]
-
-    peak_list = []
-    for p in peak_lines:
-
-        peak = sparky[p[0]:p[1]]        
-        hash = [l[0:3] for l in peak]
-
-        # Peak label. This try/except statement will skip all unlabeled peaks.
-        try:
-            rs = peak[hash.index("rs ")][4:].split("|")
-            aa_type = "%10s" % rs[3][0:3]
-            res_num = "%10i" % int(rs[3][3:])
-            atoms = "%10s" % rs[4]
-            assgn_atoms = "%28s" % ("%s-%s,%s-%s" % (rs[0],rs[1],rs[6],rs[7]))
-        except ValueError:
-            continue
+    Extract labeled peaks from sparky_file.
+    """
+
+    return formatPeaks(loadTable(sparky_file))
+
+
+def formatPeaks(table):
+    """
+    Format the labeled peaks in a PeakTable as a dictionary of R-table rows,
+    keyed by peak label.
+    """
+
+    table = table.select(table.labeled)
+    aa_names = table.aa_names
+    atom_names = table.atom_names
+
+    with STATS.stage("format"):
+        peak_list = []
+        for i in range(len(table)):
+
+            # Peak label
+            aa, res, atom = table.aa[i], table.res_num[i], table.atoms[i]
+            aa_type = "%10s" % aa_names[aa[1]]
+            res_num = "%10i" % res[1]
+            atoms = "%10s" % atom_names[atom[1]]
+            assgn_atoms = "%s%i-%s,%s%i-%s" % \
+                          (aa_names[aa[0]],res[0],atom_names[atom[0]],
+                           aa_names[aa[2]],res[2],atom_names[atom[2]])
+            assgn_atoms = "%28s" % assgn_atoms
        
-        # Peak position 
-        pos = peak[hash.index("pos")][4:].split()
-        w1 = "%10.3F" % float(pos[0])
-        w2 = "%10.3F" % float(pos[1])
-        w3 = "%10.3F" % float(pos[2])
+            # Peak position 
+            w1 = "%10.3F" % table.position[i,0]
+            w2 = "%10.3F" % table.position[i,1]
+            w3 = "%10.3F" % table.position[i,2]
  
-        # Peak height 
-        height = peak[hash.index("hei")][7:].split()
-        height = "%10.2E" % float(height[1])
-
-        # Peak integral
-        try:
-            integral = peak[hash.index("int")][9:].split()
-            integral = "%10.2E" % float(integral[0])
-        except ValueError:
-            integral = "%10s" % "NA"
+            # Peak height 
+            height = "%10.2E" % table.height[i]
+
+            # Peak integral
+            if table.integral[i] == table.integral[i]:
+                integral = "%10.2E" % table.integral[i]
+            else:
+                integral = "%10s" % "NA"
         
-        # Peak note
-        try:
-            note = peak[hash.index("not")][5:].strip()
-            note = note[1:-1]   # remove trailing quotes
-            note = "%30s" % ("\"%s\"" % (note[:26]))
-        except ValueError:
-            note = "%30s" % "NA"
+            # Peak note (stored with quotes)
+            if table.note[i] is not None:
+                note = "%30s" % ("\"%s\"" % (table.note[i][1:-1][:26]))
+            else:
+                note = "%30s" % "NA"
 
-        peak_list.append((4*"%s" % (res_num,aa_type,atoms,assgn_atoms),
-                          6*"%s" % (w1,w2,w3,height,integral,note)))
+            peak_list.append((4*"%s" % (res_num,aa_type,atoms,assgn_atoms),
+                              6*"%s" % (w1,w2,w3,height,integral,note)))
 
     return dict(peak_list)
 
 
 
+def iterTable(sparky_file,peaks,chunk_rows=CHUNK_ROWS):
+    """
+    Generate an R-readable table of the peaks extracted from sparky_file,
+    sorted by residue number, yielding it in chunks of up to chunk_rows rows.
+    Each chunk is formatted with a single % operation.
+    """
+
+    to_sort = [(int(l.split()[0]),l) for l in peaks.keys()]
+    to_sort.sort()
+    peak_labels = [l[1] for l in to_sort]
+    
+    # Write output in R-readable format
+    header = ["# Taken from %s\n" % os.path.abspath(sparky_file)]
+    header.append("%10s%10s%10s%10s%28s%10s%10s%10s%10s%10s%30s\n" % \
+           (" ","residue","aa","atoms","assgn_atoms","w1","w2","w3",
+            "height","volume","note"))
+    yield "".join(header)
+
+    for start in range(0,len(peak_labels),chunk_rows):
+        chunk = peak_labels[start:start + chunk_rows]
+        row_args = []
+        for i, peak in enumerate(chunk):
+            row_args.extend((start + i,peak,peaks[peak]))
+        yield ROW_FORMAT*len(chunk) % tuple(row_args)
+
+
+def writeTable(sparky_file,peaks):
+    """
+    Generate an R-readable table of the peaks extracted from sparky_file,
+    sorted by residue number, as a single string.
+    """
+
+    return "".join(iterTable(sparky_file,peaks))
+
+
+def tableArrays(sparky_file,table):
+    """
+    Convert the labeled peaks in a PeakTable into a dictionary of columns,
+    one row per peak, sorted by residue number.  Missing integrals are nan and
+    missing notes "".
+    """
+
+    table = table.select(table.labeled).sort("res_num",dim=1)
+    aa_names = numpy.array(table.aa_names + [""],dtype=str)
+    atom_names = numpy.array(table.atom_names + [""],dtype=str)
+
+    assgn_atoms = ["%s%i-%s,%s%i-%s" % \
+                   (aa_names[aa[0]],res[0],atom_names[atom[0]],
+                    aa_names[aa[2]],res[2],atom_names[atom[2]])
+                   for aa, res, atom in zip(table.aa,table.res_num,
+                                            table.atoms)]
+
+    arrays = {"residue":table.res_num[:,1],
+              "aa":aa_names[table.aa[:,1]],
+              "atoms":atom_names[table.atoms[:,1]],
+              "assgn_atoms":numpy.array(assgn_atoms,dtype=str),
+              "w1":table.position[:,0],
+              "w2":table.position[:,1],
+              "w3":table.position[:,2],
+              "height":table.height,
+              "volume":table.integral,
+              "note":numpy.array([n is not None and n[1:-1] or ""
+                                  for n in table.note],dtype=str),
+              "source_file":numpy.array(os.path.abspath(sparky_file))}
+
+    return arrays
+
+
+def writeArrays(output_file,arrays):
+    """
+    Write a dictionary of columns to output_file as a numpy .npz bundle
+    (loadable with numpy.load, or RcppCNpy in R).
+    """
+
+    g = open(output_file,'wb')
+    try:
+        numpy.savez(g,**arrays)
+    finally:
+        g.close()
+
+
 def main():
     """
     If called from command line...
     """
 
+    parser = optparse.OptionParser(usage=__usage__)
+    parser.add_option("-o","--output",default=None,
+                      help="output file (required with -f npz)")
+    parser.add_option("-f","--format",default="text",
+                      help="output format: text (R table) or npz [text]")
+    options, args = parser.parse_args()
+
     try:
-        sparky_file = sys.argv[1]
+        sparky_file = args[0]
     except IndexError:
         print __usage__
         sys.exit()
 
+    if options.format not in ["text","npz"]:
+        print "--format must be \"text\" or \"npz\""
+        sys.exit()
+
+    if options.format == "npz":
+        if options.output is None:
+            print "-f npz requires an output file (--output)"
+            sys.exit()
+        table = loadTable(sparky_file)
+        with STATS.stage("format"):
+            arrays = tableArrays(sparky_file,table)
+        with STATS.stage("output"):
+            writeArrays(options.output,arrays)
+        return
 
     peaks = extractPeaks(sparky_file)
  
-    to_sort = [(int(l.split()[0]),l) for l in peaks.keys()]
-    to_sort.sort()
-    peak_labels = [l[1] for l in to_sort]
-    
-    # Write output in R-readable format
-    i = 0
-    output = ["# Taken from %s\n" % os.path.abspath(sparky_file)]
-    output.append("%10s%10s%10s%10s%28s%10s%10s%10s%10s%10s%30s\n" % \
-           (" ","residue","aa","atoms","assgn_atoms","w1","w2","w3","height",
-            "volume","note"))
-    for i, peak in enumerate(peak_labels):
-        peak_data = peaks[peak]
-        output.append("%10i%s%s\n" % (i,peak,peak_data))
-
-    print "".join(output)
+    # Stream the table out in chunks
+    with STATS.stage("output"):
+        if options.output is None:
+            g = sys.stdout
+        else:
+            g = open(options.output,'w')
+        for chunk in iterTable(sparky_file,peaks):
+            g.write(chunk)
+        if options.output is None:
+            g.write("\n")
+        else:
+            g.close()
    
 
 
 if __name__ == "__main__":
-    main()
+    sparky_stats.run(main)
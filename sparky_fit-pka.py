@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+__description__ = \
+"""
+sparky_fit-pka.py
+
+Fit Henderson-Hasselbalch curves to the w1 and w2 shifts of every peak in a
+titration at once (see sparky_pka).  The titration is either a directory of
+sparky .save files named pH_7p01_*.save or a .npz bundle written by
+sparky_extract-peaks.py -f npz -l wide.  Writes an R-readable table with the
+pKa(s), Hill coefficient, limiting shifts, and fit quality of each peak and
+dimension (NA where a peak has too few points for the model).  With
+--bootstrap N, percentile intervals on the pKa(s) and Hill coefficient from N
+bootstrap replicates are added.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080520"
+__usage__ = "sparky_fit-pka.py [options] dir_with_save_files|titration.npz"
+
+import os, sys, optparse
+import numpy
+import sparky_pka, sparky_stats, sparky_titration
+from sparky_stats import STATS
+
+# Rows formatted (and written) at a time
+CHUNK_ROWS = 4096
+
+# Columns of each fit, NA where they do not apply to the model
+FIT_COLUMNS = ["pKa1","pKa2","hill","low","mid","high","rmsd","r2","points"]
+BOOTSTRAP_COLUMNS = ["pKa1_lo","pKa1_hi","pKa2_lo","pKa2_hi","hill_lo",
+                     "hill_hi","boot_n"]
+
+
+def fitMatrix(matrix,model="single",dims=("w1","w2"),fit_hill=True,jobs=1,
+              replicates=0,seed=sparky_pka.BOOTSTRAP_SEED,
+              level=sparky_pka.BOOTSTRAP_LEVEL):
+    """
+    Fit each dimension in dims of every peak in matrix.  Returns a list of
+    (dimension,fit,bootstrap) tuples: fit as returned by sparky_pka.fitCurves
+    and, if replicates > 0, bootstrap intervals as returned by
+    sparky_pka.bootstrapCurves (otherwise None).
+    """
+
+    fits = []
+    for d in dims:
+        fit = sparky_pka.fitCurves(getattr(matrix,d),matrix.pH,model,
+                                   observed=matrix.observed,
+                                   fit_hill=fit_hill,jobs=jobs)
+        bootstrap = None
+        if replicates > 0:
+            bootstrap = sparky_pka.bootstrapCurves(getattr(matrix,d),
+                                                   matrix.pH,model,
+                                                   matrix.observed,replicates,
+                                                   seed,level,fit_hill,jobs)
+        fits.append((d,fit,bootstrap))
+
+    return fits
+
+def fitColumns(fit,model,bootstrap=None):
+    """
+    Arrange a fit into the FIT_COLUMNS (and bootstrap intervals into the
+    BOOTSTRAP_COLUMNS), one (R) array each.
+    """
+
+    num_rows = len(fit["rss"])
+    missing = numpy.empty(num_rows,dtype=numpy.float64)
+    missing.fill(numpy.nan)
+
+    columns = {"pKa1":fit["pKa"][:,0],"hill":fit["hill"],
+               "low":fit["limits"][:,0],"high":fit["limits"][:,-1],
+               "rmsd":fit["rmsd"],"r2":fit["r2"],"points":fit["num_points"]}
+    if model == "double":
+        columns["pKa2"] = fit["pKa"][:,1]
+        columns["mid"] = fit["limits"][:,1]
+    else:
+        columns["pKa2"] = missing
+        columns["mid"] = missing
+
+    if bootstrap is not None:
+        columns["pKa1_lo"] = bootstrap["pKa"][:,0,0]
+        columns["pKa1_hi"] = bootstrap["pKa"][:,0,1]
+        columns["pKa2_lo"] = columns["pKa2_hi"] = missing
+        if model == "double":
+            columns["pKa2_lo"] = bootstrap["pKa"][:,1,0]
+            columns["pKa2_hi"] = bootstrap["pKa"][:,1,1]
+        columns["hill_lo"] = bootstrap["hill"][:,0]
+        columns["hill_hi"] = bootstrap["hill"][:,1]
+        columns["boot_n"] = bootstrap["replicates"]
+
+    return columns
+
+def iterFits(matrix,fits,model,titration,chunk_rows=CHUNK_ROWS):
+    """
+    Generate an R-readable table of fits (from fitMatrix) in chunks of up to
+    chunk_rows rows.
+    """
+
+    names = FIT_COLUMNS[:]
+    formats = ["%10.3F"]*(len(FIT_COLUMNS) - 1) + ["%10i"]
+    if len(fits) > 0 and fits[0][2] is not None:
+        names.extend(BOOTSTRAP_COLUMNS)
+        formats.extend(["%10.3F"]*(len(BOOTSTRAP_COLUMNS) - 1) + ["%10i"])
+
+    header = ["# %s fits of: %s\n" % (model,os.path.abspath(titration))]
+    header.append("%10s%10s%10s%10s%10s%s\n" % \
+                  (" ","residue","aa","atoms","dim",
+                   "".join(["%10s" % c for c in names])))
+    yield "".join(header)
+
+    out = []
+    i = 0
+    for d, fit, bootstrap in fits:
+        columns = fitColumns(fit,model,bootstrap)
+        columns = [columns[c] for c in names]
+        for r in range(len(matrix)):
+            values = [v == v and f % v or "%10s" % "NA"
+                      for f, v in zip(formats,[c[r] for c in columns])]
+            out.append("%10i%10i%10s%10s%10s%s\n" % \
+                       (i,matrix.residue[r],matrix.aa[r],matrix.atoms[r],d,
+                        "".join(values)))
+            i += 1
+
+            if len(out) >= chunk_rows:
+                yield "".join(out)
+                out = []
+
+    if out:
+        yield "".join(out)
+
+
+def main():
+    """
+    If called from command line...
+    """
+
+    parser = optparse.OptionParser(usage=__usage__)
+    parser.add_option("-m","--model",default="single",
+                      help="single or double (two-site) [single]")
+    parser.add_option("-d","--dims",default="w1,w2",
+                      help="dimensions to fit [w1,w2]")
+    parser.add_option("-n","--no-hill",action="store_true",default=False,
+                      help="fix the Hill coefficient of single fits at 1")
+    parser.add_option("-j","--jobs",type="int",default=1,
+                      help="number of processes used to parse and fit")
+    parser.add_option("-b","--bootstrap",type="int",default=0,
+                      help="bootstrap replicates for pKa intervals [0]")
+    parser.add_option("-s","--seed",type="int",
+                      default=sparky_pka.BOOTSTRAP_SEED,
+                      help="random seed for the bootstrap [%i]" % \
+                           sparky_pka.BOOTSTRAP_SEED)
+    parser.add_option("-c","--confidence",type="float",
+                      default=sparky_pka.BOOTSTRAP_LEVEL,
+                      help="bootstrap interval (%%) [%.0F]" % \
+                           sparky_pka.BOOTSTRAP_LEVEL)
+    parser.add_option("-o","--output",default=None,
+                      help="output file [stdout]")
+    options, args = parser.parse_args()
+
+    try:
+        titration = args[0]
+    except IndexError:
+        print __usage__
+        sys.exit()
+
+    if options.model not in sparky_pka.MODELS:
+        print "--model must be one of %s" % ", ".join(sparky_pka.MODELS)
+        sys.exit()
+    dims = [d for d in options.dims.split(",") if d != ""]
+    if len(dims) == 0 or len([d for d in dims if d not in ["w1","w2"]]) > 0:
+        print "--dims must be w1, w2, or w1,w2"
+        sys.exit()
+    if not 0 < options.confidence < 100:
+        print "--confidence must be between 0 and 100"
+        sys.exit()
+    if not os.path.exists(titration):
+        print "\"%s\" does not exist!" % titration
+        sys.exit()
+
+    with STATS.stage("read"):
+        matrix = sparky_titration.loadTitration(titration,options.jobs)
+
+    fits = fitMatrix(matrix,options.model,dims,not options.no_hill,
+                     options.jobs,options.bootstrap,options.seed,
+                     options.confidence)
+
+    with STATS.stage("output"):
+        if options.output is None:
+            g = sys.stdout
+        else:
+            g = open(options.output,'w')
+        for chunk in iterFits(matrix,fits,options.model,titration):
+            g.write(chunk)
+        if options.output is None:
+            g.write("\n")
+        else:
+            g.close()
+
+
+if __name__ == "__main__":
+    sparky_stats.run(main)
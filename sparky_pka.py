@@ -0,0 +1,433 @@
+__description__ = \
+"""
+Batched fitting of Henderson-Hasselbalch titration curves.  Every curve of a
+(peak x pH) matrix is fit at once.  Both models are linear in their limiting
+shifts once the pKa (and Hill coefficient) are fixed:
+
+    single   shift = low*(1 - f) + high*f,   f = 1/(1 + 10**(n*(pKa - pH)))
+    double   shift = low + d1*f1 + d2*f2,    fi = 1/(1 + 10**(pKai - pH))
+
+so the nonlinear parameters are found by a grid search in which each grid
+point is a weighted linear least squares problem, solved for all curves with
+one set of array operations, followed by successively finer local grids
+around each curve's best point.  Missing points (nan, or False in the
+observed mask) get zero weight.  Weights also let a bootstrap replicate be fit
+as the original data with each point weighted by the number of times it was
+drawn.  Large problems are split into chunks of rows fit across a process
+pool.
+
+bootstrapCurves draws every replicate as resampled indexes (converted to point
+weights), fits the replicates in batches, and reports percentile intervals.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080520"
+
+import multiprocessing, warnings
+import numpy
+import sparky_stats
+from sparky_stats import STATS
+
+class SparkyPkaError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+MODELS = ["single","double"]
+
+# Nonlinear parameters and limiting shifts of each model
+NUM_PKA = {"single":1,"double":2}
+NUM_LIMITS = {"single":2,"double":3}
+
+# Coarse grid: pKa values span the measured pH range extended by PKA_MARGIN
+PKA_MARGIN = 1.0
+PKA_STEP = 0.1
+HILL_RANGE = (0.5,2.5)
+HILL_STEP = 0.1
+
+# Local refinement: points on each side of the best point, rounds, and the
+# factor the step shrinks by each round
+REFINE_POINTS = 4
+REFINE_ROUNDS = 3
+REFINE_SHRINK = 4.0
+
+# Rows fit at a time (and handed to each worker)
+CHUNK_ROWS = 256
+
+# Bootstrap replicates, random seed, interval (%), and replicates resampled
+# and fit at a time
+BOOTSTRAP_REPLICATES = 1000
+BOOTSTRAP_SEED = 0
+BOOTSTRAP_LEVEL = 95.0
+BOOTSTRAP_BATCH = 50
+
+
+def _fraction(pH,pKa,hill=1.0):
+    """
+    Fraction deprotonated at pH.
+    """
+
+    return 1.0/(1.0 + 10.0**(hill*(pKa - pH)))
+
+def _basis(model,pH,pKa,hill):
+    """
+    Basis functions of model at grid points.  pKa is (..., NUM_PKA) and hill
+    (...); returns an array (..., NUM_LIMITS, pH).
+    """
+
+    pH = numpy.asarray(pH,dtype=numpy.float64)
+    if model == "single":
+        f = _fraction(pH,pKa[...,0,numpy.newaxis],hill[...,numpy.newaxis])
+        return numpy.concatenate(((1 - f)[...,numpy.newaxis,:],
+                                  f[...,numpy.newaxis,:]),axis=-2)
+
+    f1 = _fraction(pH,pKa[...,0,numpy.newaxis])
+    f2 = _fraction(pH,pKa[...,1,numpy.newaxis])
+    one = numpy.ones(f1.shape,dtype=numpy.float64)
+
+    return numpy.concatenate((one[...,numpy.newaxis,:],
+                              f1[...,numpy.newaxis,:],
+                              f2[...,numpy.newaxis,:]),axis=-2)
+
+def _solve(y,w,basis):
+    """
+    Weighted linear least squares of every curve at every grid point.  y and
+    w are (R x P); basis is (G x K x P), shared by all curves, or
+    (R x G x K x P).  Returns coefficients (R x G x K) and the residual sum
+    of squares (R x G), inf where the normal equations are singular.
+    """
+
+    num_basis = basis.shape[-2]
+    wy = w*y
+
+    # Each element of the (symmetric) normal equations is an (R x G) array
+    A, b = {}, []
+    for i in range(num_basis):
+        if basis.ndim == 3:
+            # Shared grid: every sum over pH is a matrix product
+            b.append(numpy.dot(wy,basis[:,i,:].T))
+            for j in range(i,num_basis):
+                A[i,j] = numpy.dot(w,(basis[:,i,:]*basis[:,j,:]).T)
+        else:
+            b.append(numpy.einsum("rp,rgp->rg",wy,basis[:,:,i,:]))
+            for j in range(i,num_basis):
+                A[i,j] = numpy.einsum("rp,rgp,rgp->rg",w,basis[:,:,i,:],
+                                      basis[:,:,j,:])
+        for j in range(i):
+            A[i,j] = A[j,i]
+
+    # Solve in closed form from the cofactors, skipping singular (or nearly)
+    # systems.  The test is scaled by the weights so that it does not depend
+    # on the number of points.
+    cofactor = _cofactors(A,num_basis)
+    det = sum([A[0,j]*cofactor[0,j] for j in range(num_basis)])
+    scale = w.sum(1)[:,numpy.newaxis]**num_basis
+    good = numpy.abs(det) > 1e-10*numpy.maximum(scale,1)
+    det = numpy.where(good,det,1.0)
+
+    coef = numpy.empty(det.shape + (num_basis,),dtype=numpy.float64)
+    for i in range(num_basis):
+        coef[...,i] = sum([cofactor[i,j]*b[j] for j in range(num_basis)])/det
+    coef[numpy.logical_not(good)] = 0.0
+
+    rss = (wy*y).sum(1)[:,numpy.newaxis] - \
+          sum([coef[...,i]*b[i] for i in range(num_basis)])
+    rss = numpy.where(good,numpy.maximum(rss,0),numpy.inf)
+
+    return coef, rss
+
+def _cofactors(A,num_basis):
+    """
+    Cofactors of a symmetric 2 x 2 or 3 x 3 system whose elements are held
+    in a dictionary keyed by (row,column).
+    """
+
+    if num_basis == 2:
+        return {(0,0):A[1,1],(1,1):A[0,0],(0,1):-A[0,1],(1,0):-A[0,1]}
+
+    cofactor = {}
+    for i in range(3):
+        i1, i2 = (i + 1) % 3, (i + 2) % 3
+        for j in range(i,3):
+            j1, j2 = (j + 1) % 3, (j + 2) % 3
+            cofactor[i,j] = A[i1,j1]*A[i2,j2] - A[i1,j2]*A[i2,j1]
+            cofactor[j,i] = cofactor[i,j]
+
+    return cofactor
+
+def _coarseGrid(model,pH,fit_hill):
+    """
+    Coarse grid of (pKa, hill) points shared by all curves: pKa
+    (G x NUM_PKA), hill (G), and the basis functions at each point.
+    """
+
+    pKa_step, hill_range = PKA_STEP, HILL_RANGE
+    if not fit_hill:
+        hill_range = (1.0,1.0)
+
+    low, high = pH.min() - PKA_MARGIN, pH.max() + PKA_MARGIN
+    pKa = numpy.arange(low,high + pKa_step/2,pKa_step)
+
+    if model == "single":
+        hill = numpy.arange(hill_range[0],hill_range[1] + HILL_STEP/2,
+                            HILL_STEP)
+        grid_pKa = numpy.repeat(pKa,len(hill))[:,numpy.newaxis]
+        grid_hill = numpy.tile(hill,len(pKa))
+    else:
+        i, j = numpy.triu_indices(len(pKa),1)
+        grid_pKa = numpy.column_stack((pKa[i],pKa[j]))
+        grid_hill = numpy.ones(len(grid_pKa),dtype=numpy.float64)
+
+    return grid_pKa, grid_hill, _basis(model,pH,grid_pKa,grid_hill)
+
+def _localGrid(model,pKa,hill,pKa_step,hill_step,hill_range):
+    """
+    Local grid around each curve's best point: pKa (R x G x NUM_PKA) and
+    hill (R x G).
+    """
+
+    offsets = numpy.arange(-REFINE_POINTS,REFINE_POINTS + 1,
+                           dtype=numpy.float64)
+    if model == "single":
+        hill_offsets = offsets
+        if hill_step == 0:
+            hill_offsets = numpy.zeros(1,dtype=numpy.float64)
+        d_pKa = numpy.repeat(offsets,len(hill_offsets))*pKa_step
+        d_hill = numpy.tile(hill_offsets,len(offsets))*hill_step
+        local_pKa = pKa[:,numpy.newaxis,:] + \
+                    d_pKa[numpy.newaxis,:,numpy.newaxis]
+        local_hill = numpy.clip(hill[:,numpy.newaxis] + d_hill,hill_range[0],
+                                hill_range[1])
+    else:
+        d1 = numpy.repeat(offsets,len(offsets))*pKa_step
+        d2 = numpy.tile(offsets,len(offsets))*pKa_step
+        local_pKa = pKa[:,numpy.newaxis,:] + \
+                    numpy.column_stack((d1,d2))[numpy.newaxis,:,:]
+        local_hill = numpy.ones(local_pKa.shape[:2],dtype=numpy.float64)
+
+    return local_pKa, local_hill
+
+def _fitChunk(args):
+    """
+    Fit one chunk of rows.  args is (model, y, w, pH, fit_hill, grid), where
+    grid is the coarse (pKa, hill, basis) from _coarseGrid; returns a
+    dictionary of result arrays.  Rows whose normal equations are singular
+    at every coarse grid point have no fit and are nan.
+    """
+
+    model, y, w, pH, fit_hill, grid = args
+    grid_pKa, grid_hill, grid_basis = grid
+    rows = numpy.arange(len(y))
+
+    hill_range = HILL_RANGE
+    if not fit_hill:
+        hill_range = (1.0,1.0)
+
+    # Coarse grid shared by all curves
+    coef, rss = _solve(y,w,grid_basis)
+    best = rss.argmin(1)
+    pKa, hill = grid_pKa[best], grid_hill[best]
+    coef, rss = coef[rows,best], rss[rows,best]
+    singular = numpy.isinf(rss)
+
+    # Successively finer grids around each curve's best point
+    pKa_step, hill_step = PKA_STEP, HILL_STEP
+    for i in range(REFINE_ROUNDS):
+        pKa_step /= REFINE_SHRINK
+        hill_step /= REFINE_SHRINK
+        if not fit_hill:
+            hill_step = 0.0
+        local_pKa, local_hill = _localGrid(model,pKa,hill,pKa_step,hill_step,
+                                           hill_range)
+        local_coef, local_rss = _solve(y,w,_basis(model,pH,local_pKa,
+                                                  local_hill))
+        best = local_rss.argmin(1)
+        better = local_rss[rows,best] < rss
+        pKa[better] = local_pKa[rows,best][better]
+        hill[better] = local_hill[rows,best][better]
+        coef[better] = local_coef[rows,best][better]
+        rss[better] = local_rss[rows,best][better]
+
+    # Report the limiting shift at low pH, (intermediate,) and high pH
+    if model == "single":
+        limits = coef
+    else:
+        swap = pKa[:,0] > pKa[:,1]
+        pKa[swap] = pKa[swap][:,::-1]
+        coef[swap] = coef[swap][:,[0,2,1]]
+        limits = numpy.cumsum(coef,axis=1)
+
+    for r in (pKa,hill,limits,rss):
+        r[singular] = numpy.nan
+
+    return {"pKa":pKa,"hill":hill,"limits":limits,"rss":rss}
+
+
+def fitCurves(shifts,pH,model="single",observed=None,weights=None,
+              fit_hill=True,jobs=1,chunk_rows=CHUNK_ROWS,pool=None):
+    """
+    Fit every row of shifts (R x P, nan where missing) against pH (P) with
+    model.  observed (R x P) masks points out; weights (R x P) weight each
+    point (e.g. bootstrap counts).  Rows are fit in chunks of chunk_rows,
+    across pool, or a pool of jobs processes if jobs > 1.  Returns a
+    dictionary:
+
+        pKa         (R x NUM_PKA) pKa values, ascending
+        hill        (R) Hill coefficient (1 for the double model)
+        limits      (R x NUM_LIMITS) shifts at low pH, (between pKas,) and
+                    high pH
+        rss         (R) weighted residual sum of squares
+        rmsd        (R) sqrt(rss/total weight)
+        r2          (R) fraction of the weighted variance explained
+        num_points  (R) number of points with weight
+
+    Rows with too few points for model are nan.
+    """
+
+    if model not in MODELS:
+        err = "Model must be one of %s!" % ", ".join(MODELS)
+        raise SparkyPkaError(err)
+
+    shifts = numpy.asarray(shifts,dtype=numpy.float64)
+    pH = numpy.asarray(pH,dtype=numpy.float64)
+    if shifts.ndim != 2 or shifts.shape[1] != len(pH):
+        err = "Shifts must be a (peak x pH) matrix with a column per pH!"
+        raise SparkyPkaError(err)
+
+    w = numpy.logical_not(numpy.isnan(shifts)).astype(numpy.float64)
+    if observed is not None:
+        w *= observed
+    if weights is not None:
+        w *= weights
+    y = numpy.where(w > 0,shifts,0.0)
+
+    # Points needed: one more than the number of parameters
+    num_points = (w > 0).sum(1)
+    num_params = NUM_PKA[model] + NUM_LIMITS[model]
+    if model == "single" and fit_hill:
+        num_params += 1
+    enough = numpy.flatnonzero(num_points > num_params)
+
+    num_pKa, num_limits = NUM_PKA[model], NUM_LIMITS[model]
+    results = {"pKa":numpy.empty((len(y),num_pKa)),
+               "hill":numpy.empty(len(y)),
+               "limits":numpy.empty((len(y),num_limits)),
+               "rss":numpy.empty(len(y))}
+    for r in results.values():
+        r.fill(numpy.nan)
+
+    chunks = [enough[i:i + chunk_rows]
+              for i in range(0,len(enough),chunk_rows)]
+    grid = _coarseGrid(model,pH,fit_hill)
+    args = [(model,y[c],w[c],pH,fit_hill,grid) for c in chunks]
+    STATS.add("curves_fit",len(enough))
+
+    with STATS.stage("fit"):
+        fits = sparky_stats.mapWithStats(_fitChunk,args,jobs,pool)
+
+    for c, fit in zip(chunks,fits):
+        for k in results:
+            results[k][c] = fit[k]
+
+    # Fit quality
+    total = w.sum(1)
+    total[total == 0] = numpy.nan
+    mean = (w*y).sum(1)/total
+    variance = (w*(y - mean[:,numpy.newaxis])**2).sum(1)
+    variance[variance == 0] = numpy.nan
+    results["rmsd"] = numpy.sqrt(results["rss"]/total)
+    results["r2"] = 1 - results["rss"]/variance
+    results["num_points"] = num_points
+
+    return results
+
+
+def resampleWeights(observed,num_replicates,random_state):
+    """
+    Draw num_replicates bootstrap replicates of every curve as index arrays:
+    each row's observed points are resampled with replacement, as many times
+    as the row has observed points.  Returns the number of times each point
+    was drawn (num_replicates x R x P).
+    """
+
+    observed = numpy.asarray(observed,dtype=numpy.bool_)
+    num_rows, num_pH = observed.shape
+    num_observed = observed.sum(1)
+
+    # Columns of each row's observed points come first
+    order = numpy.argsort(numpy.logical_not(observed),axis=1,kind="mergesort")
+
+    draws = random_state.random_sample((num_replicates,num_rows,num_pH))
+    draws = (draws*num_observed[:,numpy.newaxis]).astype(numpy.int64)
+    rows = numpy.arange(num_rows)[numpy.newaxis,:,numpy.newaxis]
+    columns = order[rows,draws]
+    used = numpy.arange(num_pH) < num_observed[:,numpy.newaxis]
+    used = numpy.broadcast_to(used,draws.shape)
+
+    replicate = numpy.arange(num_replicates)[:,numpy.newaxis,numpy.newaxis]
+    flat = ((replicate*num_rows + rows)*num_pH + columns)[used]
+    counts = numpy.bincount(flat,minlength=num_replicates*num_rows*num_pH)
+
+    return counts.reshape((num_replicates,num_rows,num_pH))
+
+def bootstrapCurves(shifts,pH,model="single",observed=None,
+                    replicates=BOOTSTRAP_REPLICATES,seed=BOOTSTRAP_SEED,
+                    level=BOOTSTRAP_LEVEL,fit_hill=True,jobs=1,
+                    batch=BOOTSTRAP_BATCH):
+    """
+    Percentile bootstrap intervals on the fit of every row of shifts.  The
+    replicates are drawn from a random state seeded with seed, batch at a
+    time, and each batch is fit as one stack of weighted curves (across a
+    single pool of jobs processes), so results do not depend on jobs.
+    Returns a dictionary:
+
+        pKa         (R x NUM_PKA x 2) lower and upper bounds of the level %
+                    interval
+        hill        (R x 2) bounds on the Hill coefficient
+        replicates  (R) number of replicates that could be fit
+    """
+
+    shifts = numpy.asarray(shifts,dtype=numpy.float64)
+    present = numpy.logical_not(numpy.isnan(shifts))
+    if observed is not None:
+        present &= numpy.asarray(observed,dtype=numpy.bool_)
+
+    random_state = numpy.random.RandomState(seed)
+    num_rows = len(shifts)
+    pKa = numpy.empty((replicates,num_rows,NUM_PKA[model]))
+    hill = numpy.empty((replicates,num_rows))
+
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs,sparky_stats.initWorker)
+    try:
+        for start in range(0,replicates,batch):
+            num = min(batch,replicates - start)
+            with STATS.stage("resample"):
+                weights = resampleWeights(present,num,random_state)
+                weights = weights.reshape((num*num_rows,-1))
+                stacked = numpy.tile(shifts,(num,1))
+            fit = fitCurves(stacked,pH,model,weights=weights,
+                            fit_hill=fit_hill,pool=pool)
+            pKa[start:start + num] = fit["pKa"].reshape((num,num_rows,-1))
+            hill[start:start + num] = fit["hill"].reshape((num,num_rows))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    STATS.add("bootstrap_replicates",replicates)
+
+    # Percentile intervals over the replicates that could be fit
+    tail = (100.0 - level)/2
+    with STATS.stage("intervals"):
+        # Rows with no fit replicates are nan (nanpercentile warns)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore",RuntimeWarning)
+            pKa_bounds = numpy.nanpercentile(pKa,[tail,100 - tail],axis=0)
+            hill_bounds = numpy.nanpercentile(hill,[tail,100 - tail],axis=0)
+
+    return {"pKa":numpy.rollaxis(pKa_bounds,0,3),
+            "hill":numpy.rollaxis(hill_bounds,0,2),
+            "replicates":numpy.logical_not(numpy.isnan(hill)).sum(0)}
@@ -7,9 +7,16 @@ Reads a set of sparky peak lists, parsing filename to extract experiment pH.
 """
 __author__ = "Michael J. Harms"
 __date__ = "080415"
-__usage__ = "sparky_read-peak-lists.py dir_with_list_files"
+__usage__ = "sparky_read-peak-lists.py [-j JOBS] dir_with_list_files"
 
-import os, sys
+import os, sys, optparse
+import numpy
+import sparky_stats
+from sparky_stats import STATS
+
+# Rows formatted (and written) at a time
+CHUNK_ROWS = 4096
+ROW_FORMAT = "%10i%15s%10.3F%s\n"
 
 class SparkyReadPeakListsError(Exception):
     """
@@ -18,62 +25,143 @@ class SparkyReadPeakListsError(Exception):
 
     pass
 
+def parsePeakFile(peak_file):
+    """
+    Parse a peak file into a list of assignments and an (N x 2) array of their
+    w1 and w2 positions.  Each line is split once and all positions are
+    converted to floats in a single vectorized call.
+    """
+
+    with STATS.stage("read"):
+        f = open(peak_file,'r')
+        lines = f.read().split("\n")
+        f.close()
+
+    # Remove header, comments, and blank lines
+    with STATS.stage("parse"):
+        labels = []
+        values = []
+        for l in lines[1:]:
+            column = l.split()
+            if len(column) == 0 or l[0] == "#":
+                continue
+            if len(column) < 3:
+                err = "Mangled line in %s:\n%s" % (peak_file,l)
+                raise SparkyReadPeakListsError(err)
+            labels.append(column[0])
+            values.append(column[1])
+            values.append(column[2])
+
+        try:
+            positions = numpy.fromstring(" ".join(values),sep=" ")
+            positions = positions.reshape((len(labels),2))
+        except ValueError:
+            err = "%s contains non-numeric positions!" % peak_file
+            raise SparkyReadPeakListsError(err)
+    STATS.add("peaks_parsed",len(labels))
+    STATS.add("files_parsed")
+
+    return labels, positions
+
 def readPeakFile(peak_file):
     """
-    Read the contents of a peak file (assignment, w1, and w2).
+    Read the contents of a peak file (assignment, w1, and w2) into a
+    dictionary of (w1,w2) tuples keyed by assignment.
     """
 
-    print peak_file
+    labels, positions = parsePeakFile(peak_file)
 
-    f = open(peak_file,'r')
-    peaks = f.readlines()
-    f.close()
+    return dict(zip(labels,[tuple(p) for p in positions]))
 
-    # Remove header, comments, and blank lines
-    peaks = [l for l in peaks[1:] if l[0] != "#" and l.strip() != ""]
-    peaks = [(l.split()[0],(float(l.split()[1]),float(l.split()[2])))
-             for l in peaks]
+def readPH(peak_file):
+    """
+    Parse the pH from a file name of style pH_7p01_*.list.
+    """
 
-    return dict(peaks)
+    pH = os.path.basename(peak_file).split("_")[1]
 
-def processPeakFiles(file_list):
+    return float("%s.%s" % tuple(pH.split("p")))
+
+def loadPeakFiles(file_list,jobs=1):
     """
-    Take set of files, extract peaks, sort by pH, then generate R-readable
-    output.
+    Load a set of peak files, parsing them across jobs processes, into one
+    table keyed by assignment and pH.  Returns the sorted assignments, the
+    sorted pH values, and a (assignment x pH x 2) array of w1/w2 positions
+    (nan where an assignment is missing at a pH).  If two files share a pH,
+    the later file is used.
     """
 
-    pH_values = [l.split("_")[1] for l in file_list]
-    pH_values = [float("%s.%s" % tuple(p.split("p"))) for p in pH_values]
+    parsed = sparky_stats.mapWithStats(parsePeakFile,file_list,jobs)
 
-    # Extract data, keyed to pH
-    all_data = zip(pH_values,file_list)
-    all_data = dict([(f[0],readPeakFile(f[1])) for f in all_data])
+    with STATS.stage("assemble"):
 
-    # Grab unique assignments  
-    all_peak_labels = [all_data[p].keys() for p in pH_values]
-    flattened_labels = []
-    for peak_list in all_peak_labels:
-        flattened_labels.extend(peak_list)
-    unique_labels = dict([(l,0) for l in flattened_labels]).keys()
-  
-    unique_labels.sort()  
-    pH_values.sort()
+        # Keep the last file at each pH; columns are sorted by pH
+        pH_values = [readPH(f) for f in file_list]
+        last = dict([(pH,i) for i, pH in enumerate(pH_values)])
+        pH_values = last.keys()
+        pH_values.sort()
+
+        all_labels = []
+        for pH in pH_values:
+            all_labels.extend(parsed[last[pH]][0])
+        labels, rows = numpy.unique(numpy.array(all_labels,dtype=str),
+                                    return_inverse=True)
+        columns = numpy.concatenate([numpy.repeat(c,len(parsed[last[pH]][0]))
+                                     for c, pH in enumerate(pH_values)] +
+                                    [numpy.zeros(0,dtype=int)])
+
+        positions = numpy.empty((len(labels),len(pH_values),2),dtype=float)
+        positions.fill(numpy.nan)
+        if len(rows) > 0:
+            values = numpy.concatenate([parsed[last[pH]][1]
+                                        for pH in pH_values])
+
+            # If an assignment appears twice in one file, use its last entry
+            cell = rows*len(pH_values) + columns
+            keep = len(cell) - 1 - numpy.unique(cell[::-1],return_index=True)[1]
+            positions.reshape((-1,2))[cell[keep]] = values[keep]
+
+    return [str(l) for l in labels], pH_values, positions
+
+def iterTable(file_list,labels,pH_values,positions,chunk_rows=CHUNK_ROWS):
+    """
+    Generate an R-readable table of the peaks loaded by loadPeakFiles, in
+    chunks of up to chunk_rows rows.
+    """
 
-    i = 0
     out = ["# Taken from data in:\n"]
     out.extend(["#   %s\n" % f for f in file_list])
     out.append("%10s%15s%10s%10s%10s\n" % ("  ","peak","pH","w1","w2"))
-    for peak in unique_labels:
-        for pH in pH_values:
-            try:
-                out.append("%10i%15s%10.3F%s\n" % \
-                           (i,peak,pH,"%10.3F%10.3F" % all_data[pH][peak]))
-            except KeyError:
-                out.append("%10i%15s%10.3F%10s%10s\n" % (i,peak,pH,"NA","NA"))
+    yield "".join(out)
 
+    missing = "%10s%10s" % ("NA","NA")
+    i = 0
+    row_args = []
+    for r, peak in enumerate(labels):
+        for c, pH in enumerate(pH_values):
+            w1, w2 = positions[r,c]
+            if w1 == w1:
+                row_args.extend((i,peak,pH,"%10.3F%10.3F" % (w1,w2)))
+            else:
+                row_args.extend((i,peak,pH,missing))
             i += 1
-    
-    return "".join(out)    
+
+        if len(row_args) >= 4*chunk_rows:
+            yield ROW_FORMAT*(len(row_args)/4) % tuple(row_args)
+            row_args = []
+
+    if row_args:
+        yield ROW_FORMAT*(len(row_args)/4) % tuple(row_args)
+
+def processPeakFiles(file_list,jobs=1):
+    """
+    Take set of files, extract peaks, sort by pH, then generate R-readable
+    output.
+    """
+
+    labels, pH_values, positions = loadPeakFiles(file_list,jobs)
+
+    return "".join(iterTable(file_list,labels,pH_values,positions))
 
 
 
@@ -82,8 +170,13 @@ def main():
     Function called if run from command line.
     """
 
+    parser = optparse.OptionParser(usage=__usage__)
+    parser.add_option("-j","--jobs",type="int",default=1,
+                      help="number of processes used to parse files")
+    options, args = parser.parse_args()
+
     try:
-        inp_dir = sys.argv[1]
+        inp_dir = args[0]
     except IndexError:
         print __usage__
         sys.exit()    
@@ -100,8 +193,10 @@ def main():
         raise SparkyReadPeakListsError(err)
 
     
-    out = processPeakFiles(file_list)
-    print out,
+    labels, pH_values, positions = loadPeakFiles(file_list,options.jobs)
+    with STATS.stage("output"):
+        for chunk in iterTable(file_list,labels,pH_values,positions):
+            sys.stdout.write(chunk)
 
 if __name__ == "__main__":
-    main()
+    sparky_stats.run(main)
@@ -8,9 +8,11 @@ Rename peaks in Sparky .save files using rules specified in input file.
 
 __author__ = "Michael J. Harms"
 __date__ = "080409"
-__usage__ = "sparky_rename-peaks.py peak-rules $1.save $2.save ... $n.save"
+__usage__ = "sparky_rename-peaks.py peak-rules $1.save ... $n.save (or dirs)"
 
-import os, sys, shutil
+import os, sys, re
+import sparky_classes, sparky_edit, sparky_stats
+from sparky_stats import STATS
 
 class SparkyRenamePeaksError(Exception):
     """
@@ -19,16 +21,96 @@ class SparkyRenamePeaksError(Exception):
 
     pass
 
+class PeakRules:
+    """
+    A compiled set of peak renaming rules.  Exact rules are held in a hash,
+    pattern rules are precompiled regular expressions, and offset rules shift
+    residue numbers.  Exact rules are tried first, then pattern rules and
+    offset rules in the order given.  The result for each peak name is
+    remembered, so every distinct name is only matched once.
+    """
+
+    # Peak names are residue name followed by residue number (e.g. ASN2)
+    name_pattern = re.compile(r"^([A-Za-z]+)(-?\d+)(.*)$")
+
+    def __init__(self,exact=None,patterns=None,offsets=None):
+        """
+        exact maps old names to new names, patterns is a list of (regex,
+        replacement) pairs, and offsets is a list of (shift,first,last)
+        tuples (first/last may be None for an open range).
+        """
+
+        if exact is None:
+            exact = {}
+        if patterns is None:
+            patterns = []
+        if offsets is None:
+            offsets = []
+
+        self.exact = dict(exact)
+        self.patterns = [(re.compile(p),r) for p, r in patterns]
+        self.offsets = list(offsets)
+        self._seen = {}
+
+    def __len__(self):
+        """
+        Number of rules.
+        """
+
+        return len(self.exact) + len(self.patterns) + len(self.offsets)
+
+    def rename(self,peak_name):
+        """
+        Return the new name of peak_name, or None if no rule applies.
+        """
+
+        try:
+            return self._seen[peak_name]
+        except KeyError:
+            pass
+
+        new_name = self.exact.get(peak_name)
+
+        if new_name is None:
+            for pattern, replacement in self.patterns:
+                if pattern.search(peak_name):
+                    new_name = pattern.sub(replacement,peak_name)
+                    break
+
+        if new_name is None and self.offsets:
+            m = self.name_pattern.match(peak_name)
+            if m is not None:
+                res_num = int(m.group(2))
+                for shift, first, last in self.offsets:
+                    if (first is None or res_num >= first) and \
+                       (last is None or res_num <= last):
+                        new_name = "%s%i%s" % (m.group(1),res_num + shift,
+                                               m.group(3))
+                        break
+
+        if new_name == peak_name:
+            new_name = None
+        self._seen[peak_name] = new_name
+
+        return new_name
+
+
 def readPeakRules(peak_rules_file):
     """
     Read in peak rules file of format:
    
     old_peak1-->new_peak1
     old_peak2-->new_peak2
+    re:PATTERN-->REPLACEMENT
+    offset +3
+    offset -2 10 50
     ...
 
-    Comment lines (#) and blank lines are ignored.  It is assumed that peak
-    names do not have "-->" or spaces in them.
+    "re:" rules are python regular expressions; REPLACEMENT may use groups
+    (\1).  "offset" rules shift residue numbers, optionally only from residue
+    first to last.  Comment lines (#) and blank lines are ignored.  It is
+    assumed that peak names do not have "-->" or spaces in them.  Returns a
+    PeakRules instance.
     """ 
 
     f = open(peak_rules_file,'r')
@@ -37,78 +119,133 @@ def readPeakRules(peak_rules_file):
    
     peak_rules = [l for l in peak_rules if l[0] != "#" and l.strip() != ""] 
     
+    exact = {}
+    patterns = []
+    offsets = []
+    for l in peak_rules:
+        try:
+            if l[0:7] == "offset ":
+                column = l.split()
+                shift = int(column[1])
+                if len(column) == 2:
+                    offsets.append((shift,None,None))
+                elif len(column) == 4:
+                    offsets.append((shift,int(column[2]),int(column[3])))
+                else:
+                    raise ValueError
+                continue
+
+            column = l.split("-->")
+            if len(column) != 2:
+                raise ValueError
+            if l[0:3] == "re:":
+                patterns.append((column[0][3:].strip(),column[1].strip()))
+            else:
+                exact[column[0].strip()] = column[1].strip()
+        except (ValueError,IndexError):
+            err = "%s contains mangled data!\n%s" % (peak_rules_file,l)
+            raise SparkyRenamePeaksError(err)
+
     try:
-        peak_dict = [l.split("-->") for l in peak_rules]
-        peak_dict = dict([(x[0].strip(),x[1].strip()) for x in peak_dict])
-    except:
-        err = "%s contains mangled data!" % peak_rules_file
+        rules = PeakRules(exact,patterns,offsets)
+    except re.error, e:
+        err = "%s contains a bad pattern (%s)!" % (peak_rules_file,e)
         raise SparkyRenamePeaksError(err)
 
-    return peak_dict
+    return rules
 
-def convertSparkyFile(sparky_file,peak_dict):
+def renameRsLine(line,rules):
     """
-    Rename peaks in sparky_file using rules in peak_dict. 
+    Rename the peaks on an "rs" line using rules (a PeakRules instance).
+    Every dimension's residue group (every third column) is renamed.  Returns
+    the new line, or None if the line is unchanged.
     """
 
-    # Copy sparky_file to backup file and read data
-    f = open(sparky_file,'r')
-    sparky = f.readlines()
-    f.close()
-
-    # Alter relevant lines
-    peak_keys = peak_dict.keys()
-    for line_number, line in enumerate(sparky):
-
-        # Alter "rs" entries
-        if line[0:3] == "rs ":
-            column = line[4:].split("|")
+    column = line[4:].split("|")
             
-            altered = False
-            if column[0] in peak_keys:
-                column[0] = peak_dict[column[0]]
-                altered = True
-            if column[3] in peak_keys:
-                column[3] = peak_dict[column[3]]
-                altered = True
+    altered = False
+    for i in range(0,len(column) - 1,3):
+        new_name = rules.rename(column[i])
+        if new_name is not None:
+            column[i] = new_name
+            altered = True
            
-            if altered:
-                new_line = ["|%s" % c for c in column]
-                new_line = "rs %s" % ("".join(new_line))
-                sparky[line_number] = new_line
+    if not altered:
+        return None
 
-        # Alter "label" entries
-        possible_atoms = ["N-HN","NE1-HE1","N"]
-        if line[0:6] == "label ":
-          
-            # Try to separate atoms from actual peak label 
-            atoms_index = 0
-            success = False
-            while not success and atoms_index <= len(possible_atoms):
-                try:
-                    atoms = possible_atoms[atoms_index]
-                    peak_name = line[6:line.index(atoms)]
-                    success = True
-                except ValueError:
-                    atoms_index += 1
-                except IndexError:
-                    err = "Error parsing line!:\n%s" % line
-                    raise SparkyRenamePeaksError(err)
-
- 
-            if not success:
-                err = "Atoms on line: \"%s\" not recognized!" % line
-                raise SparkyRenamePeaksError(err)            
-    
-            if peak_name in peak_keys:
-                peak_name = peak_dict[peak_name]
-                new_line = "label %s%s\n" % (peak_name,atoms)
+    new_line = ["|%s" % c for c in column]
+
+    return "rs %s" % ("".join(new_line))
+
+
+def renameLabelLine(line,rules):
+    """
+    Rename the peak on a "label" line using rules (a PeakRules instance).
+    Only the residue group is renamed; the atoms are kept as they are.
+    Returns the new line, or None if the line is unchanged (including labels
+    that do not start with a residue group).
+    """
+
+    label = sparky_classes.splitLabel(line[6:].rstrip())
+    if label is None:
+        return None
+
+    group, atoms = label
+    new_name = rules.rename(group)
+    if new_name is None:
+        return None
+
+    return "label %s%s\n" % (new_name,atoms)
+
+
+def renameLines(sparky,rules):
+    """
+    Rename peaks in sparky (the lines of a sparky .save file) using rules (a
+    PeakRules instance).  The lines are altered in place.  Returns the number
+    of lines that were changed.
+    """
+
+    num_altered = 0
+
+    with STATS.stage("edit"):
+        for line_number, line in enumerate(sparky):
+
+            # Alter "rs" and "label" entries
+            if line[0:3] == "rs ":
+                new_line = renameRsLine(line,rules)
+            elif line[0:6] == "label ":
+                new_line = renameLabelLine(line,rules)
+            else:
+                continue
+
+            if new_line is not None:
                 sparky[line_number] = new_line
+                num_altered += 1
+
+    return num_altered
+
+
+def convertSparkyFile(sparky_file,rules):
+    """
+    Rename peaks in sparky_file using rules (a PeakRules instance) in a single
+    pass over the file.  Only the "rs" and "label" lines are decoded; the
+    changes are written with an atomic, locked edit (see sparky_edit).
+    """
+
+    editor = sparky_edit.SparkyEditor(sparky_file)
+    try:
+        with STATS.stage("edit"):
+            for start, end, line in editor.findLines(("rs ","label ")):
+                if line[0:3] == "rs ":
+                    new_line = renameRsLine(line,rules)
+                else:
+                    new_line = renameLabelLine(line,rules)
+                if new_line is not None:
+                    editor.replace(start,end,new_line)
 
-    # Write output
-    g = open(sparky_file,'w')
-    g.writelines(sparky)
-    g.close()
+        editor.commit()
+    finally:
+        editor.close()
 
 
 def main():
@@ -117,29 +254,34 @@ def main():
     """
 
     # Parse command line
-    try:
-        peak_rules_file = sys.argv[1]
-        sparky_files = sys.argv[2:]
-    except IndexError:
+    if len(sys.argv) < 3:
         print __usage__
         sys.exit()
+    peak_rules_file = sys.argv[1]
 
     # Read in peak conversion rules
-    peak_dict = readPeakRules(peak_rules_file)
+    rules = readPeakRules(peak_rules_file)
    
-    # Make sure that sparky files exist 
-    file_check = [os.path.isfile(f) for f in sparky_files]
-    if False in file_check:
-        print "Not all specified sparky save files exist!"
-        sys.exit()
+    # Make sure that sparky files exist; directories are replaced by the
+    # .save files they contain
+    sparky_files = []
+    for f in sys.argv[2:]:
+        if os.path.isdir(f):
+            sparky_files.extend([os.path.join(f,s) for s in os.listdir(f)
+                                 if s[-5:] == ".save"])
+        elif os.path.isfile(f):
+            sparky_files.append(f)
+        else:
+            print "Not all specified sparky save files exist!"
+            sys.exit()
    
     sparky_files.sort() 
     for sparky_file in sparky_files:
         print sparky_file
-        convertSparkyFile(sparky_file,peak_dict)    
+        convertSparkyFile(sparky_file,rules)    
         
 
 
 
 if __name__ == "__main__":
-    main()
+    sparky_stats.run(main)
@@ -0,0 +1,407 @@
+__description__ = \
+"""
+A small selector language for picking peaks out of a PeakTable.  A selector is
+compiled once and then evaluated against any number of tables as a vectorized
+boolean mask (one entry per peak).  Terms:
+
+    name HIS3,PRO5        peaks assigned to these residues
+    res 10-20,25          residue numbers (ranges are inclusive)
+    aa GLY,PRO            amino acid types
+    atom N,HN             atom names
+    ppm 7.5-9.0           positions in ppm
+    height < 1e5          height (also <=, >, >=)
+    integral < 1e6        integral (peaks without an integral never match)
+    labeled / unlabeled   assigned or unassigned peaks
+    all                   every peak
+
+Any term except labeled/unlabeled/all may name a dimension (e.g. ppm.w2,
+res.w1); without one a peak matches if any dimension matches.  Terms combine
+with "and", "or", "not", and parentheses:
+
+    unlabeled and height < 5e4
+    res 1-10 or (aa GLY and ppm.w1 100-106)
+
+Assignment terms never match unlabeled peaks.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080508"
+
+import re
+import numpy
+
+class SparkySelectError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+_token_pattern = re.compile(r"\(|\)|<=|>=|<|>|[^\s()<>]+")
+_range_pattern = re.compile(r"^(-?\d+)(?:-(-?\d+))?$")
+_ppm_pattern = re.compile(r"^(-?[\d.]+(?:e-?\d+)?)-(-?[\d.]+(?:e-?\d+)?)$")
+
+_list_fields = ["name","res","aa","atom","ppm"]
+_compare_fields = ["height","integral"]
+_operators = {"<":numpy.less,"<=":numpy.less_equal,">":numpy.greater,
+              ">=":numpy.greater_equal}
+
+class Selector:
+    """
+    A compiled selector expression.
+    """
+
+    def __init__(self,expression,function):
+        """
+        Wrap function (which maps a PeakTable to a boolean mask).
+        """
+
+        self.expression = expression
+        self._function = function
+
+    def __repr__(self):
+        return "Selector(%r)" % self.expression
+
+    def mask(self,table):
+        """
+        Return a boolean array, True for each peak in table that is selected.
+        """
+
+        if len(table) == 0:
+            return numpy.zeros(0,dtype=numpy.bool_)
+
+        return numpy.asarray(self._function(table),dtype=numpy.bool_)
+
+    def select(self,table):
+        """
+        Return a new PeakTable holding only the selected peaks.
+        """
+
+        return table.select(self.mask(table))
+
+
+def _dims(table,dim):
+    """
+    The dimensions a term applies to.
+    """
+
+    if dim is None:
+        return range(table.dimension)
+    if dim >= table.dimension:
+        err = "Dimension w%i does not exist in a %iD experiment!" % \
+              (dim + 1,table.dimension)
+        raise SparkySelectError(err)
+
+    return [dim]
+
+def _anyDim(table,dim,term):
+    """
+    OR term(table,d) over the dimensions selected by dim.
+    """
+
+    mask = numpy.zeros(len(table),dtype=numpy.bool_)
+    for d in _dims(table,dim):
+        mask |= term(table,d)
+
+    return mask
+
+def _residueKey(name):
+    """
+    Split a residue name (e.g. HIS3) into (aa,res_num) the way the residue
+    groups of "rs" lines are split (see sparky_classes.SparkyPeak).  Returns
+    None if name is not exactly such a group, so it could never match one.
+    """
+
+    try:
+        key = (name[0:3],int(name[3:]))
+    except ValueError:
+        return None
+    if "%s%i" % key != name:
+        return None
+
+    return key
+
+def _nameTerm(names,found=None):
+    """
+    Term matching peaks assigned to residues in names (e.g. HIS3).  Names
+    that match a peak are added to found, if given.
+    """
+
+    wanted = [(_residueKey(n),n) for n in names]
+    wanted = [(k,n) for k, n in wanted if k is not None]
+
+    def term(table,d):
+        lookup = dict([(a,i) for i, a in enumerate(table.aa_names)])
+        keys = [((lookup[k[0]],k[1]),n) for k, n in wanted if k[0] in lookup]
+        if len(keys) == 0 or len(table) == 0:
+            return numpy.zeros(len(table),dtype=numpy.bool_)
+
+        # Encode (aa,res_num) pairs as single integers to compare in one pass
+        res_num = [k[0][1] for k in keys]
+        offset = int(min(table.res_num[:,d].min(),min(res_num)))
+        width = int(max(table.res_num[:,d].max(),max(res_num)))
+        width = width - offset + 1
+        codes = table.aa[:,d].astype(numpy.int64)*width + \
+                (table.res_num[:,d] - offset)
+        key_codes = numpy.array([a*width + (r - offset) for (a, r), n in keys],
+                                dtype=numpy.int64)
+
+        mask = table.labeled & numpy.in1d(codes,key_codes)
+        if found is not None:
+            hit = numpy.in1d(key_codes,codes[mask])
+            found.update([n for (k, n), h in zip(keys,hit) if h])
+
+        return mask
+
+    return term
+
+def _resTerm(values):
+    """
+    Term matching residue numbers in a list of ranges.
+    """
+
+    ranges = []
+    for v in values:
+        m = _range_pattern.match(v)
+        if m is None:
+            err = "\"%s\" is not a residue range!" % v
+            raise SparkySelectError(err)
+        first = int(m.group(1))
+        last = first
+        if m.group(2) is not None:
+            last = int(m.group(2))
+        ranges.append((first,last))
+
+    def term(table,d):
+        mask = numpy.zeros(len(table),dtype=numpy.bool_)
+        for first, last in ranges:
+            mask |= table.residueMask(first,last,d)
+        return mask
+
+    return term
+
+def _ppmTerm(values):
+    """
+    Term matching positions in a list of ppm windows.
+    """
+
+    windows = []
+    for v in values:
+        m = _ppm_pattern.match(v)
+        try:
+            low, high = float(m.group(1)), float(m.group(2))
+        except (AttributeError,ValueError):
+            err = "\"%s\" is not a ppm window!" % v
+            raise SparkySelectError(err)
+        windows.append((min(low,high),max(low,high)))
+
+    def term(table,d):
+        mask = numpy.zeros(len(table),dtype=numpy.bool_)
+        for low, high in windows:
+            mask |= table.ppmMask(low,high,d)
+        return mask
+
+    return term
+
+def _listTerm(field,values,dim):
+    """
+    Compile a "field[.wN] value,value,..." term.
+    """
+
+    values = [v for v in values.split(",") if v != ""]
+    if len(values) == 0:
+        err = "No values given for \"%s\"!" % field
+        raise SparkySelectError(err)
+
+    if field == "name":
+        for v in values:
+            if _residueKey(v) is None:
+                err = "\"%s\" is not a residue name!" % v
+                raise SparkySelectError(err)
+        term = _nameTerm(values)
+    elif field == "res":
+        term = _resTerm(values)
+    elif field == "aa":
+        term = lambda table, d: table.aaMask(values,d)
+    elif field == "atom":
+        term = lambda table, d: table.atomMask(values,d)
+    else:
+        term = _ppmTerm(values)
+
+    return lambda table: _anyDim(table,dim,term)
+
+def _compareTerm(field,operator,value):
+    """
+    Compile a "field OP value" term.
+    """
+
+    try:
+        value = float(value)
+    except ValueError:
+        err = "\"%s\" is not a number!" % value
+        raise SparkySelectError(err)
+    op = _operators[operator]
+
+    def term(table):
+        column = getattr(table,field)
+        mask = numpy.zeros(len(table),dtype=numpy.bool_)
+        present = numpy.logical_not(numpy.isnan(column))
+        mask[present] = op(column[present],value)
+        return mask
+
+    return term
+
+
+class _Parser:
+    """
+    Recursive descent parser turning a token list into a mask function.
+    """
+
+    def __init__(self,expression):
+        self.expression = expression
+        self.tokens = _token_pattern.findall(expression)
+        self.i = 0
+
+    def _error(self,message):
+        err = "%s in selector \"%s\"!" % (message,self.expression)
+        raise SparkySelectError(err)
+
+    def _peek(self):
+        if self.i < len(self.tokens):
+            return self.tokens[self.i]
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            self._error("Unexpected end")
+        self.i += 1
+        return token
+
+    def parse(self):
+        if len(self.tokens) == 0:
+            self._error("Empty expression")
+        function = self._or()
+        if self._peek() is not None:
+            self._error("Unexpected \"%s\"" % self._peek())
+        return function
+
+    def _or(self):
+        terms = [self._and()]
+        while self._peek() == "or":
+            self._next()
+            terms.append(self._and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda table: reduce(numpy.logical_or,[t(table) for t in terms])
+
+    def _and(self):
+        terms = [self._not()]
+        while self._peek() == "and":
+            self._next()
+            terms.append(self._not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda table: reduce(numpy.logical_and,[t(table) for t in terms])
+
+    def _not(self):
+        token = self._next()
+        if token == "not":
+            term = self._not()
+            return lambda table: numpy.logical_not(term(table))
+        if token == "(":
+            term = self._or()
+            if self._next() != ")":
+                self._error("Missing \")\"")
+            return term
+        return self._term(token)
+
+    def _term(self,token):
+        if token == "labeled":
+            return lambda table: table.labeled.copy()
+        if token == "unlabeled":
+            return lambda table: numpy.logical_not(table.labeled)
+        if token == "all":
+            return lambda table: numpy.ones(len(table),dtype=numpy.bool_)
+
+        field, dim = token, None
+        if "." in token:
+            field, suffix = token.split(".",1)
+            if suffix[0:1] != "w" or not suffix[1:].isdigit() or \
+               int(suffix[1:]) < 1:
+                self._error("Bad dimension \"%s\"" % suffix)
+            dim = int(suffix[1:]) - 1
+
+        if field in _list_fields:
+            return _listTerm(field,self._next(),dim)
+        if field in _compare_fields:
+            if dim is not None:
+                self._error("\"%s\" has no dimensions" % field)
+            operator = self._next()
+            if operator not in _operators:
+                self._error("Expected comparison after \"%s\"" % field)
+            return _compareTerm(field,operator,self._next())
+
+        self._error("Unknown term \"%s\"" % token)
+
+
+def compileSelector(expression):
+    """
+    Compile a selector expression into a Selector.
+    """
+
+    return Selector(expression,_Parser(expression).parse())
+
+class NameSelector(Selector):
+    """
+    Selector matching peaks whose w1 or w2 residue is one of a list of names
+    (e.g. ["HIS3"]).  groupMask compares the names with the residue groups
+    exactly as written on the "rs" lines, as peak lists have always been
+    matched, so any name (e.g. G7) can match.  mask evaluates the names
+    against a PeakTable, where only residue names can match.  The names that
+    have matched a peak so far are remembered.
+    """
+
+    def __init__(self,names):
+        """
+        Compile the list of names.
+        """
+
+        self.names = list(names)
+        self.found = set()
+        term = _nameTerm(self.names,self.found)
+        Selector.__init__(self,"name %s" % ",".join(self.names),
+                          lambda table: term(table,0) | term(table,1))
+
+    def groupMask(self,groups):
+        """
+        Return a boolean array, True for each peak whose w1 or w2 group in
+        groups (an N x dimension array of "rs" line groups, e.g. from
+        sparky_classes.SparkySaveIndex.residueGroups) is one of the names.
+        """
+
+        groups = numpy.asarray(groups,dtype=str)
+        mask = numpy.zeros(len(groups),dtype=numpy.bool_)
+        if len(groups) == 0 or len(self.names) == 0:
+            return mask
+
+        names = numpy.array(self.names,dtype=str)
+        for d in range(min(groups.shape[1],2)):
+            hit = numpy.in1d(groups[:,d],names)
+            self.found.update(groups[hit,d])
+            mask |= hit
+
+        return mask
+
+    def unmatched(self):
+        """
+        Names that have not matched a peak in any table masked so far.
+        """
+
+        return [n for n in self.names if n not in self.found]
+
+
+def nameSelector(names):
+    """
+    Return a NameSelector for the residues in names (e.g. ["HIS3"]).
+    """
+
+    return NameSelector(names)
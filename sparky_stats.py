@@ -0,0 +1,247 @@
+__description__ = \
+"""
+Stage-level timing and counters shared by sparky_classes and the sparky_*.py
+scripts.  Code marks stages with
+
+    with STATS.stage("read"):
+        ...
+
+and bumps counters with STATS.add("peaks_parsed",n).  Both are no-ops unless
+STATS.enabled is set, which the scripts do when given --stats.  Scripts hand
+their main() to run(), which strips the flags below from sys.argv, runs main,
+and writes the report to stderr:
+
+    --stats          human-readable report
+    --stats=json     JSON report
+    --profile=FILE   also run under cProfile, writing the profile to FILE
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080502"
+
+import sys, time, multiprocessing
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class _NullStage:
+    """
+    Stage used when stats are disabled.
+    """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self,*args):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    """
+    Context manager that adds its wall time to a stage of a SparkyStats.
+    """
+
+    def __init__(self,stats,name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self,*args):
+        self.stats.addTime(self.name,time.time() - self.start)
+        return False
+
+class SparkyStats:
+    """
+    Accumulates wall time per stage and named counters.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty, disabled set of stats.
+        """
+
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        """
+        Discard all recorded times and counters.
+        """
+
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self._order = []
+
+    def stage(self,name):
+        """
+        Return a context manager that times a stage.
+        """
+
+        if not self.enabled:
+            return _NULL_STAGE
+
+        return _Stage(self,name)
+
+    def addTime(self,name,seconds,calls=1):
+        """
+        Add seconds to stage name.
+        """
+
+        if name not in self.times:
+            self.times[name] = 0.0
+            self.calls[name] = 0
+            self._order.append(name)
+        self.times[name] += seconds
+        self.calls[name] += calls
+
+    def add(self,counter,value=1):
+        """
+        Add value to counter.
+        """
+
+        if self.enabled:
+            self.counters[counter] = self.counters.get(counter,0) + value
+
+    def collect(self):
+        """
+        Return the recorded stats as a dictionary and reset them (used to ship
+        stats back from worker processes).
+        """
+
+        data = {"stages":[(n,self.times[n],self.calls[n]) for n in self._order],
+                "counters":self.counters}
+        self.reset()
+
+        return data
+
+    def merge(self,data):
+        """
+        Add stats returned by collect() to this instance.
+        """
+
+        for name, seconds, calls in data["stages"]:
+            self.addTime(name,seconds,calls)
+        for counter, value in data["counters"].items():
+            self.counters[counter] = self.counters.get(counter,0) + value
+
+    def report(self,format="human"):
+        """
+        Return the recorded stats as a human-readable table or JSON.
+        """
+
+        if format == "json":
+            stages = dict([(n,{"time":self.times[n],"calls":self.calls[n]})
+                           for n in self._order])
+            return json.dumps({"stages":stages,"counters":self.counters},
+                              indent=1,sort_keys=True) + "\n"
+
+        out = ["%-24s%12s%10s\n" % ("stage","time (s)","calls")]
+        out.extend(["%-24s%12.4f%10i\n" % (n,self.times[n],self.calls[n])
+                    for n in self._order])
+        out.append("%-24s%12.4f\n" % ("total",sum(self.times.values())))
+        if self.counters:
+            out.append("\n%-24s%12s\n" % ("counter","value"))
+            counters = self.counters.keys()
+            counters.sort()
+            out.extend(["%-24s%12i\n" % (c,self.counters[c]) for c in counters])
+
+        return "".join(out)
+
+# Stats shared by all modules
+STATS = SparkyStats()
+
+def initWorker():
+    """
+    Pool initializer: clear the stats a forked worker inherits from its
+    parent, so collect() only ships back the worker's own.
+    """
+
+    STATS.reset()
+
+def _statsWorker(args):
+    """
+    Apply a function to one item in a worker process, shipping its stats back
+    along with the result.
+    """
+
+    function, item = args
+    result = function(item)
+
+    return result, STATS.collect()
+
+def mapWithStats(function,items,jobs=1,pool=None):
+    """
+    Apply function to each of items, returning the results in order.  If
+    jobs > 1 (or a pool started with initWorker is given), the items are
+    processed across a pool of worker processes and the stats recorded in
+    each worker are merged into STATS.  function must be picklable (defined
+    at module level).
+    """
+
+    items = list(items)
+    if pool is None and min(jobs,len(items)) <= 1:
+        return [function(i) for i in items]
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(min(jobs,len(items)),initWorker)
+    try:
+        results = pool.map(_statsWorker,[(function,i) for i in items],
+                           chunksize=1)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    for result, stats in results:
+        STATS.merge(stats)
+
+    return [r[0] for r in results]
+
+
+def run(main_function):
+    """
+    Strip --stats and --profile from sys.argv, call main_function, and write
+    the requested stats to stderr.
+    """
+
+    format = None
+    profile_file = None
+    argv = [sys.argv[0]]
+    args = sys.argv[1:]
+    while args:
+        a = args.pop(0)
+        if a == "--stats":
+            format = "human"
+        elif a[0:8] == "--stats=":
+            format = a[8:]
+        elif a == "--profile" and args:
+            profile_file = args.pop(0)
+        elif a[0:10] == "--profile=":
+            profile_file = a[10:]
+        else:
+            argv.append(a)
+    sys.argv[:] = argv
+
+    if format not in (None,"human","json"):
+        print >> sys.stderr, "--stats must be \"human\" or \"json\""
+        sys.exit(1)
+    STATS.enabled = format is not None
+
+    try:
+        if profile_file is None:
+            main_function()
+        else:
+            import cProfile
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(main_function)
+            finally:
+                profile.dump_stats(profile_file)
+    finally:
+        if STATS.enabled:
+            sys.stderr.write(STATS.report(format))
@@ -0,0 +1,343 @@
+__description__ = \
+"""
+Dense (peak x pH) matrices of a titration.  Each labeled peak is keyed by
+residue number, amino acid, and atoms; keys are mapped to row indexes and pH
+values to column indexes with integer arrays, so a titration is assembled in
+one vectorized pass over all of its peaks rather than by dictionary lookups
+for every (peak,pH) pair.  Missing peaks are nan (and False in the observed
+mask).  The matrices can be written as the classic long R table (one row per
+peak and pH), a wide R table (one row per peak), or a numpy .npz bundle, which
+loadArrays reads back.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080509"
+
+import os
+import numpy
+from sparky_stats import STATS
+
+class SparkyTitrationError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+# Rows formatted (and written) at a time
+CHUNK_ROWS = 4096
+
+_LONG_ROW = "%10i%10i%10s%10s%10.3F%s\n"
+_MISSING = "%10s%10s%10s%10s%30s" % ("NA","NA","NA","NA","NA")
+_MATRICES = ["w1","w2","height","volume"]
+
+class TitrationMatrix:
+    """
+    Peaks of a titration as dense matrices.  Row r holds the peak assigned to
+    (residue[r],aa[r],atoms[r]) and column c the experiment at pH[c]:
+
+        w1, w2     (R x P)  peak position (nan if not observed)
+        height     (R x P)  peak height (nan if not observed)
+        volume     (R x P)  peak integral (nan if not observed or integrated)
+        note       (R x P)  peak note without quotes (None if absent)
+        observed   (R x P)  whether the peak was seen at that pH
+
+    Rows are sorted by residue number, then amino acid and atoms.
+    """
+
+    def __init__(self,residue,aa,atoms,pH,matrices,note,observed):
+        """
+        Initialize from row keys, pH values, a dictionary of the float
+        matrices, and the note and observed matrices.
+        """
+
+        self.residue = residue
+        self.aa = aa
+        self.atoms = atoms
+        self.pH = pH
+        for m in _MATRICES:
+            setattr(self,m,matrices[m])
+        self.note = note
+        self.observed = observed
+
+    def __len__(self):
+        """
+        Number of peaks (rows).
+        """
+
+        return len(self.residue)
+
+    def _header(self,data_dir,sparky_files):
+        """
+        Comment lines naming the source of the data.
+        """
+
+        header = ["# Taken from data in: %s\n" % data_dir]
+        header.extend(["#   %s\n" % f for f in sparky_files])
+
+        return header
+
+    def iterLong(self,data_dir,sparky_files,chunk_rows=CHUNK_ROWS):
+        """
+        Generate the long R table (one row for every peak at every pH, NA where
+        the peak was not observed) in chunks of up to chunk_rows rows.
+        """
+
+        header = self._header(data_dir,sparky_files)
+        header.append("%10s%10s%10s%10s%10s%10s%10s%10s%10s%30s\n" % \
+           (" ","residue","aa","atoms","pH","w1","w2","height","volume","note"))
+        yield "".join(header)
+
+        num_pH = len(self.pH)
+        row_args = []
+        for r in range(len(self)):
+            residue, aa, atoms = self.residue[r], self.aa[r], self.atoms[r]
+            for c in range(num_pH):
+                if self.observed[r,c]:
+                    data = _formatPeak(self.w1[r,c],self.w2[r,c],
+                                       self.height[r,c],self.volume[r,c],
+                                       self.note[r,c])
+                else:
+                    data = _MISSING
+                row_args.extend((r*num_pH + c,residue,aa,atoms,self.pH[c],
+                                 data))
+
+            # Format each chunk with a single % operation
+            if len(row_args) >= 6*chunk_rows:
+                yield _LONG_ROW*(len(row_args)/6) % tuple(row_args)
+                row_args = []
+
+        if row_args:
+            yield _LONG_ROW*(len(row_args)/6) % tuple(row_args)
+
+    def iterWide(self,data_dir,sparky_files,chunk_rows=CHUNK_ROWS):
+        """
+        Generate the wide R table (one row per peak, with w1, w2, height, and
+        volume columns for each pH) in chunks of up to chunk_rows rows.  Notes
+        are only written in the long table.
+        """
+
+        header = self._header(data_dir,sparky_files)
+        columns = ["%14s" % ("%s_%.3F" % (m,p))
+                   for p in self.pH for m in _MATRICES]
+        header.append("%10s%10s%10s%10s%s\n" % \
+                      (" ","residue","aa","atoms","".join(columns)))
+        yield "".join(header)
+
+        value_format = {"w1":"%14.3F","w2":"%14.3F","height":"%14.2E",
+                        "volume":"%14.2E"}
+        formats = [value_format[m] for p in self.pH for m in _MATRICES]
+        matrices = [getattr(self,m) for m in _MATRICES]
+
+        out = []
+        for r in range(len(self)):
+            values = [matrices[j][r,c] for c in range(len(self.pH))
+                      for j in range(len(_MATRICES))]
+            values = [v == v and f % v or "%14s" % "NA"
+                      for f, v in zip(formats,values)]
+            out.append("%10i%10i%10s%10s%s\n" % \
+                       (r,self.residue[r],self.aa[r],self.atoms[r],
+                        "".join(values)))
+
+            if len(out) >= chunk_rows:
+                yield "".join(out)
+                out = []
+
+        if out:
+            yield "".join(out)
+
+    def arrays(self):
+        """
+        Return the matrices as a dictionary of plain arrays for numpy.savez.
+        Missing notes are "".
+        """
+
+        arrays = dict([(m,getattr(self,m)) for m in _MATRICES])
+        arrays["residue"] = self.residue
+        arrays["aa"] = self.aa
+        arrays["atoms"] = self.atoms
+        arrays["pH"] = self.pH
+        arrays["observed"] = self.observed
+        note = [[n or "" for n in row] for row in self.note]
+        arrays["note"] = numpy.array(note,dtype=str).reshape(self.note.shape)
+
+        return arrays
+
+
+def loadArrays(npz_file):
+    """
+    Load a TitrationMatrix from a .npz bundle of TitrationMatrix.arrays (as
+    written by sparky_extract-peaks.py -f npz -l wide).
+    """
+
+    try:
+        data = numpy.load(npz_file)
+        try:
+            matrices = dict([(m,data[m]) for m in _MATRICES])
+            residue, aa, atoms = data["residue"], data["aa"], data["atoms"]
+            pH, observed, note = data["pH"], data["observed"], data["note"]
+        finally:
+            data.close()
+    except (IOError,KeyError,ValueError):
+        err = "%s is not a titration matrix (.npz)!" % npz_file
+        raise SparkyTitrationError(err)
+
+    notes = numpy.empty(note.shape,dtype=object)
+    notes[:] = [[str(n) or None for n in row] for row in note]
+
+    return TitrationMatrix(residue,aa,atoms,pH,matrices,notes,observed)
+
+
+def loadTitration(titration,jobs=1):
+    """
+    Return a TitrationMatrix for a directory of .save files named
+    pH_7p01_*.save (parsed across jobs processes, through the parse cache) or
+    for a .npz bundle read by loadArrays.
+    """
+
+    if not os.path.isdir(titration):
+        return loadArrays(titration)
+
+    import sparky_classes
+    extract = sparky_classes.loadScript("sparky_extract-peaks")
+
+    sparky_files = [f for f in os.listdir(titration) if f[-5:] == ".save"]
+    sparky_files.sort()
+    pH_values = [extract.readPH(f) for f in sparky_files]
+    tables = extract.loadAllTables([os.path.join(titration,f)
+                                    for f in sparky_files],jobs)
+
+    with STATS.stage("assemble"):
+        matrix = buildMatrix(tables,pH_values)
+
+    return matrix
+
+
+def _formatPeak(w1,w2,height,volume,note):
+    """
+    Format the data of one observed peak for the long R table.
+    """
+
+    if volume == volume:
+        volume = "%10.2E" % volume
+    else:
+        volume = "%10s" % "NA"
+
+    if note is not None:
+        note = "%30s" % ("\"%s\"" % note[:26])
+    else:
+        note = "%30s" % "NA"
+
+    return "%10.3F%10.3F%10.2E%s%s" % (w1,w2,height,volume,note)
+
+def _internNames(names):
+    """
+    Map each distinct name to an integer id, assigned in the order the names
+    sort when right-justified (the order of the R table labels).
+    """
+
+    names = dict([(n,0) for n in names]).keys()
+    names.sort(key=lambda n: "%10s" % n)
+
+    return dict([(n,i) for i, n in enumerate(names)]), names
+
+
+def buildMatrix(tables,pH_values):
+    """
+    Assemble TitrationMatrix from PeakTables (one per experiment) and the pH
+    of each experiment.  Only labeled peaks are used, keyed by the residue,
+    amino acid, and atoms of w1 and w2 (e.g. 10 VAL N-HN).  If two
+    experiments have the same pH, the later one is used; if a peak appears
+    twice in one experiment, its last entry is used.
+    """
+
+    if len(tables) != len(pH_values):
+        err = "Number of tables and pH values do not match!"
+        raise SparkyTitrationError(err)
+
+    # Keep the last experiment at each pH; columns are sorted by pH
+    last = dict([(pH,i) for i, pH in enumerate(pH_values)])
+    pH = numpy.array(sorted(last.keys()),dtype=numpy.float64)
+    experiments = [(c,last[p]) for c, p in enumerate(pH)]
+    tables = [tables[i].select(tables[i].labeled) for c, i in experiments]
+
+    # Intern amino acid and atom names across all experiments.  Atoms are
+    # coded per table as w1 atom*(number of atoms) + w2 atom.
+    pair_codes = [t.atoms[:,0]*len(t.atom_names) + t.atoms[:,1]
+                  for t in tables]
+    pair_names = []
+    for t, codes in zip(tables,pair_codes):
+        codes = numpy.unique(codes)
+        n = len(t.atom_names)
+        pair_names.append(dict([(p,"%s-%s" % (t.atom_names[p / n],
+                                              t.atom_names[p % n]))
+                                for p in codes]))
+    aa_ids, aa_names = _internNames([a for t in tables for a in t.aa_names])
+    atom_ids, atom_names = _internNames([p for names in pair_names
+                                         for p in names.values()])
+
+    # Flatten every peak into integer key columns
+    residue, aa, atoms, column = [], [], [], []
+    for (c, i), t, codes, names in zip(experiments,tables,pair_codes,
+                                       pair_names):
+        aa_map = numpy.array([aa_ids[a] for a in t.aa_names] + [-1],
+                             dtype=numpy.int64)
+        pair_map = dict([(p,atom_ids[n]) for p, n in names.items()])
+        residue.append(t.res_num[:,0].astype(numpy.int64))
+        aa.append(aa_map[t.aa[:,0]])
+        atoms.append(numpy.array([pair_map[p] for p in codes],
+                                 dtype=numpy.int64))
+        column.append(numpy.repeat(c,len(t)))
+
+    if sum([len(t) for t in tables]) == 0:
+        residue = aa = atoms = column = numpy.zeros(0,dtype=numpy.int64)
+    else:
+        residue = numpy.concatenate(residue)
+        aa = numpy.concatenate(aa)
+        atoms = numpy.concatenate(atoms)
+        column = numpy.concatenate(column)
+
+    # Map (residue,aa,atoms) keys to rows
+    num_aa = max(len(aa_names),1)
+    num_atoms = max(len(atom_names),1)
+    res_min = len(residue) and residue.min() or 0
+    key = ((residue - res_min)*num_aa + aa)*num_atoms + atoms
+    row_keys, row = numpy.unique(key,return_inverse=True)
+
+    num_rows, num_pH = len(row_keys), len(pH)
+    row_atoms = row_keys % num_atoms
+    row_aa = (row_keys / num_atoms) % num_aa
+    row_residue = row_keys / (num_atoms*num_aa) + res_min
+
+    # Keep the last entry of any (row,pH) cell that appears more than once
+    cell = row*num_pH + column
+    last_cell = len(cell) - 1 - numpy.unique(cell[::-1],return_index=True)[1]
+
+    # Scatter the peaks into the matrices
+    sources = {"w1":[t.position[:,0] for t in tables],
+               "w2":[t.position[:,1] for t in tables],
+               "height":[t.height for t in tables],
+               "volume":[t.integral for t in tables]}
+    matrices = {}
+    for m in _MATRICES:
+        values = numpy.zeros(0)
+        if len(cell) > 0:
+            values = numpy.concatenate(sources[m])
+        matrices[m] = numpy.empty((num_rows,num_pH),dtype=numpy.float64)
+        matrices[m].fill(numpy.nan)
+        matrices[m].flat[cell[last_cell]] = values[last_cell]
+
+    observed = numpy.zeros((num_rows,num_pH),dtype=numpy.bool_)
+    observed.flat[cell[last_cell]] = True
+
+    note = numpy.empty((num_rows,num_pH),dtype=object)
+    if len(cell) > 0:
+        notes = numpy.concatenate([t.note for t in tables])[last_cell]
+        for j, n in zip(cell[last_cell],notes):
+            if n is not None:
+                note.flat[j] = n[1:-1]
+
+    aa_names = numpy.array(aa_names + [""],dtype=str)
+    atom_names = numpy.array(atom_names + [""],dtype=str)
+
+    return TitrationMatrix(row_residue,aa_names[row_aa],atom_names[row_atoms],
+                           pH,matrices,note,observed)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+__description__ = \
+"""
+sparky_track-peaks.py
+
+Follow peaks, assigned or not, through a titration.  The spectra in a
+directory of sparky .save files (named pH_7p01_*.save) are sorted by pH and
+the peaks of each are linked to the peaks of the next: positions are scaled
+by a per-dimension ppm scale, candidate links within a tolerance (1 scaled
+unit) come from a KD-tree query, and each connected group of candidates is
+resolved by optimal (minimum total distance) assignment.  Linked peaks form
+trajectories, written as an R-readable table with one row per peak.
+
+Requires scipy.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "080523"
+__usage__ = "sparky_track-peaks.py [options] dir_with_save_files"
+
+import os, sys, optparse
+import numpy
+import sparky_cache, sparky_classes, sparky_stats
+from sparky_stats import STATS
+
+try:
+    from scipy.spatial import cKDTree
+    from scipy.optimize import linear_sum_assignment
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+except ImportError:
+    cKDTree = None
+
+# ppm corresponding to one scaled unit in each dimension (w1,w2,...); the
+# defaults suit N-HN spectra
+TRACK_SCALE = [0.25,0.05]
+
+# Candidate links considered per peak, and the shortest trajectory written
+TRACK_NEIGHBORS = 8
+TRACK_MIN_LENGTH = 2
+
+# Rows formatted (and written) at a time
+CHUNK_ROWS = 4096
+
+class SparkyTrackError(Exception):
+    """
+    General error class for this module.
+    """
+
+    pass
+
+
+def linkPeaks(a,b,tolerance=1.0,neighbors=TRACK_NEIGHBORS):
+    """
+    Link points a (N x dim) one-to-one to points b (M x dim) with no link
+    longer than tolerance, maximizing the number of links and then minimizing
+    their total length.  Returns the indexes into a and b of each link and
+    its length, sorted by b.
+    """
+
+    if cKDTree is None:
+        err = "Peak tracking requires scipy!"
+        raise SparkyTrackError(err)
+
+    empty = (numpy.zeros(0,dtype=numpy.int64),numpy.zeros(0,dtype=numpy.int64),
+             numpy.zeros(0,dtype=numpy.float64))
+    if len(a) == 0 or len(b) == 0:
+        return empty
+
+    # Candidate links: up to neighbors points of a within tolerance of each b
+    k = min(neighbors,len(a))
+    distance, a_index = cKDTree(a).query(b,k=k,distance_upper_bound=tolerance)
+    distance = distance.reshape((len(b),k))
+    a_index = a_index.reshape((len(b),k))
+    candidate = numpy.isfinite(distance)
+    b_index = numpy.repeat(numpy.arange(len(b)),k).reshape((len(b),k))
+    a_index, b_index = a_index[candidate], b_index[candidate]
+    distance = distance[candidate]
+    if len(distance) == 0:
+        return empty
+
+    # Peaks only compete for links within a connected group of candidates
+    num_nodes = len(a) + len(b)
+    graph = coo_matrix((numpy.ones(len(distance)),(a_index,len(a) + b_index)),
+                       shape=(num_nodes,num_nodes))
+    node_group = connected_components(graph,directed=False)[1]
+    num_a = numpy.bincount(node_group[:len(a)],minlength=num_nodes)
+    num_b = numpy.bincount(node_group[len(a):],minlength=num_nodes)
+    group = node_group[a_index]
+
+    # Groups whose candidates all share one peak allow a single link: the
+    # shortest.  Only the rest need an assignment.
+    star = numpy.flatnonzero((num_a[group] == 1) | (num_b[group] == 1))
+    star = star[numpy.lexsort((distance[star],group[star]))]
+    first = numpy.ones(len(star),dtype=numpy.bool_)
+    first[1:] = group[star][1:] != group[star][:-1]
+    star = star[first]
+    links = [(a_index[star],b_index[star],distance[star])]
+
+    assign = numpy.logical_and(num_a[group] > 1,num_b[group] > 1)
+    order = numpy.flatnonzero(assign)
+    order = order[numpy.argsort(group[order],kind="mergesort")]
+    bounds = numpy.flatnonzero(numpy.diff(group[order])) + 1
+    STATS.add("link_groups",len(star) + (len(order) > 0 and len(bounds) + 1))
+    for edges in numpy.split(order,bounds):
+        if len(edges) == 0:
+            continue
+        rows, row_index = numpy.unique(a_index[edges],return_inverse=True)
+        columns, column_index = numpy.unique(b_index[edges],
+                                             return_inverse=True)
+
+        # Pairs that are not candidates cost more than any set of real links
+        forbidden = tolerance*(len(rows) + len(columns)) + 1
+        cost = numpy.empty((len(rows),len(columns)),dtype=numpy.float64)
+        cost.fill(forbidden)
+        cost[row_index,column_index] = distance[edges]
+
+        i, j = linear_sum_assignment(cost)
+        real = cost[i,j] < forbidden
+        links.append((rows[i[real]],columns[j[real]],cost[i,j][real]))
+
+    a_index, b_index, distance = [numpy.concatenate(l) for l in zip(*links)]
+    order = numpy.argsort(b_index)
+
+    return a_index[order], b_index[order], distance[order]
+
+def trackPeaks(tables,scale=TRACK_SCALE,tolerance=1.0,
+               neighbors=TRACK_NEIGHBORS):
+    """
+    Link the peaks of each PeakTable in tables to those of the next.  Returns
+    a list with, for each table, the trajectory id of every peak and its
+    scaled distance from the peak it was linked to (nan if it starts a
+    trajectory).
+    """
+
+    scale = numpy.asarray(scale,dtype=numpy.float64)
+    tracks = []
+    previous = None
+    next_id = 0
+    for t in tables:
+        if t.dimension != len(scale):
+            err = "%i scale values given for a %iD spectrum!" % \
+                  (len(scale),t.dimension)
+            raise SparkyTrackError(err)
+
+        points = t.position/scale
+        ids = numpy.empty(len(t),dtype=numpy.int64)
+        ids.fill(-1)
+        step = numpy.empty(len(t),dtype=numpy.float64)
+        step.fill(numpy.nan)
+
+        if previous is not None:
+            with STATS.stage("link"):
+                a, b, distance = linkPeaks(previous[0],points,tolerance,
+                                           neighbors)
+            ids[b] = previous[1][a]
+            step[b] = distance
+            STATS.add("peaks_linked",len(b))
+
+        new = numpy.flatnonzero(ids < 0)
+        ids[new] = numpy.arange(next_id,next_id + len(new))
+        next_id += len(new)
+
+        tracks.append((ids,step))
+        previous = (points,ids)
+
+    return tracks
+
+def _labels(table):
+    """
+    Residue number, amino acid, and atoms (e.g. N-HN) of each peak, "NA" if
+    unlabeled.
+    """
+
+    aa_names = numpy.array(table.aa_names + ["NA"],dtype=str)
+    atom_names = numpy.array(table.atom_names + ["NA"],dtype=str)
+
+    residue = numpy.array(["%i" % r for r in table.res_num[:,0]],dtype="S10")
+    residue[numpy.logical_not(table.labeled)] = "NA"
+    aa = aa_names[table.aa[:,0]]
+    atoms = ["-".join(a) for a in atom_names[table.atoms]]
+    atoms = numpy.array(atoms,dtype=str)
+    atoms[numpy.logical_not(table.labeled)] = "NA"
+
+    return residue, aa, atoms
+
+def iterTracks(sparky_files,pH_values,tables,tracks,
+               min_length=TRACK_MIN_LENGTH,chunk_rows=CHUNK_ROWS):
+    """
+    Generate an R-readable table of the trajectories (from trackPeaks) with
+    at least min_length peaks, one row per peak ordered by trajectory and pH,
+    in chunks of up to chunk_rows rows.
+    """
+
+    dimension = max([t.dimension for t in tables] + [2])
+    header = ["# Peak trajectories of:\n"]
+    header.extend(["#   %s\n" % f for f in sparky_files])
+    header.append("%10s%10s%10s%10s%10s%12s%s%10s%10s\n" % \
+                  (" ","track","pH","residue","aa","atoms",
+                   "".join(["%10s" % ("w%i" % (d + 1))
+                            for d in range(dimension)]),"height","step"))
+    yield "".join(header)
+
+    if len(tables) == 0:
+        return
+
+    # Order every peak by trajectory, then spectrum
+    ids = numpy.concatenate([t[0] for t in tracks])
+    spectrum = numpy.concatenate([numpy.repeat(i,len(t))
+                                  for i, t in enumerate(tables)])
+    row = numpy.concatenate([numpy.arange(len(t)) for t in tables])
+    length = numpy.bincount(ids,minlength=1)
+    keep = numpy.flatnonzero(length[ids] >= min_length)
+    keep = keep[numpy.lexsort((spectrum[keep],ids[keep]))]
+    STATS.add("tracks_written",(length >= min_length).sum())
+
+    labels = [_labels(t) for t in tables]
+    out = []
+    for i, k in enumerate(keep):
+        s, r = spectrum[k], row[k]
+        t = tables[s]
+        residue, aa, atoms = [l[r] for l in labels[s]]
+        position = "".join(["%10.3F" % p for p in t.position[r]])
+        position += "%10s" % "NA"*(dimension - t.dimension)
+        step = tracks[s][1][r]
+        step = step == step and "%10.3F" % step or "%10s" % "NA"
+        out.append("%10i%10i%10.3F%10s%10s%12s%s%10.2E%s\n" % \
+                   (i,ids[k],pH_values[s],residue,aa,atoms,position,
+                    t.height[r],step))
+
+        if len(out) >= chunk_rows:
+            yield "".join(out)
+            out = []
+
+    if out:
+        yield "".join(out)
+
+
+def main():
+    """
+    If called from command line...
+    """
+
+    parser = optparse.OptionParser(usage=__usage__)
+    parser.add_option("-s","--scale",default=",".join(["%g" % s for s in
+                                                       TRACK_SCALE]),
+                      help="ppm per scaled unit in each dimension; peaks " + \
+                           "link within 1 unit [%s]" % \
+                           ",".join(["%g" % s for s in TRACK_SCALE]))
+    parser.add_option("-t","--tolerance",type="float",default=1.0,
+                      help="longest link in scaled units [1.0]")
+    parser.add_option("-n","--neighbors",type="int",default=TRACK_NEIGHBORS,
+                      help="candidate links per peak [%i]" % TRACK_NEIGHBORS)
+    parser.add_option("-m","--min-length",type="int",default=TRACK_MIN_LENGTH,
+                      help="shortest trajectory written [%i]" % \
+                           TRACK_MIN_LENGTH)
+    parser.add_option("-u","--unlabeled",action="store_true",default=False,
+                      help="only track unlabeled peaks")
+    parser.add_option("-o","--output",default=None,
+                      help="output file [stdout]")
+    options, args = parser.parse_args()
+
+    try:
+        input_dir = args[0]
+    except IndexError:
+        print __usage__
+        sys.exit()
+
+    if not os.path.isdir(input_dir):
+        print "\"%s\" does not exist!" % input_dir
+        sys.exit()
+    if cKDTree is None:
+        print "sparky_track-peaks.py requires scipy"
+        sys.exit(1)
+
+    try:
+        scale = [float(s) for s in options.scale.split(",")]
+        if len([s for s in scale if s <= 0]) > 0:
+            raise ValueError
+    except ValueError:
+        print "--scale must be a list of positive numbers"
+        sys.exit()
+
+    # Spectra in order of pH
+    extract = sparky_classes.loadScript("sparky_extract-peaks")
+    sparky_files = [f for f in os.listdir(input_dir) if f[-5:] == ".save"]
+    to_sort = [(extract.readPH(f),f) for f in sparky_files]
+    to_sort.sort()
+    pH_values = [s[0] for s in to_sort]
+    sparky_files = [os.path.join(input_dir,s[1]) for s in to_sort]
+
+    tables = []
+    for f in sparky_files:
+        table = sparky_cache.loadPeakTable(f,skip_unlabeled=False)
+        if options.unlabeled:
+            table = table.select(numpy.logical_not(table.labeled))
+        tables.append(table)
+
+    try:
+        tracks = trackPeaks(tables,scale,options.tolerance,options.neighbors)
+    except SparkyTrackError, e:
+        print e
+        sys.exit(1)
+
+    with STATS.stage("output"):
+        if options.output is None:
+            g = sys.stdout
+        else:
+            g = open(options.output,'w')
+        for chunk in iterTracks(sparky_files,pH_values,tables,tracks,
+                                options.min_length):
+            g.write(chunk)
+        if options.output is None:
+            g.write("\n")
+        else:
+            g.close()
+
+
+if __name__ == "__main__":
+    sparky_stats.run(main)